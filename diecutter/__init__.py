@@ -1,7 +1,54 @@
 # -*- coding: utf-8 -*-
-"""Diecutter provides API to manage and render templates."""
-import pkg_resources
+"""Diecutter provides API to manage and render templates.
+
+Importing this package is cheap: submodules are not imported, and version is
+read without :py:mod:`pkg_resources`, which takes long to import.
+
+"""
+import os
+
+
+def get_version():
+    """Return version of diecutter distribution.
+
+    Version is read, in order:
+
+    * from ``VERSION`` file, in a code repository (including development
+      installs);
+
+    * from name of distribution metadata (``diecutter-<version>.dist-info``
+      or ``diecutter-<version>-py2.7.egg-info``), next to the package, if
+      there is only one;
+
+    * using :py:mod:`pkg_resources`, as a last resort, e.g. when stale
+      metadata of previous installs is left next to the package.
+
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(package_dir)
+    if os.path.exists(os.path.join(parent_dir, 'setup.py')):
+        try:
+            with open(os.path.join(parent_dir, 'VERSION')) as version_file:
+                return version_file.read().strip()
+        except IOError:
+            pass
+    prefix = '{name}-'.format(name=__name__)
+    try:
+        names = os.listdir(parent_dir)
+    except OSError:
+        names = []
+    versions = set()
+    for name in names:
+        if name.startswith(prefix):
+            for suffix in ('.dist-info', '.egg-info'):
+                if name.endswith(suffix):
+                    version = name[len(prefix):-len(suffix)]
+                    versions.add(version.split('-py', 1)[0])
+    if len(versions) == 1:
+        return versions.pop()
+    import pkg_resources
+    return pkg_resources.get_distribution(__name__).version
 
 
 #: Module version, as defined in PEP-0396.
-__version__ = pkg_resources.get_distribution(__package__).version
+__version__ = get_version()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Admission control: limit concurrent requests per class, shed load.
+
+Requests are classified by cost:
+
+* "file": POST rendering a single file ;
+* "directory": POST rendering an archive (directories, batches, manifests) ;
+* "get": GET of a raw template ;
+* "put": PUT of a template.
+
+Each class has a limit of concurrent requests and a bounded queue. When a
+request arrives and the limit is reached, it waits in the queue. When the
+queue is full, or when it waited too long, it is rejected immediately with
+``503 Service Unavailable``. So cheap requests are not stuck behind long
+archive renders.
+
+"""
+import threading
+import time
+
+
+#: Classes of requests.
+REQUEST_CLASSES = ('file', 'directory', 'get', 'put')
+
+
+class Limiter(object):
+    """Allow ``limit`` concurrent holders, and ``queue`` waiting ones."""
+    def __init__(self, limit, queue=0, timeout=30, clock=time.time):
+        #: Maximum number of concurrent holders.
+        self.limit = limit
+        #: Maximum number of waiting requests.
+        self.queue = queue
+        #: Maximum time waiting, in seconds.
+        self.timeout = timeout
+        #: Function that returns current time, in seconds.
+        self.clock = clock
+        #: Number of current holders.
+        self.active = 0
+        #: Number of waiting requests.
+        self.waiting = 0
+        #: Number of admitted requests.
+        self.admitted = 0
+        #: Number of requests rejected because queue was full.
+        self.rejected = 0
+        #: Number of requests rejected because they waited too long.
+        self.timeouts = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """Return True once admitted, False if rejected."""
+        with self._condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                try:
+                    deadline = self.clock() + self.timeout
+                    while self.active >= self.limit:
+                        remaining = deadline - self.clock()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """Release slot, wake up one waiting request."""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def info(self):
+        """Return dictionary of statistics."""
+        with self._condition:
+            return {'limit': self.limit,
+                    'queue': self.queue,
+                    'active': self.active,
+                    'waiting': self.waiting,
+                    'admitted': self.admitted,
+                    'rejected': self.rejected,
+                    'timeouts': self.timeouts}
+
+
+class AdmissionControl(object):
+    """:py:class:`Limiter` instances, indexed by request class."""
+    def __init__(self, limits, timeout=30, retry_after=1):
+        #: Dictionary of :py:class:`Limiter`, indexed by class. Classes
+        #: without limiter are not limited.
+        self.limiters = dict(
+            (request_class, Limiter(limit, queue, timeout))
+            for request_class, (limit, queue) in limits.items())
+        #: Value of ``Retry-After`` header of rejections, in seconds.
+        self.retry_after = retry_after
+
+    def acquire(self, request_class):
+        """Return function that releases slot, or ``None`` if rejected."""
+        limiter = self.limiters.get(request_class)
+        if limiter is None:
+            return lambda: None
+        if not limiter.acquire():
+            return None
+        released = []
+
+        def release():
+            if not released:  # Release once.
+                released.append(True)
+                limiter.release()
+        return release
+
+    def info(self):
+        """Return statistics of limiters, indexed by request class."""
+        return dict((request_class, limiter.info())
+                    for request_class, limiter in self.limiters.items())
+
+
+def parse_limits(value):
+    """Return ``(limit, queue)`` from setting ``value``.
+
+    Value is a limit, optionally followed by queue size. Queue size defaults
+    to limit.
+
+    >>> from diecutter.admission import parse_limits
+    >>> parse_limits('4 16')
+    (4, 16)
+    >>> parse_limits('2')
+    (2, 2)
+
+    """
+    parts = [int(part) for part in str(value).split()]
+    if len(parts) == 1:
+        parts.append(parts[0])
+    if len(parts) != 2 or parts[0] <= 0 or parts[1] < 0:
+        raise ValueError(value)
+    return tuple(parts)
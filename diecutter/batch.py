@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Render many templates or contexts in one request, as one archive."""
+from os.path import basename
+
+from piecutter.exceptions import TemplateError
+
+from diecutter.exceptions import DataParsingError
+
+
+def template_renderer(engine, template):
+    """Return callable which renders ``template`` against a context.
+
+    ``template`` is compiled once if ``engine`` supports it, i.e. if it is a
+    :py:class:`~diecutter.engines.CachedEngine` with a compiler.
+
+    """
+    if getattr(engine, 'compiler', None) is None:
+        return lambda context: engine.render(template, context)
+    return engine.compile(template)
+
+
+class BatchResource(object):
+    """Proxy to a resource, rendered against a list of contexts.
+
+    Output of :py:meth:`render` has the same format as
+    :py:meth:`piecutter.resources.DirResource.render`, so that batches are
+    written as archives.
+
+    Each context gets a name, which is the basename of resource rendered
+    against the context with filename engine. File resources give one entry
+    per context, named after the context. Directory resources give one
+    directory per context. Empty or duplicate names are prefixed with the
+    index of context in the batch.
+
+    """
+    is_file = False
+
+    def __init__(self, resource, contexts):
+        #: Wrapped file or directory resource.
+        self.resource = resource
+        #: List of contexts (dictionaries).
+        self.contexts = contexts
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def archive_name(self, context):
+        """Return name of archive, without extension."""
+        return 'batch'
+
+    def item_name(self, index, context, names):
+        """Return unique name of ``context``, register it in ``names``."""
+        template = basename(self.resource.path.rstrip('/'))
+        name = self.resource.filename_engine.render(template, context)
+        if not name:
+            name = str(index)
+        elif name in names:
+            name = '{index}-{name}'.format(index=index, name=name)
+        names.add(name)
+        return name
+
+    def item_contexts(self, context):
+        """Generate ``(index, item_context)`` for each context in batch.
+
+        Items are updated with ``diecutter`` variables from ``context``, plus
+        ``diecutter.index``.
+
+        """
+        for index, item in enumerate(self.contexts):
+            item_context = dict(item)
+            item_context['diecutter'] = dict(context.get('diecutter', {}),
+                                             index=index)
+            yield index, item_context
+
+    def render(self, context):
+        """Generate ``(filename, content)`` for all contexts in batch."""
+        if self.resource.is_file:
+            return self.render_file(context)
+        return self.render_dir(context)
+
+    def render_file(self, context):
+        """Generate one ``(filename, content)`` per context.
+
+        Template is read and compiled once.
+
+        """
+        try:
+            render = template_renderer(self.resource.engine,
+                                       self.resource.read())
+        except (TemplateError, UnicodeDecodeError) as e:
+            raise TemplateError('%s: %s' % (self.resource.path, e))
+        names = set()
+        for index, item_context in self.item_contexts(context):
+            name = self.item_name(index, item_context, names)
+            try:
+                content = render(item_context).encode('utf-8')
+            except TemplateError as e:
+                raise TemplateError('%s: %s' % (self.resource.path, e))
+            yield name, [content]
+
+    def render_dir(self, context):
+        """Generate ``(filename, content)`` in one directory per context."""
+        names = set()
+        for index, item_context in self.item_contexts(context):
+            name = self.item_name(index, item_context, names)
+            for filename, content in self.resource.render(item_context):
+                yield '{dir}/{file}'.format(dir=name, file=filename), content
+
+
+def extract_manifest(request):
+    """Return list of manifest entries from JSON body of ``request``.
+
+    Body is a JSON array of objects with keys ``template_path`` (mandatory),
+    ``output_name`` and ``context`` (optional). Returned entries are
+    dictionaries with all three keys, ``output_name`` defaults to ``None``
+    and ``context`` to ``{}``.
+
+    Raise :py:class:`~diecutter.exceptions.DataParsingError` if body is not
+    a valid manifest.
+
+    """
+    try:
+        data = request.json_body
+    except ValueError:
+        raise DataParsingError('Failed to parse JSON manifest.')
+    if not isinstance(data, list):
+        raise DataParsingError('Manifest must be a list of entries.')
+    entries = []
+    for item in data:
+        if not isinstance(item, dict) \
+                or not isinstance(item.get('template_path'), basestring):
+            raise DataParsingError('Manifest entries must have a '
+                                   '"template_path".')
+        entry = {'template_path': item['template_path'],
+                 'output_name': item.get('output_name'),
+                 'context': item.get('context', {})}
+        if not isinstance(entry['context'], dict):
+            raise DataParsingError('Manifest "context" must be an object.')
+        if entry['output_name'] is not None \
+                and not isinstance(entry['output_name'], basestring):
+            raise DataParsingError('Manifest "output_name" must be a string.')
+        entries.append(entry)
+    return entries
+
+
+class ManifestResource(object):
+    """Several resources, each rendered against its own context.
+
+    Output of :py:meth:`render` has the same format as
+    :py:meth:`piecutter.resources.DirResource.render`, so that manifests are
+    written as archives.
+
+    File resources give one entry, named ``output_name``. Directory
+    resources give one directory named ``output_name``. If ``output_name``
+    is ``None``, template path rendered against context with filename engine
+    is used.
+
+    """
+    is_file = False
+
+    def __init__(self, items):
+        #: List of ``(template_path, resource, output_name, context)``.
+        self.items = items
+
+    def archive_name(self, context):
+        """Return name of archive, without extension."""
+        return 'manifest'
+
+    def item_name(self, template_path, resource, output_name, context):
+        """Return name of output for item."""
+        if output_name is None:
+            output_name = resource.filename_engine.render(
+                template_path.rstrip('/'), context)
+        return output_name.strip('/')
+
+    def render(self, context):
+        """Generate ``(filename, content)`` for all items in manifest."""
+        for template_path, resource, output_name, item_context in self.items:
+            name = self.item_name(template_path, resource, output_name,
+                                  item_context)
+            if resource.is_file:
+                yield name, resource.render(item_context)
+            else:
+                for filename, content in resource.render(item_context):
+                    yield '{dir}/{file}'.format(dir=name, file=filename), \
+                        content
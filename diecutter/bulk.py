@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""Offline bulk renders: one template, many contexts, outputs on disk.
+
+Renders use the same services, engines and writers as HTTP requests. Outputs
+are named as in batch archives (see :py:class:`diecutter.batch.BatchResource`)
+and written atomically, so that an interrupted run can be resumed: outputs
+that already exist are skipped.
+
+Use it from command line, as ``diecutter render``.
+
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+
+from pyramid.request import Request
+
+from piecutter.exceptions import TemplateError
+
+from diecutter.batch import BatchResource, template_renderer
+from diecutter.exceptions import DataParsingError
+from diecutter.writers import coalesce, targz_directory_stream, \
+    zip_directory_stream
+
+
+#: Archive writers for directory templates, indexed by archive type, which is
+#: also the extension of output files.
+ARCHIVE_STREAMS = {
+    'zip': zip_directory_stream,
+    'tar.gz': targz_directory_stream,
+}
+
+#: Size of chunks written to output files, in bytes.
+CHUNK_SIZE = 64 * 1024
+
+
+def read_contexts(lines):
+    """Generate contexts from JSON ``lines``, skipping blank lines.
+
+    Raise :py:class:`~diecutter.exceptions.DataParsingError` on invalid lines.
+
+    >>> from diecutter.bulk import read_contexts
+    >>> list(read_contexts(['{"name": "a"}', '', '{"name": "b"}']))
+    [{u'name': u'a'}, {u'name': u'b'}]
+
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            context = json.loads(line)
+        except ValueError:
+            raise DataParsingError(
+                'Failed to parse JSON line {number}.'.format(number=number))
+        if not isinstance(context, dict):
+            raise DataParsingError(
+                'Line {number} is not an object (dictionary).'.format(
+                    number=number))
+        yield context
+
+
+def safe_join(directory, name):
+    """Return path of ``name`` in ``directory``, or raise ValueError."""
+    directory = os.path.normpath(directory)
+    path = os.path.normpath(os.path.join(directory, name))
+    if not path.startswith(directory + os.sep):
+        raise ValueError('Output path is outside output directory: '
+                         '{name}'.format(name=name))
+    return path
+
+
+def remove(path):
+    """Remove file or directory at ``path``, if any."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def write_chunks(path, chunks):
+    """Write ``chunks`` to file at ``path``, return number of bytes."""
+    size = 0
+    with open(path, 'wb') as output_file:
+        for chunk in coalesce(chunks, CHUNK_SIZE):
+            output_file.write(chunk)
+            size += len(chunk)
+    return size
+
+
+class BulkRenderer(object):
+    """Render template of ``service`` against contexts, to ``output_dir``.
+
+    File templates give one file per context. Directory templates give one
+    directory per context, or one archive if ``archive_type`` is set (see
+    :py:data:`ARCHIVE_STREAMS`).
+
+    Instances are callables which render ``(index, name, context)`` items and
+    return ``(index, name, size, error)``, so that they can be mapped on
+    items by worker processes.
+
+    """
+    def __init__(self, service, template_path, output_dir, engine='',
+                 archive_type=''):
+        #: :py:class:`~diecutter.local.LocalService` instance.
+        self.service = service
+        #: Path of template, relative to template directory.
+        self.template_path = template_path
+        #: Directory where outputs are written.
+        self.output_dir = output_dir
+        #: Slug of engine, or ``''`` for default engine.
+        self.engine = engine
+        #: Type of archives written for directory templates, or ``''``.
+        self.archive_type = archive_type
+        self._resource = None
+        self._render_file = None
+
+    def get_request(self):
+        """Return blank request, as if template was requested over HTTP."""
+        path = '/?engine={engine}'.format(engine=self.engine) \
+            if self.engine else '/'
+        request = Request.blank(path)
+        request.matchdict = {'template_path': self.template_path}
+        return request
+
+    @property
+    def resource(self):
+        """Template resource. Raise ValueError if template does not exist.
+        """
+        if self._resource is None:
+            resource = self.service.get_resource(self.get_request(),
+                                                 self.template_path)
+            if not resource or not resource.exists:
+                raise ValueError('Template not found: {path}'.format(
+                    path=self.template_path))
+            self._resource = resource
+        return self._resource
+
+    def items(self, contexts):
+        """Generate ``(index, name, context)`` for each item of ``contexts``.
+
+        Contexts get ``diecutter`` variables, as in batch renders. Names are
+        unique, and do not depend on which outputs already exist.
+
+        """
+        request = self.get_request()
+        batch = BatchResource(self.resource, contexts)
+        context = {'diecutter': self.service.get_diecutter_context(request)}
+        names = set()
+        for index, item_context in batch.item_contexts(context):
+            yield index, batch.item_name(index, item_context, names), \
+                item_context
+
+    def output_path(self, name):
+        """Return path of output of item ``name``."""
+        if self.archive_type and not self.resource.is_file:
+            name = '{name}.{extension}'.format(name=name,
+                                               extension=self.archive_type)
+        return safe_join(self.output_dir, name)
+
+    def is_done(self, name):
+        """Return whether output of item ``name`` already exists."""
+        return os.path.lexists(self.output_path(name))
+
+    def render_file(self, context):
+        """Return content of file template rendered against ``context``.
+
+        Template is read and compiled once.
+
+        """
+        path = self.resource.path
+        try:
+            if self._render_file is None:
+                self._render_file = template_renderer(self.resource.engine,
+                                                      self.resource.read())
+            return [self._render_file(context).encode('utf-8')]
+        except (TemplateError, UnicodeDecodeError) as e:
+            raise TemplateError('%s: %s' % (path, e))
+
+    def render_item(self, name, context):
+        """Render item to its output path, return number of bytes written.
+
+        Output is written to a temporary path, then renamed.
+
+        """
+        path = self.output_path(name)
+        directory, filename = os.path.split(path)
+        partial = os.path.join(directory, '.{name}.part'.format(name=filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        remove(partial)
+        try:
+            if self.resource.is_file:
+                size = write_chunks(partial, self.render_file(context))
+            elif self.archive_type:
+                stream = ARCHIVE_STREAMS[self.archive_type]
+                size = write_chunks(partial,
+                                    stream(self.resource.render(context)))
+            else:
+                size = 0
+                os.mkdir(partial)
+                for relative, content in self.resource.render(context):
+                    file_path = safe_join(partial, relative)
+                    if not os.path.isdir(os.path.dirname(file_path)):
+                        os.makedirs(os.path.dirname(file_path))
+                    size += write_chunks(file_path, content)
+                remove(path)  # Directories cannot be replaced by rename.
+            os.rename(partial, path)
+        except Exception:
+            remove(partial)
+            raise
+        return size
+
+    def __call__(self, item):
+        index, name, context = item
+        try:
+            return index, name, self.render_item(name, context), None
+        except (TemplateError, ValueError, EnvironmentError) as e:
+            return index, name, 0, str(e)
+
+
+#: :py:class:`BulkRenderer` of worker process.
+_renderer = None
+
+
+def init_worker(service_factory, settings, *args):
+    """Setup worker process: build service and :py:class:`BulkRenderer`.
+
+    Interruptions are handled by parent process.
+
+    """
+    global _renderer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import diecutter.settings
+    service = service_factory()
+    service.configure(diecutter.settings.configure(settings))
+    _renderer = BulkRenderer(service, *args)
+
+
+def render_chunk(items):
+    """Render ``items`` with worker's :py:class:`BulkRenderer`."""
+    return [_renderer(item) for item in items]
+
+
+def chunks(iterable, size):
+    """Generate lists of ``size`` items of ``iterable``.
+
+    >>> from diecutter.bulk import chunks
+    >>> list(chunks(xrange(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def interruptible(results):
+    """Generate items of chunks in pool's ``results``, allowing
+    KeyboardInterrupt.
+
+    In Python 2, waiting for results without a timeout cannot be interrupted.
+    Pools give such results when chunksize is greater than 1: so chunks are
+    made by callers.
+
+    """
+    while True:
+        try:
+            chunk = results.next(1)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+        for item in chunk:
+            yield item
+
+
+def format_report(report):
+    """Return report of :py:func:`run` as a line of text.
+
+    >>> from diecutter.bulk import format_report
+    >>> print format_report({'rendered': 30, 'skipped': 5, 'errors': [],
+    ...                      'bytes': 3 * 1024 * 1024, 'duration': 2})
+    30 rendered, 5 skipped, 0 errors in 2.0s (15.0 items/s, 1.50 MB/s)
+
+    """
+    duration = float(report['duration']) or 1e-9
+    return ('{rendered} rendered, {skipped} skipped, {errors} errors in '
+            '{duration:.1f}s ({rate:.1f} items/s, {throughput:.2f} MB/s)'
+            .format(rendered=report['rendered'],
+                    skipped=report['skipped'],
+                    errors=len(report['errors']),
+                    duration=report['duration'],
+                    rate=report['rendered'] / duration,
+                    throughput=report['bytes'] / duration / 1024 / 1024))
+
+
+class Progress(object):
+    """Write report of :py:func:`run` to ``stream``, every ``interval``."""
+    def __init__(self, stream, interval=1, clock=time.time):
+        self.stream = stream
+        self.interval = interval
+        self.clock = clock
+        self.last = clock()
+
+    def __call__(self, report, force=False):
+        now = self.clock()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            self.stream.write(format_report(report) + '\n')
+            self.stream.flush()
+
+
+def run(renderer, contexts, processes=1, force=False, progress=None,
+        chunksize=8):
+    """Render ``contexts`` with ``renderer``, in ``processes`` processes.
+
+    Items whose output already exists are skipped, unless ``force`` is
+    ``True``. ``progress`` is called with report after each item.
+
+    Return report: dictionary with number of items ``rendered`` and
+    ``skipped``, ``errors`` as a list of ``(name, message)``, ``bytes``
+    written, ``duration`` in seconds, and ``interrupted`` flag.
+
+    """
+    start = time.time()
+    report = {'rendered': 0, 'skipped': 0, 'errors': [], 'bytes': 0,
+              'duration': 0, 'interrupted': False}
+
+    failures = []
+
+    def tasks():
+        # Pools consume tasks in a thread, where exceptions would be lost.
+        try:
+            for index, name, context in renderer.items(contexts):
+                if not force and renderer.is_done(name):
+                    report['skipped'] += 1
+                    continue
+                yield index, name, context
+        except Exception as e:
+            failures.append(e)
+
+    renderer.resource  # Fail early if template does not exist.
+    pool = None
+    if processes > 1:
+        service = renderer.service
+        pool = multiprocessing.Pool(
+            processes, init_worker,
+            (type(service), service.configuration.settings,
+             renderer.template_path, renderer.output_dir, renderer.engine,
+             renderer.archive_type))
+        results = interruptible(pool.imap_unordered(
+            render_chunk, chunks(tasks(), chunksize)))
+    else:
+        results = itertools.imap(renderer, tasks())
+    try:
+        for index, name, size, error in results:
+            if error is None:
+                report['rendered'] += 1
+                report['bytes'] += size
+            else:
+                report['errors'].append((name, error))
+            report['duration'] = time.time() - start
+            if progress is not None:
+                progress(report)
+    except KeyboardInterrupt:
+        report['interrupted'] = True
+    finally:
+        if pool is not None:  # Workers are idle, unless interrupted.
+            pool.terminate()
+            pool.join()
+    report['duration'] = time.time() - start
+    if failures:
+        raise failures[0]
+    return report
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""Serve templates from a bundle: one ZIP file, memory-mapped.
+
+With many small templates, filesystem metadata calls dominate lookups, and
+deploying a template directory is slow. A bundle is a ZIP file of the
+template directory. Its central directory is read once, into an in-memory
+index (see :py:mod:`diecutter.index`), then templates are read from a memory
+map, without system calls.
+
+Deploy a new bundle by renaming it over the old one: it is loaded on next
+reload, and swapped atomically with the old one. Requests in progress keep
+reading the old one.
+
+Templates uploaded with PUT are written to an overlay directory, whose files
+take precedence over bundle's.
+
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+from pyramid.exceptions import ConfigurationError, Forbidden
+
+from piecutter import resources
+
+from diecutter.index import Entry, IndexedDirResource, IndexedFileResource, \
+    PollingWatcher, Snapshot, TemplateIndex, scan
+from diecutter.local import LocalService
+from diecutter.service import Service
+from diecutter.settings import to_integer
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Local file header of ZIP entries.
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+
+
+def bundle_version(path):
+    """Return ``(inode, mtime, size)`` of file at ``path``, or ``None``."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def member_name(name):
+    """Return normalized relative path of ZIP member, or ``None`` if unsafe.
+
+    >>> from diecutter.bundle import member_name
+    >>> member_name('./dir/file.txt'), member_name('dir/')
+    ('dir/file.txt', 'dir')
+    >>> member_name('../file.txt') is None, member_name('/etc') is None
+    (True, True)
+
+    """
+    parts = [part for part in name.split('/') if part and part != '.']
+    if not parts or '..' in parts or name.startswith('/'):
+        return None
+    return os.path.join(*parts)
+
+
+class Bundle(object):
+    """ZIP file of templates, memory-mapped.
+
+    :py:attr:`snapshot` is a :py:class:`~diecutter.index.Snapshot` of its
+    content, as if it was extracted.
+
+    """
+    def __init__(self, path):
+        #: Path of ZIP file.
+        self.path = path
+        #: Version of file, see :py:func:`bundle_version`.
+        self.version = bundle_version(path)
+        with open(path, 'rb') as bundle_file:
+            self.data = mmap.mmap(bundle_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            infolist = zipfile.ZipFile(bundle_file).infolist()
+        #: Dictionary of :py:class:`zipfile.ZipInfo`, indexed by path.
+        self.members = {}
+        mtime = self.version[1]
+        entries = {'': Entry('dir', mtime, 0)}
+        for info in infolist:
+            name = member_name(info.filename)
+            if name is None:
+                continue
+            parts = name.split(os.sep)
+            for depth in range(1, len(parts)):
+                entries[os.path.join(*parts[:depth])] = \
+                    Entry('dir', mtime, 0)
+            if info.filename.endswith('/'):
+                entries[name] = Entry('dir', mtime, 0)
+                continue
+            self.members[name] = info
+            entries[name] = Entry('file', time.mktime(info.date_time + (
+                0, 0, -1)), info.file_size)
+        #: :py:class:`~diecutter.index.Snapshot` of bundle's content.
+        self.snapshot = snapshot_from_entries(entries)
+
+    def read(self, name):
+        """Return content of member ``name``. Raise KeyError if missing."""
+        info = self.members[name]
+        offset = info.header_offset
+        header = LOCAL_HEADER.unpack(
+            self.data[offset:offset + LOCAL_HEADER.size])
+        start = offset + LOCAL_HEADER.size + header[9] + header[10]
+        data = self.data[start:start + info.compress_size]
+        if info.compress_type == zipfile.ZIP_STORED:
+            return data
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        raise ValueError('Unsupported compression of {name} in {path}'
+                         .format(name=name, path=self.path))
+
+
+def snapshot_from_entries(entries):
+    """Return :py:class:`~diecutter.index.Snapshot` of ``entries``.
+
+    ``entries`` is a dictionary of :py:class:`~diecutter.index.Entry`,
+    indexed by relative path. Parent directories must have entries.
+
+    """
+    children = dict((path, ([], [])) for path, entry in entries.items()
+                    if entry.kind == 'dir')
+    for path, entry in entries.items():
+        if path:
+            files, dirs = children[os.path.dirname(path)]
+            (files if entry.kind == 'file' else dirs).append(
+                os.path.basename(path))
+    return Snapshot(entries, dict((path, (tuple(sorted(files)),
+                                          tuple(sorted(dirs))))
+                                  for path, (files, dirs) in children.items()))
+
+
+def write_bundle(template_dir, path):
+    """Write bundle of ``template_dir`` at ``path``, atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as archive:
+            for root, dirs, files in os.walk(template_dir):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    archive.write(file_path,
+                                  os.path.relpath(file_path, template_dir))
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+class BundleSnapshot(Snapshot):
+    """Snapshot of bundle and overlay, merged.
+
+    Bundle is part of snapshot, so that they are swapped together.
+
+    """
+    def __init__(self, bundle, overlay=None):
+        entries = dict(bundle.snapshot.entries)
+        #: Relative paths of files in overlay.
+        self.overlay = frozenset()
+        if overlay is not None:
+            entries.update(overlay.entries)
+            self.overlay = frozenset(path for path, entry
+                                     in overlay.entries.items()
+                                     if entry.kind == 'file')
+        merged = snapshot_from_entries(entries)
+        super(BundleSnapshot, self).__init__(merged.entries, merged.children)
+        #: :py:class:`Bundle` instance.
+        self.bundle = bundle
+
+
+class BundleIndex(TemplateIndex):
+    """Index of templates of a bundle, merged with an overlay directory.
+
+    Paths are relative to :py:attr:`root`, which is ``overlay_dir`` if set,
+    so that files uploaded with PUT are written there. Else it is bundle's
+    path, and paths are virtual.
+
+    """
+    def __init__(self, path, overlay_dir=''):
+        #: Path of bundle file.
+        self.path = os.path.abspath(path)
+        #: Directory of files that take precedence over bundle's, or ``''``.
+        self.overlay_dir = overlay_dir
+        self.root = os.path.normpath(os.path.abspath(overlay_dir or path))
+        overlay = scan(self.root) if overlay_dir else None
+        #: Current :py:class:`BundleSnapshot`.
+        self.snapshot = BundleSnapshot(Bundle(self.path), overlay)
+        self._failed_version = None
+
+    def file_version(self, snapshot, relative, entry):
+        """Return version of file, including CRC of bundle's members."""
+        info = None
+        if relative not in snapshot.overlay:
+            info = snapshot.bundle.members.get(relative)
+        return (entry.mtime, entry.size, info.CRC if info else None)
+
+    def refresh(self):
+        """Load bundle if it changed, scan overlay again.
+
+        Return True if something changed. If new bundle cannot be loaded,
+        current one is kept.
+
+        """
+        bundle = self.snapshot.bundle
+        version = bundle_version(self.path)
+        if version not in (bundle.version, self._failed_version):
+            try:
+                bundle = Bundle(self.path)
+            except (EnvironmentError, ValueError, zipfile.BadZipfile) as e:
+                self._failed_version = version  # Log once.
+                logger.error('Failed to load bundle {path}: {error}'
+                             .format(path=self.path, error=e))
+            else:
+                logger.info('Loaded bundle {path}'.format(path=self.path))
+        overlay = scan(self.root) if self.overlay_dir else None
+        snapshot = BundleSnapshot(bundle, overlay)
+        changed = bundle is not self.snapshot.bundle or \
+            snapshot.entries != self.snapshot.entries
+        self.snapshot = snapshot
+        return changed
+
+
+class BundleFileResource(resources.FileResource):
+    """File resource read from a :py:class:`Bundle`."""
+    exists = True
+
+    def __init__(self, path='', engine=None, filename_engine=None,
+                 bundle=None, name=''):
+        super(BundleFileResource, self).__init__(path, engine,
+                                                 filename_engine)
+        #: :py:class:`Bundle` instance.
+        self.bundle = bundle
+        #: Path of member in bundle.
+        self.name = name
+
+    def read(self):
+        """Return the template source, read from bundle."""
+        try:
+            return self.bundle.read(self.name).decode('utf-8')
+        except KeyError:
+            raise IOError('No such file in bundle: {name}'.format(
+                name=self.name))
+
+
+def file_resource(index, snapshot, path, engine, filename_engine=None):
+    """Return resource of file at ``path``, in overlay or bundle."""
+    relative = index.relative_path(path)
+    if relative in snapshot.overlay:
+        return IndexedFileResource(path=path, engine=engine,
+                                   filename_engine=filename_engine)
+    return BundleFileResource(path=path, engine=engine,
+                              filename_engine=filename_engine,
+                              bundle=snapshot.bundle, name=relative)
+
+
+class BundleDirResource(IndexedDirResource):
+    """Directory resource of a :py:class:`BundleIndex`.
+
+    Tree and files are read from the snapshot of index at creation time.
+
+    """
+    def __init__(self, path='', engine=None, filename_engine=None,
+                 index=None):
+        super(BundleDirResource, self).__init__(path, engine,
+                                                filename_engine, index)
+        #: :py:class:`BundleSnapshot` instance.
+        self.snapshot = index.snapshot
+
+    def read_tree(self):
+        """Generate list of paths to contained resources, from snapshot."""
+        for relative in self.index.walk(self.path, self.snapshot):
+            yield os.path.join(self.index.root, relative)
+
+    def get_file_resource(self, path):
+        """Return resource of file at ``path``, in overlay or bundle."""
+        file_path = os.path.join(self.path, os.path.normpath(path))
+        if not file_path.startswith(self.path.rstrip(os.sep) + os.sep):
+            raise ValueError('File resource path is not relative to '
+                             'directory path. FILE: "{f}", DIR: "{d}"'
+                             .format(f=path, d=self.path))
+        return file_resource(self.index, self.snapshot, file_path,
+                             self.engine)
+
+
+class BundleService(LocalService):
+    """A diecutter service that reads templates from a bundle.
+
+    See :py:mod:`diecutter.bundle`. Bundle is read from
+    "diecutter.bundle.path" setting, and reloaded every
+    "diecutter.bundle.reload_interval" seconds if it changed. PUT requests
+    write to "diecutter.bundle.overlay_dir".
+
+    """
+    def configure(self, configuration):
+        """Setup service: load bundle, start reloading it.
+
+        "diecutter.template_dir" and "diecutter.template_index" settings are
+        not used.
+
+        """
+        Service.configure(self, configuration)
+        settings = configuration.settings
+        path = settings.get('diecutter.bundle.path')
+        if not path:
+            raise ConfigurationError(
+                'Missing mandatory "diecutter.bundle.path" setting.')
+        overlay_dir = settings.get('diecutter.bundle.overlay_dir', '')
+        if overlay_dir and not os.path.isdir(overlay_dir):
+            os.makedirs(overlay_dir)
+        try:
+            self.template_index = BundleIndex(path, overlay_dir)
+        except (EnvironmentError, ValueError, zipfile.BadZipfile) as e:
+            raise ConfigurationError(
+                'Cannot load bundle {path}: {error}'.format(path=path,
+                                                            error=e))
+        interval = to_integer(settings, 'diecutter.bundle.reload_interval')
+        if interval > 0:
+            self.template_index_watcher = PollingWatcher(self.template_index,
+                                                         interval)
+            self.template_index_watcher.start()
+
+    def put(self, request):
+        if not self.template_index.overlay_dir:
+            raise Forbidden('This diecutter server has no overlay directory.')
+        return super(BundleService, self).put(request)
+
+    def get_indexed_resource(self, request, path):
+        """Return resource at ``path``, from bundle or overlay, or ``None``.
+
+        Paths with a trailing slash only match directories.
+
+        """
+        snapshot = self.template_index.snapshot
+        relative = self.template_index.relative_path(path)
+        entry = None if relative is None else snapshot.entries.get(relative)
+        if entry is None or (path.endswith('/') and entry.kind == 'file'):
+            return None
+        engine = self.get_engine(request)
+        filename_engine = self.get_filename_engine(request)
+        if entry.kind == 'dir':
+            return BundleDirResource(
+                path=path, engine=engine, filename_engine=filename_engine,
+                index=self.template_index)
+        return file_resource(self.template_index, snapshot, path, engine,
+                             filename_engine)
+
+    def get_template_dir(self, request):
+        """Return root of bundle's index: overlay directory, or bundle path.
+        """
+        return self.template_index.root
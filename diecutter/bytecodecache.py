@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of Jinja2 bytecode, shared by processes.
+
+Jinja2 compiles templates into Python code, then into bytecode.
+:py:class:`BytecodeCache` stores bytecode in ``diecutter.bytecode_cache_dir``,
+so that every worker process, and processes started after a restart, reuse
+compiled templates.
+
+Files are written atomically (temporary file then rename), so that concurrent
+workers never read partial bytecode.
+
+"""
+import errno
+import os
+import tempfile
+
+from jinja2.bccache import FileSystemBytecodeCache
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """Jinja2 filesystem bytecode cache with atomic writes."""
+    def __init__(self, directory, pattern='__diecutter_%s.cache'):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        super(BytecodeCache, self).__init__(directory, pattern)
+
+    def dump_bytecode(self, bucket):
+        """Write bucket's bytecode to cache file, atomically."""
+        path = self._get_cache_filename(bucket)
+        handle, temp_path = tempfile.mkstemp(prefix='.tmp-',
+                                             dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                bucket.write_bytecode(temp_file)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Command line interface: ``diecutter <command>``.
+
+Modules are imported by commands that use them, so that ``diecutter --help``
+starts fast.
+
+"""
+import argparse
+import sys
+
+
+def get_service(config_uri):
+    """Return service configured from Paste ``config_uri``, as in WSGI app.
+    """
+    from pyramid.paster import get_appsettings
+    from pyramid.path import DottedNameResolver
+    import diecutter.settings
+    settings = get_appsettings(config_uri, 'main')
+    configuration = diecutter.settings.configure(settings)
+    service_factory = DottedNameResolver().resolve(
+        configuration.settings['diecutter.service'])
+    service = service_factory()
+    service.configure(configuration)
+    return service
+
+
+def warmup_command(options):
+    """Compile templates, report errors. Return exit code."""
+    from pyramid.paster import setup_logging
+    from diecutter.warmup import access_log_paths, warmup
+    setup_logging(options.config_uri)
+    service = get_service(options.config_uri)
+    paths = None
+    if options.access_log:
+        with open(options.access_log) as log_file:
+            paths = access_log_paths(log_file, options.top)
+    report = warmup(service, paths)
+    for path, message in report['errors']:
+        sys.stderr.write('{path}: {message}\n'.format(path=path,
+                                                      message=message))
+    sys.stdout.write('Compiled {templates} templates in {duration:.3f}s, '
+                     '{errors} errors.\n'.format(
+                         templates=report['templates'],
+                         duration=report['duration'],
+                         errors=len(report['errors'])))
+    return 1 if report['errors'] else 0
+
+
+def render_command(options):
+    """Render template against JSON lines contexts. Return exit code."""
+    import multiprocessing
+    from pyramid.httpexceptions import HTTPException
+    from diecutter.bulk import BulkRenderer, Progress, format_report, \
+        read_contexts, run
+    from diecutter.exceptions import DataParsingError
+    from diecutter.local import LocalService
+    import diecutter.settings
+    settings = {}
+    if options.config:
+        from pyramid.paster import get_appsettings, setup_logging
+        setup_logging(options.config)
+        settings.update(get_appsettings(options.config, 'main'))
+    if options.template_dir:
+        settings['diecutter.template_dir'] = options.template_dir
+    service = LocalService()
+    service.configure(diecutter.settings.configure(settings))
+    renderer = BulkRenderer(service, options.template_path,
+                            options.output_dir, options.engine,
+                            options.archive)
+    processes = options.processes or multiprocessing.cpu_count()
+    progress = None if options.quiet else Progress(sys.stderr)
+    contexts_file = sys.stdin if options.contexts == '-' \
+        else open(options.contexts)
+    try:
+        report = run(renderer, read_contexts(contexts_file),
+                     processes=processes, force=options.force,
+                     progress=progress)
+    except (DataParsingError, ValueError, HTTPException) as e:
+        sys.stderr.write('{error}\n'.format(error=e))
+        return 2
+    finally:
+        if contexts_file is not sys.stdin:
+            contexts_file.close()
+    for name, message in report['errors']:
+        sys.stderr.write('{name}: {message}\n'.format(name=name,
+                                                      message=message))
+    sys.stdout.write(format_report(report) + '\n')
+    if report['interrupted']:
+        sys.stderr.write('Interrupted. Run same command again to resume.\n')
+        return 130
+    return 1 if report['errors'] else 0
+
+
+def parser_factory():
+    """Return :py:class:`argparse.ArgumentParser` of ``diecutter`` command.
+    """
+    parser = argparse.ArgumentParser(
+        prog='diecutter', description='Templates as a service.')
+    subparsers = parser.add_subparsers(title='commands')
+    warmup = subparsers.add_parser(
+        'warmup', help='Precompile templates, report failures.',
+        description='Compile templates of diecutter.template_dir with '
+                    'configured engines. Fills the bytecode cache (see '
+                    'diecutter.bytecode_cache_dir).')
+    warmup.add_argument('config_uri',
+                        help='Paste configuration file, e.g. diecutter.ini.')
+    warmup.add_argument('--access-log', default='',
+                        help='Only compile the most requested paths in this '
+                             'access log.')
+    warmup.add_argument('--top', type=int, default=100,
+                        help='Number of paths read from access log.')
+    warmup.set_defaults(command=warmup_command)
+    render = subparsers.add_parser(
+        'render', help='Render a template against many contexts, to disk.',
+        description='Render a template (file or directory) against each '
+                    'context of a JSON lines input, with the same engines '
+                    'and writers as the server. Outputs are named as in '
+                    'batch archives. Existing outputs are skipped, so that '
+                    'interrupted runs can be resumed.')
+    render.add_argument('template_path',
+                        help='Path of template, relative to template '
+                             'directory. Trailing "/" for directories works '
+                             'as in URLs.')
+    render.add_argument('-c', '--contexts', default='-',
+                        help='JSON lines file, one context per line. '
+                             'Default is "-", i.e. standard input.')
+    render.add_argument('-o', '--output-dir', required=True,
+                        help='Directory where outputs are written.')
+    render.add_argument('--template-dir', default='',
+                        help='Template directory. Overrides '
+                             'diecutter.template_dir setting.')
+    render.add_argument('--config', default='',
+                        help='Paste configuration file to read settings '
+                             'from, e.g. diecutter.ini. Default settings '
+                             'are used otherwise.')
+    render.add_argument('--engine', default='',
+                        help='Template engine. Default is diecutter.engine '
+                             'setting.')
+    render.add_argument('--archive', default='', choices=['zip', 'tar.gz'],
+                        help='Write directory templates as archives of '
+                             'this type, instead of directories.')
+    render.add_argument('-j', '--processes', type=int, default=0,
+                        help='Number of worker processes. Default is '
+                             'number of CPUs.')
+    render.add_argument('--force', action='store_true',
+                        help='Render again items whose output exists.')
+    render.add_argument('-q', '--quiet', action='store_true',
+                        help='Do not report progress.')
+    render.set_defaults(command=render_command)
+    return parser
+
+
+def main(args=None):
+    """Run ``diecutter`` command, return exit code."""
+    options = parser_factory().parse_args(args)
+    return options.command(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 """Utilities to extract context dictionary from request."""
+import json
+
 from diecutter import exceptions
 
 
@@ -20,8 +22,44 @@ def extract_post_context(request):
 
 
 def extract_json_context(request):
-    """Extract and return context from a application/json request."""
-    return request.json_body.copy()
+    """Extract and return context from a application/json request.
+
+    If body is a JSON array, return a list of contexts, i.e. a batch.
+
+    """
+    data = request.json_body
+    if isinstance(data, list):
+        return validate_batch(data)
+    return data.copy()
+
+
+def extract_json_lines_context(request):
+    """Extract and return list of contexts from a JSON-lines request.
+
+    Each non-empty line of body is a JSON object, i.e. a context.
+
+    """
+    contexts = []
+    for line in request.body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            contexts.append(json.loads(line))
+        except ValueError:
+            raise exceptions.DataParsingError('Failed to parse JSON line.')
+    return validate_batch(contexts)
+
+
+def validate_batch(contexts):
+    """Return copy of list of ``contexts``, checking items are dictionaries.
+
+    Raise :py:class:`~diecutter.exceptions.DataParsingError` otherwise.
+
+    """
+    if not all(isinstance(context, dict) for context in contexts):
+        raise exceptions.DataParsingError(
+            'Batch items must be objects (dictionaries).')
+    return [context.copy() for context in contexts]
 
 
 def extract_ini_context(request):
@@ -50,6 +88,8 @@ CONTEXT_EXTRACTORS = {
     '': extract_post_context,  # Default fallback.
     'application/x-www-form-urlencoded': extract_post_context,
     'application/json': extract_json_context,
+    'application/x-ndjson': extract_json_lines_context,
+    'application/jsonlines': extract_json_lines_context,
     'text/plain': extract_ini_context,
 }
 """Default context extractors configuration.
@@ -61,7 +101,8 @@ This is a dictionary where:
 
 * keys are (lowercase) content-types.
 * values are callables which accept one ``request`` argument and return a
-  dictionary (or dictionary-like object).
+  dictionary (or dictionary-like object). Extractors may also return a list
+  of dictionaries, i.e. a batch of contexts.
 
 """
 
@@ -80,6 +121,8 @@ def get_context_extractors(request):
 def extract_context(request):
     """Extract context dictionary from request and return it.
 
+    Return a list of dictionaries for batch requests.
+
     Raise :py:class:`NotImplementedError` if request input (content-type) is
     not supported.
 
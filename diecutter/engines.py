@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Long-lived template engines with compiled-template cache.
+
+`piecutter` engines compile the template source on every call to
+``render()``. :py:class:`CachedEngine` wraps such an engine and keeps compiled
+templates in a shared :py:class:`~diecutter.utils.cache.LRUCache`, indexed by
+engine slug and hash of template source.
+
+"""
+import hashlib
+import logging
+
+from piecutter.engines import Engine
+from piecutter.exceptions import TemplateError
+
+
+logger = logging.getLogger(__name__)
+
+
+def compile_jinja2(engine, template):
+    """Compile ``template`` with Jinja2 ``engine``, return render callable.
+
+    If Jinja2 environment has a bytecode cache (see
+    :py:func:`set_bytecode_cache`), bytecode is read from and written to it.
+
+    """
+    from jinja2.exceptions import UndefinedError, TemplateSyntaxError
+    environment = engine.environment
+    try:
+        if environment.bytecode_cache is None:
+            compiled = environment.from_string(template)
+        else:
+            compiled = environment.template_class.from_code(
+                environment, compile_jinja2_code(environment, template),
+                environment.make_globals(None))
+    except TemplateSyntaxError as e:
+        raise TemplateError(e)
+
+    def render(context):
+        try:
+            return compiled.render(**context)
+        except (UndefinedError, TypeError) as e:
+            raise TemplateError(e)
+
+    def generate(context):
+        try:
+            for chunk in compiled.generate(**context):
+                yield chunk
+        except (UndefinedError, TypeError) as e:
+            raise TemplateError(e)
+    render.generate = generate
+    return render
+
+
+def compile_jinja2_code(environment, template):
+    """Return code object of ``template``, using environment's bytecode cache.
+
+    Templates are identified by hash of their source, since they are not
+    loaded from Jinja2 loaders.
+
+    """
+    cache = environment.bytecode_cache
+    bucket = cache.get_bucket(environment, template_hash(template), None,
+                              template)
+    if bucket.code is None:
+        bucket.code = environment.compile(template)
+        try:
+            cache.set_bucket(bucket)
+        except (IOError, OSError) as e:  # Cache is an optimization.
+            logger.warning('Failed to write bytecode cache: {error}'
+                           .format(error=e))
+    return bucket.code
+
+
+def set_bytecode_cache(engine, directory):
+    """Make Jinja2 ``engine`` cache bytecode in ``directory``.
+
+    Return ``True`` if ``engine`` supports it, i.e. has a Jinja2
+    environment, else ``False``.
+
+    """
+    if get_compiler(engine) is not compile_jinja2:
+        return False
+    from diecutter.bytecodecache import BytecodeCache
+    engine.environment.bytecode_cache = BytecodeCache(directory)
+    return True
+
+
+def compile_django(engine, template):
+    """Compile ``template`` with Django ``engine``, return render callable."""
+    from django.template import Template, Context, TemplateSyntaxError
+    try:
+        compiled = Template(template)
+    except TemplateSyntaxError as e:
+        raise TemplateError(e)
+
+    def render(context):
+        try:
+            return compiled.render(Context(context))
+        except TemplateSyntaxError as e:
+            raise TemplateError(e)
+    return render
+
+
+COMPILERS = {
+    'piecutter.engines.jinja:Jinja2Engine': compile_jinja2,
+    'piecutter.engines.django:DjangoEngine': compile_django,
+}
+"""Compilers for known engine classes.
+
+This is a dictionary where:
+
+* keys are Python paths of engine classes, as in ``diecutter.engine.*``
+  settings. Subclasses of those classes use the same compiler.
+
+* values are callables which accept ``engine`` and ``template`` arguments
+  and return a callable which accepts ``context`` and returns rendered
+  template. If that callable has a ``generate`` attribute, it is a callable
+  which accepts ``context`` and generates rendered template in chunks.
+
+Engines that are not registered here are not cached.
+
+"""
+
+
+def get_compiler(engine):
+    """Return compiler registered for ``engine``'s class, or ``None``."""
+    for klass in type(engine).__mro__:
+        path = '{module}:{name}'.format(module=klass.__module__,
+                                        name=klass.__name__)
+        try:
+            return COMPILERS[path]
+        except KeyError:
+            pass
+    return None
+
+
+def template_hash(template):
+    """Return hexadecimal digest of ``template`` source."""
+    if isinstance(template, unicode):
+        template = template.encode('utf-8')
+    return hashlib.sha1(template).hexdigest()
+
+
+class CachedEngine(Engine):
+    """Engine proxy that caches compiled templates."""
+    def __init__(self, engine, cache, slug=''):
+        #: Wrapped engine instance.
+        self.engine = engine
+        #: :py:class:`~diecutter.utils.cache.LRUCache` instance.
+        self.cache = cache
+        #: Engine slug, part of cache keys.
+        self.slug = slug
+        #: Compiler for wrapped engine, or ``None`` if unsupported.
+        self.compiler = get_compiler(engine)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def compile(self, template):
+        """Return render callable for ``template``, from cache if possible."""
+        key = (self.slug, template_hash(template))
+        return self.cache.get_or_set(
+            key, lambda: self.compiler(self.engine, template))
+
+    def render(self, template, context):
+        """Return the rendered template against context."""
+        if self.compiler is None:
+            return self.engine.render(template, context)
+        return self.compile(template)(context)
+
+    def generate(self, template, context):
+        """Return iterator over chunks of template rendered against context.
+
+        With Jinja2, output is generated as the template is evaluated. Other
+        engines render the whole template as one chunk.
+
+        """
+        if self.compiler is None:
+            return iter([self.engine.render(template, context)])
+        compiled = self.compile(template)
+        generate = getattr(compiled, 'generate', None)
+        if generate is None:
+            return iter([compiled(context)])
+        return generate(context)
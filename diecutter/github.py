@@ -1,26 +1,443 @@
 # -*- coding: utf-8 -*-
 """Manage templates located on Github."""
+import errno
+import fcntl
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
 from piecutter.loaders.github import GithubLoader
+import requests
 
 from piecutter.utils import temporary_directory
 from diecutter.local import LocalService
+from diecutter.service import Service
+from diecutter.settings import to_integer
+from diecutter.stats import get_timings
+from diecutter.utils import call_after
+from diecutter.utils.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Full commit identifiers, i.e. references whose content never changes.
+SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+#: Names of Github users and projects.
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+#: Name of the file holding size of a checkout, in checkout directory.
+SIZE_FILENAME = '.diecutter-size'
+
+#: Name of the file locked by users of a checkout, in checkout directory.
+LOCK_FILENAME = '.diecutter-lock'
+
+
+def is_safe_name(name):
+    """Return True if ``name`` is a valid user or project name, i.e. can be
+    used as a directory name.
+
+    >>> from diecutter.github import is_safe_name
+    >>> is_safe_name('diecutter'), is_safe_name('..'), is_safe_name('a/b')
+    (True, False, False)
+
+    """
+    return NAME_PATTERN.match(name) is not None and name not in ('.', '..')
+
+
+def is_sha(commit):
+    """Return True if ``commit`` is a full commit identifier.
+
+    >>> from diecutter.github import is_sha
+    >>> is_sha('8c1f2e6b0b7d6e7f0b1c7e5a9d3c2b1a0f9e8d7c')
+    True
+    >>> is_sha('master')
+    False
+
+    """
+    return SHA_PATTERN.match(commit) is not None
+
+
+def directory_size(path):
+    """Return total size of files in ``path``, recursively."""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            try:
+                size += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class CheckoutCache(object):
+    """On-disk cache of Github checkouts, indexed by user, project, commit.
+
+    Only full commit identifiers are cached, since their content never
+    changes. Checkouts are downloaded in a temporary directory, then
+    atomically renamed, so several processes can share the same cache
+    directory. Least recently used checkouts are removed when total size
+    exceeds ``max_bytes`` (``0`` means no limit).
+
+    Users of a checkout hold a shared lock on its :py:data:`LOCK_FILENAME`
+    file, which they close when done. Checkouts in use are not removed.
+
+    """
+    def __init__(self, directory, max_bytes=0, loader_factory=GithubLoader):
+        #: Root directory of the cache.
+        self.directory = directory
+        #: Maximum total size of checkouts, in bytes.
+        self.max_bytes = max_bytes
+        #: Factory of loaders, used to download checkouts.
+        self.loader_factory = loader_factory
+
+    def path(self, user, project, commit):
+        """Return path to checkout in cache (it may not exist).
+
+        Raise ValueError if ``user`` or ``project`` are not valid names, or
+        if ``commit`` is not a full commit identifier.
+
+        """
+        if not (is_safe_name(user) and is_safe_name(project)
+                and is_sha(commit)):
+            raise ValueError('Invalid checkout: {user}/{project}/{commit}'
+                             .format(user=user, project=project,
+                                     commit=commit))
+        return os.path.join(self.directory, user, project, commit)
+
+    def lock(self, path, exclusive=False):
+        """Return lock file of checkout at ``path``, locked, or ``None``.
+
+        Shared locks wait for exclusive ones. Exclusive locks do not wait:
+        ``None`` is returned if checkout is in use. ``None`` is also returned
+        if checkout has been removed.
+
+        """
+        lock_path = os.path.join(path, LOCK_FILENAME)
+        try:
+            lock_file = open(lock_path, 'a')
+        except IOError:  # Removed.
+            return None
+        operation = fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive \
+            else fcntl.LOCK_SH
+        try:
+            fcntl.flock(lock_file.fileno(), operation)
+            # Checkout may have been removed while waiting for the lock.
+            if os.fstat(lock_file.fileno()).st_ino == \
+                    os.stat(lock_path).st_ino:
+                return lock_file
+        except (IOError, OSError):  # In use, or removed in the meantime.
+            pass
+        lock_file.close()
+        return None
+
+    def hold(self, path, locks):
+        """Append shared lock of checkout at ``path`` to ``locks`` list.
+
+        Return ``path``, or ``None`` if checkout has been removed. If
+        ``locks`` is ``None``, checkout is not locked.
+
+        """
+        if locks is None:
+            return path
+        lock_file = self.lock(path)
+        if lock_file is None:
+            return None
+        locks.append(lock_file)
+        return path
+
+    def get(self, user, project, commit, locks=None):
+        """Return path to checkout, or ``None`` if not in cache.
+
+        See :py:meth:`hold` about ``locks``.
+
+        """
+        path = self.path(user, project, commit)
+        if not os.path.isdir(path):
+            return None
+        try:
+            os.utime(path, None)  # Mark as recently used.
+        except OSError:  # Removed in the meantime.
+            return None
+        return self.hold(path, locks)
+
+    def fetch(self, user, project, commit, locks=None):
+        """Download checkout in cache, return its path.
+
+        See :py:meth:`hold` about ``locks``.
+
+        """
+        path = self.path(user, project, commit)
+        parent = os.path.dirname(path)
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        temp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        try:
+            loader = self.loader_factory(temp_dir)
+            loader.github_targz(user, project, commit)
+            with open(os.path.join(temp_dir, SIZE_FILENAME), 'w') as size_file:
+                size_file.write(str(directory_size(temp_dir)))
+            try:
+                os.rename(temp_dir, path)
+            except OSError:
+                if not os.path.isdir(path):  # Not a concurrent download.
+                    raise
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        self.hold(path, locks)
+        self.evict(keep=path)
+        return path
+
+    def checkout(self, user, project, commit, locks=None):
+        """Return path to checkout, downloading it if necessary.
+
+        See :py:meth:`hold` about ``locks``.
+
+        """
+        path = self.get(user, project, commit, locks)
+        if path is None:
+            path = self.fetch(user, project, commit, locks)
+        return path
+
+    def entries(self):
+        """Return list of ``(last_used, size, path)`` for checkouts."""
+        entries = []
+        for user in os.listdir(self.directory):
+            user_dir = os.path.join(self.directory, user)
+            if user.startswith('.') or not os.path.isdir(user_dir):
+                continue
+            for project in os.listdir(user_dir):
+                project_dir = os.path.join(user_dir, project)
+                if not os.path.isdir(project_dir):
+                    continue
+                for commit in os.listdir(project_dir):
+                    if not is_sha(commit):
+                        continue
+                    path = os.path.join(project_dir, commit)
+                    try:
+                        last_used = os.stat(path).st_mtime
+                        with open(os.path.join(path, SIZE_FILENAME)) as f:
+                            size = int(f.read())
+                    except (IOError, OSError, ValueError):
+                        continue
+                    entries.append((last_used, size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """Remove least recently used checkouts until size fits in budget.
+
+        Checkout at ``keep`` path and checkouts in use are never removed.
+
+        """
+        if not self.max_bytes:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for (last_used, size, path) in entries)
+        for last_used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            lock_file = self.lock(path, exclusive=True)
+            if lock_file is None:  # In use, or already removed.
+                continue
+            # Rename first, so that other processes do not see partial
+            # checkouts.
+            trash = tempfile.mkdtemp(prefix='.trash-', dir=self.directory)
+            try:
+                os.rename(path, os.path.join(trash, 'checkout'))
+            except OSError:  # Already removed by another process.
+                pass
+            else:
+                total -= size
+                logger.debug('Removed checkout {path} from cache'
+                             .format(path=path))
+            lock_file.close()
+            shutil.rmtree(trash, ignore_errors=True)
+
+
+class CachedGithubLoader(GithubLoader):
+    """Github loader that uses a :py:class:`CheckoutCache` for commits."""
+    def __init__(self, checkout_dir, cache, locks=None):
+        super(CachedGithubLoader, self).__init__(checkout_dir)
+        #: :py:class:`CheckoutCache` instance.
+        self.cache = cache
+        #: List of locks on cached checkouts, released by caller.
+        self.locks = locks
+
+    def github_targz(self, user, project, commit):
+        """Return path to local extract, from cache if possible."""
+        if is_sha(commit):
+            return self.cache.checkout(user, project, commit,
+                                       locks=self.locks)
+        parent = super(CachedGithubLoader, self)
+        return parent.github_targz(user, project, commit)
+
+
+class RefResolver(object):
+    """Resolve branches and tags to commit identifiers, with a TTL cache.
+
+    Resolutions are kept ``ttl`` seconds: during that time, a reference
+    resolves to the same commit, even if it moved on Github.
+
+    """
+    def __init__(self, api_url='https://api.github.com', ttl=60,
+                 max_size=1024, timeout=10, clock=time.time):
+        #: Root URL of Github API.
+        self.api_url = api_url.rstrip('/')
+        #: Time to live of resolutions, in seconds.
+        self.ttl = ttl
+        #: Timeout of requests to Github API, in seconds.
+        self.timeout = timeout
+        #: Callable that returns current time.
+        self.clock = clock
+        #: :py:class:`~diecutter.utils.cache.LRUCache` of ``(sha, expires)``.
+        self.cache = LRUCache(max_size=max_size)
+
+    def commit_url(self, user, project, ref):
+        """Return URL of Github API to get commit of ``ref``.
+
+        >>> from diecutter.github import RefResolver
+        >>> RefResolver().commit_url('user', 'project', 'master')
+        'https://api.github.com/repos/user/project/commits/master'
+
+        """
+        return '{api}/repos/{user}/{project}/commits/{ref}'.format(
+            api=self.api_url, user=user, project=project, ref=ref)
+
+    def fetch(self, user, project, ref):
+        """Return commit identifier of ``ref`` from Github API, or ``None``.
+        """
+        url = self.commit_url(user, project, ref)
+        try:
+            response = requests.get(
+                url, timeout=self.timeout,
+                headers={'Accept': 'application/vnd.github.VERSION.sha'})
+        except requests.exceptions.RequestException as e:
+            logger.warning('Failed to resolve {url}: {error}'
+                           .format(url=url, error=e))
+            return None
+        sha = response.text.strip()
+        if response.status_code != 200 or not is_sha(sha):
+            logger.warning('Failed to resolve {url}: HTTP {status}'
+                           .format(url=url, status=response.status_code))
+            return None
+        return str(sha)
+
+    def resolve(self, user, project, ref):
+        """Return commit identifier for ``ref``.
+
+        Return ``ref`` itself if it is already a commit identifier, or if
+        resolution failed.
+
+        """
+        if is_sha(ref):
+            return ref
+        key = (user, project, ref)
+        now = self.clock()
+        cached = self.cache.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        sha = self.fetch(user, project, ref)
+        if sha is None:
+            return ref
+        self.cache.set(key, (sha, now + self.ttl))
+        return sha
 
 
 class GithubService(LocalService):
     """A diecutter service that uses Github as template storage."""
+    def __init__(self, configuration=None):
+        super(GithubService, self).__init__(configuration)
+        #: :py:class:`CheckoutCache` instance, or ``None``.
+        self.checkout_cache = None
+        #: :py:class:`RefResolver` instance, or ``None``.
+        self.ref_resolver = None
+
+    def configure(self, configuration):
+        """Setup service, including checkout cache.
+
+        "diecutter.template_dir" setting is not used.
+
+        """
+        Service.configure(self, configuration)
+        settings = configuration.settings
+        cache_dir = settings.get('diecutter.github.cache_dir')
+        if cache_dir:
+            max_bytes = to_integer(settings, 'diecutter.github.cache_size')
+            self.checkout_cache = CheckoutCache(cache_dir, max_bytes)
+            self.ref_resolver = RefResolver(
+                api_url=settings['diecutter.github.api_url'],
+                ttl=to_integer(settings, 'diecutter.github.ref_ttl'))
+
+    def cache_info(self, request):
+        """Return statistics about caches, including Github references."""
+        info = super(GithubService, self).cache_info(request)
+        if self.ref_resolver is not None:
+            info['github_ref'] = self.ref_resolver.cache.info()
+        return info
+
     def get(self, request):
         with temporary_directory() as checkout_dir:
-            self.checkout_dir = checkout_dir
-            return super(GithubService, self).get(request)
+            self.set_checkout_dir(request, checkout_dir)
+            try:
+                return super(GithubService, self).get(request)
+            finally:
+                self.release_checkouts(request)
 
     def post(self, request):
-        with temporary_directory() as checkout_dir:
-            self.checkout_dir = checkout_dir
-            return super(GithubService, self).post(request)
+        parent = super(GithubService, self)
+        return self.stream_with_checkout(request, parent.post)
+
+    def manifest(self, request):
+        parent = super(GithubService, self)
+        return self.stream_with_checkout(request, parent.manifest)
+
+    def stream_with_checkout(self, request, view):
+        """Return ``view(request)``, with a temporary checkout directory.
+
+        Rendering may go on while response is streamed: temporary checkout
+        is removed, and cached checkouts are released, once response has been
+        sent, or closed by WSGI server (HEAD requests, client disconnects...).
+
+        """
+        checkout = temporary_directory()
+        self.set_checkout_dir(request, checkout.__enter__())
+
+        def cleanup(size=None):
+            checkout.__exit__()
+            self.release_checkouts(request)
+        try:
+            response = view(request)
+        except Exception:
+            cleanup()
+            raise
+        return call_after(response, cleanup)
 
     def put(self, request):
         raise NotImplementedError()
 
+    def set_checkout_dir(self, request, checkout_dir):
+        """Remember temporary checkout directory for request."""
+        if not hasattr(request, 'cache'):
+            request.cache = {}
+        request.cache['diecutter_checkout_dir'] = checkout_dir
+        request.cache['diecutter_checkout_locks'] = []
+
+    def release_checkouts(self, request):
+        """Release locks on cached checkouts used by request."""
+        for lock_file in request.cache.pop('diecutter_checkout_locks', []):
+            lock_file.close()
+
     def split_path(self, path):
         """Return parts of path of the form /{user}/{project}/{commit}/{path}.
 
@@ -35,29 +452,52 @@ class GithubService(LocalService):
         return path.lstrip('/').split('/', 3)
 
     def get_resource_loader(self, request):
-        """Return :py:class:`GithubLoader` instance."""
-        return GithubLoader(self.checkout_dir)
+        """Return :py:class:`GithubLoader` instance.
+
+        If ``diecutter.github.cache_dir`` is set, return a
+        :py:class:`CachedGithubLoader`.
+
+        """
+        checkout_dir = request.cache['diecutter_checkout_dir']
+        if self.checkout_cache is None:
+            return GithubLoader(checkout_dir)
+        return CachedGithubLoader(checkout_dir, self.checkout_cache,
+                                  request.cache['diecutter_checkout_locks'])
 
-    def get_resource(self, request):
+    def get_resource(self, request, template_path=None):
         """Return the resource matching request.
 
         Return value is a :py:class:`GithubFileResource` or
         :py:class`GithubDirResource`.
 
+        ``template_path`` defaults to path in request's URL.
+
         """
-        path = self.get_resource_path(request)
+        path = self.get_resource_path(request, template_path)
         try:
             user, project, commit, relative_path = self.split_path(path)
         except:
             # favicon.ico request.
             return
-        engine = self.get_engine(request)
-        filename_engine = self.get_filename_engine(request)
-        resource_loader = self.get_resource_loader(request)
-        resource = resource_loader.get_resource(
-            engine, filename_engine, user, project, commit, relative_path)
+        if not (is_safe_name(user) and is_safe_name(project)):
+            return
+        with get_timings(request).timer('resource'):
+            if self.ref_resolver is not None:
+                commit = self.ref_resolver.resolve(user, project, commit)
+            engine = self.get_engine(request)
+            filename_engine = self.get_filename_engine(request)
+            resource_loader = self.get_resource_loader(request)
+            resource = resource_loader.get_resource(
+                engine, filename_engine, user, project, commit,
+                relative_path)
         return resource
 
-    def get_resource_path(self, request):
-        """Return validated (absolute) resource path from request."""
-        return request.matchdict['template_path']
+    def get_resource_path(self, request, template_path=None):
+        """Return validated (absolute) resource path from request.
+
+        ``template_path`` defaults to path in request's URL.
+
+        """
+        if template_path is None:
+            return request.matchdict['template_path']
+        return template_path
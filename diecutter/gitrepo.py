@@ -0,0 +1,716 @@
+# -*- coding: utf-8 -*-
+"""Serve templates from local bare git repositories.
+
+Objects are read straight from the object database: loose objects and
+packfiles (version 2 indexes, with deltas). There is no checkout: trees and
+blobs are looked up on demand, and kept in a cache shared by repositories,
+since objects are identified by their content.
+
+URLs are of the form ``/{repository}/{ref}/{path}``, where ``ref`` is a
+branch, a tag or a full commit identifier.
+
+"""
+import mmap
+import os
+import posixpath
+import re
+import struct
+import threading
+import zlib
+
+from pyramid.exceptions import ConfigurationError, Forbidden
+
+from piecutter import resources
+
+from diecutter.local import LocalService
+from diecutter.service import Service
+from diecutter.settings import to_integer
+from diecutter.stats import get_timings
+from diecutter.utils.cache import LRUCache
+
+
+#: Types of packed objects, indexed by type number.
+OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+#: Packed object types for deltas against an offset or an identifier.
+OFS_DELTA = 6
+REF_DELTA = 7
+
+#: Size of compressed data read at once from packfiles, in bytes.
+INFLATE_CHUNK_SIZE = 16 * 1024
+
+#: Modes of tree entries that are directories and submodules.
+DIR_MODE = '40000'
+SUBMODULE_MODE = '160000'
+
+#: Full object identifiers.
+SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+#: Maximum depth of symbolic references, such as HEAD.
+MAX_SYMREF_DEPTH = 5
+
+
+def read_varint(data, pos):
+    """Return ``(value, pos)`` of little-endian base-128 integer at ``pos``.
+
+    >>> from diecutter.gitrepo import read_varint
+    >>> read_varint('\\x91\\x2e', 0)
+    (5905, 2)
+
+    """
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def apply_delta(base, delta):
+    """Return object built from ``base`` and git ``delta`` instructions.
+
+    >>> from diecutter.gitrepo import apply_delta
+    >>> apply_delta('Hello world', '\\x0b\\x0c\\x90\\x06\\x06Hello!')
+    'Hello Hello!'
+
+    """
+    base_size, pos = read_varint(delta, 0)
+    result_size, pos = read_varint(delta, pos)
+    if base_size != len(base):
+        raise ValueError('Delta does not match base size.')
+    chunks = []
+    while pos < len(delta):
+        opcode = ord(delta[pos])
+        pos += 1
+        if opcode & 0x80:  # Copy from base.
+            offset = size = 0
+            for index in range(4):
+                if opcode & (1 << index):
+                    offset |= ord(delta[pos]) << (8 * index)
+                    pos += 1
+            for index in range(3):
+                if opcode & (0x10 << index):
+                    size |= ord(delta[pos]) << (8 * index)
+                    pos += 1
+            chunks.append(base[offset:offset + (size or 0x10000)])
+        elif opcode:  # Insert data.
+            chunks.append(delta[pos:pos + opcode])
+            pos += opcode
+        else:
+            raise ValueError('Invalid delta opcode.')
+    result = ''.join(chunks)
+    if len(result) != result_size:
+        raise ValueError('Delta result has wrong size.')
+    return result
+
+
+def parse_tree(data):
+    """Return list of ``(mode, name, sha)`` entries of tree object ``data``.
+
+    >>> from diecutter.gitrepo import parse_tree
+    >>> parse_tree('100644 a.txt\\x00' + '\\x01' * 20)
+    [('100644', 'a.txt', '0101010101010101010101010101010101010101')]
+
+    """
+    entries = []
+    pos = 0
+    while pos < len(data):
+        space = data.index(' ', pos)
+        nul = data.index('\0', space)
+        sha = data[nul + 1:nul + 21].encode('hex')
+        entries.append((data[pos:space], data[space + 1:nul], sha))
+        pos = nul + 21
+    return entries
+
+
+def parse_headers(data):
+    """Return dictionary of headers of commit or tag object ``data``.
+
+    Only the first value of each header is kept.
+
+    >>> from diecutter.gitrepo import parse_headers
+    >>> sorted(parse_headers('tree abc\\nparent def\\n\\nMessage').items())
+    [('parent', 'def'), ('tree', 'abc')]
+
+    """
+    headers = {}
+    for line in data.split('\n\n', 1)[0].splitlines():
+        if line.startswith(' '):  # Continuation, such as signatures.
+            continue
+        name, _, value = line.partition(' ')
+        headers.setdefault(name, value)
+    return headers
+
+
+class PackIndex(object):
+    """Version 2 index of a packfile, memory-mapped."""
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.data = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if self.data[:8] != '\xfftOc\x00\x00\x00\x02':
+            raise ValueError('Unsupported pack index: {path}'.format(
+                path=path))
+        self.fanout = struct.unpack('>256I', self.data[8:1032])
+        #: Number of objects.
+        self.count = self.fanout[255]
+        self._crc_start = 1032 + 20 * self.count
+        self._offset_start = self._crc_start + 4 * self.count
+        self._large_offset_start = self._offset_start + 4 * self.count
+
+    def sha(self, index):
+        """Return binary identifier of object at ``index``."""
+        start = 1032 + 20 * index
+        return self.data[start:start + 20]
+
+    def offset(self, sha):
+        """Return offset in packfile of object ``sha`` (binary), or ``None``.
+        """
+        first = ord(sha[0])
+        low = self.fanout[first - 1] if first else 0
+        high = self.fanout[first]
+        while low < high:
+            middle = (low + high) // 2
+            current = self.sha(middle)
+            if current < sha:
+                low = middle + 1
+            elif current > sha:
+                high = middle
+            else:
+                start = self._offset_start + 4 * middle
+                offset, = struct.unpack('>I', self.data[start:start + 4])
+                if offset & 0x80000000:
+                    start = self._large_offset_start + \
+                        8 * (offset & 0x7fffffff)
+                    offset, = struct.unpack('>Q', self.data[start:start + 8])
+                return offset
+        return None
+
+    def close(self):
+        self.data.close()
+
+
+class Pack(object):
+    """Packfile and its index, memory-mapped.
+
+    Memory maps are read with slices, without seeking, so that several
+    threads can read objects at the same time.
+
+    """
+    def __init__(self, path):
+        #: Path of packfile, with ``.pack`` extension.
+        self.path = path
+        #: :py:class:`PackIndex` instance.
+        self.index = PackIndex(path[:-len('.pack')] + '.idx')
+        with open(path, 'rb') as pack_file:
+            self.data = mmap.mmap(pack_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if self.data[:4] != 'PACK':
+            raise ValueError('Invalid packfile: {path}'.format(path=path))
+
+    def inflate(self, pos, size):
+        """Return ``size`` bytes decompressed from data at ``pos``."""
+        decompressor = zlib.decompressobj()
+        chunks = []
+        length = 0
+        while length < size:
+            compressed = self.data[pos:pos + INFLATE_CHUNK_SIZE]
+            if not compressed:
+                raise ValueError('Truncated packfile: {path}'.format(
+                    path=self.path))
+            pos += len(compressed)
+            chunk = decompressor.decompress(compressed, size - length)
+            chunks.append(chunk)
+            length += len(chunk)
+        return ''.join(chunks)
+
+    def read(self, offset, store):
+        """Return ``(type, data)`` of object at ``offset``.
+
+        Deltas are resolved, bases are read from ``store``
+        (:py:class:`ObjectStore`), so that they are cached.
+
+        """
+        pos = offset
+        byte = ord(self.data[pos])
+        object_type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            pos += 1
+            byte = ord(self.data[pos])
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        pos += 1
+        if object_type == OFS_DELTA:
+            byte = ord(self.data[pos])
+            pos += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = ord(self.data[pos])
+                pos += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base_type, base = store.read_packed(self, offset - distance)
+        elif object_type == REF_DELTA:
+            base_sha = self.data[pos:pos + 20].encode('hex')
+            pos += 20
+            base_type, base = store.read(base_sha)
+        else:
+            return OBJECT_TYPES[object_type], self.inflate(pos, size)
+        return base_type, apply_delta(base, self.inflate(pos, size))
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class ObjectStore(object):
+    """Read objects of a git repository, from loose objects and packfiles.
+
+    Objects are kept in ``cache``, a :py:class:`LRUCache` which may be shared
+    by several stores.
+
+    """
+    def __init__(self, objects_dir, cache=None):
+        #: Path of ``objects`` directory.
+        self.objects_dir = objects_dir
+        #: :py:class:`~diecutter.utils.cache.LRUCache` of ``(type, data)``,
+        #: indexed by object identifier. Delta bases are also indexed by
+        #: ``(pack path, offset)``.
+        self.cache = LRUCache(max_size=0) if cache is None else cache
+        #: List of :py:class:`Pack`.
+        self.packs = []
+        self._packs_version = None
+        self._lock = threading.Lock()
+        self.refresh_packs()
+
+    def refresh_packs(self):
+        """Open new packfiles, forget removed ones. Return True if changed.
+        """
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        try:
+            names = sorted(name for name in os.listdir(pack_dir)
+                           if name.endswith('.pack'))
+        except OSError:
+            names = []
+        with self._lock:
+            if names == self._packs_version:
+                return False
+            packs = dict((pack.path, pack) for pack in self.packs)
+            self.packs = []
+            for name in names:
+                path = os.path.join(pack_dir, name)
+                pack = packs.pop(path, None)
+                if pack is None:
+                    try:
+                        pack = Pack(path)
+                    except (IOError, OSError, ValueError):  # Being written.
+                        continue
+                self.packs.append(pack)
+            self._packs_version = names
+        return True
+
+    def read_loose(self, sha):
+        """Return ``(type, data)`` of loose object ``sha``, or ``None``."""
+        path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        try:
+            with open(path, 'rb') as object_file:
+                raw = zlib.decompress(object_file.read())
+        except IOError:
+            return None
+        header, _, data = raw.partition('\0')
+        return header.split(' ', 1)[0], data
+
+    def read_packed(self, pack, offset):
+        """Return ``(type, data)`` of object at ``offset`` in ``pack``."""
+        return self.cache.get_or_set((pack.path, offset),
+                                     lambda: pack.read(offset, self))
+
+    def find(self, sha):
+        """Return ``(type, data)`` of object ``sha``, or ``None``."""
+        loose = self.read_loose(sha)
+        if loose is not None:
+            return loose
+        binary = sha.decode('hex')
+        for pack in self.packs:
+            offset = pack.index.offset(binary)
+            if offset is not None:
+                return pack.read(offset, self)
+        return None
+
+    def read(self, sha):
+        """Return ``(type, data)`` of object ``sha``.
+
+        Raise KeyError if object does not exist.
+
+        """
+        cached = self.cache.get(sha)
+        if cached is not None:
+            return cached
+        found = self.find(sha)
+        if found is None and self.refresh_packs():  # Repacked meanwhile.
+            found = self.find(sha)
+        if found is None:
+            raise KeyError(sha)
+        self.cache.set(sha, found)
+        return found
+
+    def close(self):
+        with self._lock:
+            for pack in self.packs:
+                pack.close()
+            self.packs = []
+            self._packs_version = None
+
+
+class Repository(object):
+    """Bare git repository (or ``.git`` directory) at ``path``."""
+    def __init__(self, path, cache=None):
+        #: Path of git directory.
+        self.path = path
+        #: :py:class:`ObjectStore` instance.
+        self.store = ObjectStore(os.path.join(path, 'objects'), cache)
+        self._packed_refs = ({}, None)
+
+    def packed_refs(self):
+        """Return dictionary of packed references, peeled if possible."""
+        path = os.path.join(self.path, 'packed-refs')
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return {}
+        refs, version = self._packed_refs
+        if version == (stat.st_mtime, stat.st_size):
+            return refs
+        refs = {}
+        name = None
+        with open(path) as refs_file:
+            for line in refs_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('^'):  # Peeled value of previous tag.
+                    if name is not None:
+                        refs[name] = line[1:]
+                    continue
+                sha, _, name = line.partition(' ')
+                refs[name] = sha
+        self._packed_refs = (refs, (stat.st_mtime, stat.st_size))
+        return refs
+
+    def read_ref(self, name, depth=0):
+        """Return object identifier of reference ``name``, or ``None``."""
+        if depth > MAX_SYMREF_DEPTH:
+            return None
+        path = os.path.join(self.path, *name.split('/'))
+        try:
+            with open(path) as ref_file:
+                value = ref_file.read().strip()
+        except IOError:
+            return self.packed_refs().get(name)
+        if value.startswith('ref: '):
+            return self.read_ref(value[len('ref: '):], depth + 1)
+        return value if SHA_PATTERN.match(value) else None
+
+    def peel(self, sha):
+        """Return commit pointed to by ``sha``, following tags, or ``None``.
+        """
+        for depth in range(MAX_SYMREF_DEPTH):
+            try:
+                object_type, data = self.store.read(sha)
+            except KeyError:
+                return None
+            if object_type == 'commit':
+                return sha
+            if object_type != 'tag':
+                return None
+            sha = parse_headers(data).get('object')
+        return None
+
+    def resolve(self, ref):
+        """Return commit identifier of ``ref``, or ``None``.
+
+        ``ref`` is a full commit identifier, or a reference name looked up
+        as git does: as is (such as ``HEAD``), then in tags, then in
+        branches.
+
+        """
+        if SHA_PATTERN.match(ref):
+            return self.peel(ref)
+        parts = ref.split('/')
+        if not ref or '..' in parts or '' in parts or ref.startswith('.'):
+            return None
+        for name in (ref, 'refs/' + ref, 'refs/tags/' + ref,
+                     'refs/heads/' + ref):
+            sha = self.read_ref(name)
+            if sha is not None:
+                return self.peel(sha)
+        return None
+
+    def commit_info(self, commit):
+        """Return ``(tree, time)`` of ``commit``: root tree identifier and
+        committer timestamp."""
+        headers = parse_headers(self.store.read(commit)[1])
+        committer = headers.get('committer', '').split()
+        try:
+            timestamp = int(committer[-2])
+        except (IndexError, ValueError):
+            timestamp = 0
+        return headers['tree'], timestamp
+
+    def tree(self, sha):
+        """Return entries of tree ``sha``, see :py:func:`parse_tree`."""
+        object_type, data = self.store.read(sha)
+        if object_type != 'tree':
+            raise KeyError(sha)
+        return parse_tree(data)
+
+    def lookup(self, tree, path):
+        """Return ``(kind, sha)`` of ``path`` relative to ``tree``.
+
+        ``kind`` is "dir" or "file". Return ``None`` if path does not exist.
+
+        """
+        entry = ('dir', tree)
+        for name in [part for part in path.split('/') if part]:
+            if entry[0] != 'dir':
+                return None
+            for mode, entry_name, sha in self.tree(entry[1]):
+                if entry_name == name and mode != SUBMODULE_MODE:
+                    entry = ('dir' if mode == DIR_MODE else 'file', sha)
+                    break
+            else:
+                return None
+        return entry
+
+    def walk(self, tree, prefix=''):
+        """Generate ``(relative_path, sha)`` of files in ``tree``,
+        recursively, in :py:func:`os.walk` order (sorted)."""
+        files = []
+        dirs = []
+        for mode, name, sha in self.tree(tree):
+            if mode == DIR_MODE:
+                dirs.append((name, sha))
+            elif mode != SUBMODULE_MODE:
+                files.append((name, sha))
+        for name, sha in sorted(files):
+            yield posixpath.join(prefix, name), sha
+        for name, sha in sorted(dirs):
+            for item in self.walk(sha, posixpath.join(prefix, name)):
+                yield item
+
+    def read_blob(self, sha):
+        """Return content of blob ``sha``."""
+        object_type, data = self.store.read(sha)
+        if object_type != 'blob':
+            raise KeyError(sha)
+        return data
+
+    def close(self):
+        self.store.close()
+
+
+class GitFileResource(resources.FileResource):
+    """File resource whose content is a blob of a git repository."""
+    def __init__(self, path='', engine=None, filename_engine=None,
+                 repository=None, sha=None, mtime=0):
+        super(GitFileResource, self).__init__(path, engine, filename_engine)
+        #: :py:class:`Repository` instance.
+        self.repository = repository
+        #: Identifier of blob, or ``None`` if file does not exist.
+        self.sha = sha
+        #: Time of commit, as a timestamp.
+        self.mtime = mtime
+
+    @property
+    def exists(self):
+        return self.sha is not None
+
+    def read(self):
+        """Return the template source, read from repository."""
+        if self.sha is None:
+            raise IOError('No such file in repository: {path}'.format(
+                path=self.path))
+        return self.repository.read_blob(self.sha).decode('utf-8')
+
+
+class GitDirResource(resources.DirResource):
+    """Directory resource whose tree is a tree of a git repository.
+
+    :py:attr:`path` is a virtual absolute path, such as
+    ``/repository/ref/path/``.
+
+    """
+    exists = True
+
+    def __init__(self, path='', engine=None, filename_engine=None,
+                 repository=None, sha=None, mtime=0):
+        super(GitDirResource, self).__init__(path, engine, filename_engine)
+        #: :py:class:`Repository` instance.
+        self.repository = repository
+        #: Identifier of tree.
+        self.sha = sha
+        #: Time of commit, as a timestamp.
+        self.mtime = mtime
+
+    def read_tree(self):
+        """Generate list of paths to contained resources, from repository.
+        """
+        for relative, sha in self.repository.walk(self.sha):
+            yield posixpath.join(self.path, relative)
+
+    def get_file_resource(self, path):
+        """Return :py:class:`GitFileResource` at ``path``, which is absolute
+        or relative to :py:attr:`path`."""
+        prefix = self.path.rstrip('/') + '/'
+        file_path = posixpath.join(self.path, posixpath.normpath(path))
+        if not file_path.startswith(prefix):
+            raise ValueError('File resource path is not relative to '
+                             'directory path. FILE: "{f}", DIR: "{d}"'
+                             .format(f=path, d=self.path))
+        entry = self.repository.lookup(self.sha, file_path[len(prefix):])
+        sha = entry[1] if entry is not None and entry[0] == 'file' else None
+        return GitFileResource(file_path, self.engine, self.filename_engine,
+                               repository=self.repository, sha=sha,
+                               mtime=self.mtime)
+
+
+class GitService(LocalService):
+    """A diecutter service that reads templates from local git repositories.
+
+    Repositories are bare repositories (``name.git`` or ``name``) or working
+    copies (``name/.git``) in ``diecutter.git.repositories_dir``.
+
+    """
+    def __init__(self, configuration=None):
+        super(GitService, self).__init__(configuration)
+        #: Directory holding repositories.
+        self.repositories_dir = None
+        #: Dictionary of :py:class:`Repository`, indexed by name.
+        self.repositories = {}
+        #: :py:class:`~diecutter.utils.cache.LRUCache` of objects, shared by
+        #: repositories.
+        self.object_cache = LRUCache(max_size=0)
+
+    def configure(self, configuration):
+        """Setup service, checking "diecutter.git.repositories_dir" setting.
+
+        "diecutter.template_dir" setting is not used.
+
+        """
+        Service.configure(self, configuration)
+        settings = configuration.settings
+        repositories_dir = settings.get('diecutter.git.repositories_dir')
+        if not repositories_dir or not os.path.isdir(repositories_dir):
+            raise ConfigurationError(
+                '"diecutter.git.repositories_dir" setting must be an '
+                'existing directory.')
+        self.repositories_dir = repositories_dir
+        self.object_cache = LRUCache(
+            max_size=None,
+            max_bytes=to_integer(settings, 'diecutter.git.cache_size'),
+            sizeof=lambda value: len(value[1]))
+
+    def cache_info(self, request):
+        """Return statistics about caches, including git objects."""
+        info = super(GitService, self).cache_info(request)
+        info['git_object'] = self.object_cache.info()
+        return info
+
+    def put(self, request):
+        raise Forbidden('Git repositories are read-only.')
+
+    def split_path(self, path):
+        """Return ``[repository, ref, path]`` parts of path.
+
+        >>> from diecutter.gitrepo import GitService
+        >>> service = GitService()
+        >>> service.split_path('/repo/master/nested/path')
+        ['repo', 'master', 'nested/path']
+        >>> service.split_path('/repo/master')
+        ['repo', 'master', '']
+
+        """
+        parts = path.lstrip('/').split('/', 2)
+        if len(parts) == 2:
+            parts.append('')
+        return parts
+
+    def get_repository(self, name):
+        """Return :py:class:`Repository` called ``name``, or ``None``."""
+        try:
+            return self.repositories[name]
+        except KeyError:
+            pass
+        if not name or name.startswith('.') or os.sep in name:
+            return None
+        for candidate in (name + '.git', name, os.path.join(name, '.git')):
+            path = os.path.join(self.repositories_dir, candidate)
+            if os.path.isdir(os.path.join(path, 'objects')):
+                break
+        else:
+            return None
+        with self._lock:
+            if name not in self.repositories:
+                self.repositories[name] = Repository(path,
+                                                     self.object_cache)
+            return self.repositories[name]
+
+    def get_resource(self, request, template_path=None):
+        """Return the resource matching request, or ``None``.
+
+        Return value is a :py:class:`GitFileResource` or
+        :py:class:`GitDirResource`.
+
+        ``template_path`` defaults to path in request's URL.
+
+        """
+        path = self.get_resource_path(request, template_path)
+        try:
+            name, ref, relative_path = self.split_path(path)
+        except ValueError:
+            return None
+        with get_timings(request).timer('resource'):
+            repository = self.get_repository(name)
+            if repository is None:
+                return None
+            commit = repository.resolve(ref)
+            if commit is None:
+                return None
+            tree, mtime = repository.commit_info(commit)
+            entry = repository.lookup(tree, relative_path)
+            if entry is None:
+                return None
+            kind, sha = entry
+            engine = self.get_engine(request)
+            filename_engine = self.get_filename_engine(request)
+            path = '/' + path.lstrip('/')
+            if kind == 'dir':
+                return GitDirResource(
+                    path=path, engine=engine,
+                    filename_engine=filename_engine, repository=repository,
+                    sha=sha, mtime=mtime)
+            return GitFileResource(
+                path=path, engine=engine, filename_engine=filename_engine,
+                repository=repository, sha=sha, mtime=mtime)
+
+    def get_resource_path(self, request, template_path=None):
+        """Return resource path from request.
+
+        ``template_path`` defaults to path in request's URL.
+
+        """
+        if template_path is None:
+            return request.matchdict['template_path']
+        return template_path
+
+    def needs_tree_info(self, request, resource):
+        """Return ``True``: versions are identifiers of git objects."""
+        return True
+
+    def get_tree_info(self, request, resource):
+        """Return ``(version, mtime)`` of ``resource``: identifier of blob or
+        tree, and time of commit."""
+        return (resource.sha, resource.mtime)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""In-memory index of templates directory.
+
+:py:class:`TemplateIndex` scans ``diecutter.template_dir`` once, then serves
+lookups, directory listings and versions without system calls. A watcher
+keeps it fresh: `pyinotify`_ if installed, else polling.
+
+.. _`pyinotify`: https://pypi.python.org/pypi/pyinotify
+
+"""
+from collections import namedtuple
+import hashlib
+import logging
+import os
+import threading
+
+from piecutter import resources
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Indexed file or directory. ``kind`` is either "file" or "dir".
+Entry = namedtuple('Entry', ['kind', 'mtime', 'size'])
+
+
+class Snapshot(object):
+    """Immutable state of index: entries and children of directories."""
+    def __init__(self, entries, children):
+        #: Dictionary of :py:class:`Entry`, indexed by relative path. Root
+        #: directory's path is ``''``.
+        self.entries = entries
+        #: Dictionary of ``(files, dirs)`` sorted names, indexed by relative
+        #: path of directory.
+        self.children = children
+
+
+def scan(root):
+    """Return :py:class:`Snapshot` of ``root`` directory."""
+    entries = {}
+    children = {}
+    for directory, dirs, files in os.walk(root, topdown=True):
+        dirs.sort()
+        files.sort()
+        relative = os.path.relpath(directory, root)
+        if relative == '.':
+            relative = ''
+        try:
+            stat = os.stat(directory)
+        except OSError:  # Removed in the meantime.
+            continue
+        entries[relative] = Entry('dir', stat.st_mtime, 0)
+        children[relative] = (tuple(files), tuple(dirs))
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries[os.path.join(relative, name)] = Entry(
+                'file', stat.st_mtime, stat.st_size)
+    return Snapshot(entries, children)
+
+
+class TemplateIndex(object):
+    """Index of files and directories in ``root``.
+
+    Index is a :py:class:`Snapshot`, replaced as a whole on
+    :py:meth:`refresh`, so that readers never need locks.
+
+    """
+    def __init__(self, root):
+        #: Absolute path of indexed directory.
+        self.root = os.path.normpath(os.path.abspath(root))
+        #: Current :py:class:`Snapshot`.
+        self.snapshot = scan(self.root)
+
+    def refresh(self):
+        """Scan directory again. Return True if something changed."""
+        snapshot = scan(self.root)
+        changed = snapshot.entries != self.snapshot.entries
+        self.snapshot = snapshot
+        return changed
+
+    def relative_path(self, path):
+        """Return path relative to root, or ``None`` if outside root."""
+        path = os.path.normpath(os.path.abspath(path))
+        if path == self.root:
+            return ''
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path[len(self.root) + len(os.sep):]
+
+    def lookup(self, path):
+        """Return :py:class:`Entry` for absolute ``path``, or ``None``."""
+        relative = self.relative_path(path)
+        if relative is None:
+            return None
+        return self.snapshot.entries.get(relative)
+
+    def walk(self, path, snapshot=None):
+        """Generate relative paths of files in directory at absolute
+        ``path``, recursively, in :py:func:`os.walk` order (sorted).
+        """
+        if snapshot is None:
+            snapshot = self.snapshot
+        relative = self.relative_path(path)
+        if relative is None or relative not in snapshot.children:
+            return
+        pending = [relative]
+        while pending:
+            directory = pending.pop()
+            files, dirs = snapshot.children[directory]
+            for name in files:
+                yield os.path.join(directory, name)
+            pending.extend(os.path.join(directory, name)
+                           for name in reversed(dirs))
+
+    def file_version(self, snapshot, relative, entry):
+        """Return version of file ``entry`` at ``relative`` path."""
+        return (entry.mtime, entry.size)
+
+    def tree_info(self, path):
+        """Return ``(version, mtime)`` of template at absolute ``path``.
+
+        Same as :py:func:`diecutter.utils.fingerprints.tree_info`, using
+        index.
+
+        """
+        snapshot = self.snapshot
+        relative = self.relative_path(path)
+        entry = None if relative is None else snapshot.entries.get(relative)
+        if entry is None:
+            return (None, None)
+        if entry.kind == 'file':
+            version = self.file_version(snapshot, relative, entry)
+            return (hashlib.sha1(repr(version)).hexdigest(), entry.mtime)
+        digest = hashlib.sha1()
+        mtime = entry.mtime
+        for file_path in self.walk(path, snapshot):
+            file_entry = snapshot.entries[file_path]
+            version = self.file_version(snapshot, file_path, file_entry)
+            if relative:
+                file_path = os.path.relpath(file_path, relative)
+            digest.update(repr((file_path, version)))
+            mtime = max(mtime, file_entry.mtime)
+        return (digest.hexdigest(), mtime)
+
+
+class IndexedFileResource(resources.FileResource):
+    """File resource which exists, according to index."""
+    exists = True
+
+
+class IndexedDirResource(resources.DirResource):
+    """Directory resource whose tree is read from index."""
+    exists = True
+
+    def __init__(self, path='', engine=None, filename_engine=None,
+                 index=None):
+        super(IndexedDirResource, self).__init__(path, engine,
+                                                 filename_engine)
+        #: :py:class:`TemplateIndex` instance.
+        self.index = index
+
+    def read_tree(self):
+        """Generate list of paths to contained resources, from index."""
+        for relative in self.index.walk(self.path):
+            yield os.path.join(self.index.root, relative)
+
+
+class PollingWatcher(threading.Thread):
+    """Thread that refreshes ``index`` every ``interval`` seconds."""
+    def __init__(self, index, interval=2):
+        super(PollingWatcher, self).__init__(name='diecutter-index-poll')
+        self.daemon = True
+        #: :py:class:`TemplateIndex` instance.
+        self.index = index
+        #: Delay between scans, in seconds.
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if self.index.refresh():
+                    logger.debug('Template index refreshed (polling).')
+            except Exception as e:  # Keep watching.
+                logger.error('Failed to refresh template index: {error}'
+                             .format(error=e))
+
+    def stop(self):
+        """Stop watching."""
+        self._stop_event.set()
+
+
+class InotifyWatcher(object):
+    """Refreshes ``index`` on inotify events, using `pyinotify`.
+
+    Events are coalesced: index is refreshed at most once per ``delay``
+    seconds.
+
+    """
+    def __init__(self, index, delay=0.1):
+        import pyinotify
+        #: :py:class:`TemplateIndex` instance.
+        self.index = index
+        #: Delay between an event and refresh, in seconds.
+        self.delay = delay
+        self._timer = None
+        self._lock = threading.Lock()
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_ATTRIB)
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.manager,
+                                                   self.on_event)
+        self.notifier.daemon = True
+        self.manager.add_watch(index.root, mask, rec=True, auto_add=True)
+
+    def on_event(self, event):
+        """Schedule refresh of index."""
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.refresh)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def refresh(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.index.refresh()
+        except Exception as e:
+            logger.error('Failed to refresh template index: {error}'
+                         .format(error=e))
+
+    def start(self):
+        """Start watching."""
+        self.notifier.start()
+
+    def stop(self):
+        """Stop watching."""
+        self.notifier.stop()
+
+
+def watcher_factory(index, mode, interval):
+    """Return watcher for ``index``, not started.
+
+    ``mode`` is "poll" or "on". "on" uses :py:class:`InotifyWatcher` if
+    `pyinotify` is installed, else :py:class:`PollingWatcher`.
+
+    """
+    if mode == 'on':
+        try:
+            return InotifyWatcher(index)
+        except ImportError:
+            logger.info('pyinotify is not installed, template index uses '
+                        'polling.')
+        except Exception as e:  # Such as inotify limits.
+            logger.warning('Cannot watch templates with inotify ({error}), '
+                           'template index uses polling.'.format(error=e))
+    return PollingWatcher(index, interval)
@@ -3,15 +3,23 @@
 from datetime import datetime
 import logging
 from os import makedirs
-from os.path import join, abspath, dirname, exists, isdir, normpath
+from os.path import join, abspath, dirname, exists, isdir, normpath, sep
 
 from pyramid.exceptions import ConfigurationError, Forbidden, NotFound
-from pyramid.httpexceptions import HTTPNotImplemented
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotImplemented
 
 from piecutter import resources
 
 from diecutter import __version__ as VERSION
+from diecutter.batch import BatchResource, ManifestResource, extract_manifest
 from diecutter.contextextractors import extract_context
+from diecutter.exceptions import DataParsingError
+from diecutter.index import IndexedDirResource, IndexedFileResource, \
+    TemplateIndex, watcher_factory
+from diecutter.rendercache import restore
+from diecutter.stats import get_timings
+from diecutter.utils import call_after, is_not_modified
+from diecutter.utils.fingerprints import context_hash, etag
 import diecutter.service
 
 
@@ -20,31 +28,151 @@ logger = logging.getLogger(__name__)
 
 class LocalService(diecutter.service.Service):
     """A service that loads templates on local filesystem."""
+    def __init__(self, configuration=None):
+        super(LocalService, self).__init__(configuration)
+        #: :py:class:`~diecutter.index.TemplateIndex` of template directory,
+        #: or ``None``. Set by :py:meth:`configure`.
+        self.template_index = None
+        #: Watcher which keeps :py:attr:`template_index` fresh, or ``None``.
+        self.template_index_watcher = None
+
+    def configure(self, configuration):
+        """Setup service, checking "diecutter.template_dir" setting.
+
+        Builds index of template directory if "diecutter.template_index"
+        setting is enabled.
+
+        """
+        self.validate_template_dir(configuration.template_dir)
+        super(LocalService, self).configure(configuration)
+        if configuration.template_index != 'off':
+            self.template_index = TemplateIndex(configuration.template_dir)
+            self.template_index_watcher = watcher_factory(
+                self.template_index, configuration.template_index,
+                configuration.template_index_interval)
+            self.template_index_watcher.start()
+
     def get(self, request):
-        resource = self.get_resource(request)
-        if not resource or not resource.exists:
-            return NotFound('Template not found')
-        request.response.content_type = 'text/plain'
-        request.response.write(resource.read())
-        return request.response
+        release = self.admit(request, 'get')
+        try:
+            resource = self.get_resource(request)
+            if not resource or not resource.exists:
+                return NotFound('Template not found')
+            response = request.response
+            if self.needs_tree_info(request, resource):
+                version, mtime = self.get_tree_info(request, resource)
+                response.etag = etag(resource.path, version)
+                response.last_modified = int(mtime)
+                if is_not_modified(request, response.etag,
+                                   response.last_modified):
+                    response.status_int = 304
+                    del response.content_type
+                    return response
+            response.content_type = 'text/plain'
+            response.write(resource.read())
+            return response
+        finally:
+            release()
 
     def post(self, request):
         resource = self.get_resource(request)
         try:
-            context = extract_context(request)
+            with get_timings(request).timer('context'):
+                context = extract_context(request)
         except NotImplementedError as e:
             raise HTTPNotImplemented(e.message)
-        context['diecutter'] = {
-            'api_url': '%s://%s' % (request.environ['wsgi.url_scheme'],
-                                    request.environ['HTTP_HOST']),
-            'version': VERSION,
-            'now': datetime.now()}
-        if not resource.exists:
+        except DataParsingError as e:
+            raise HTTPBadRequest(str(e))
+        context_digest = context_hash(context)
+        batch = isinstance(context, list)
+        if batch:
+            contexts, context = context, {}
+        context['diecutter'] = self.get_diecutter_context(request)
+        if not resource or not resource.exists:
             return NotFound('Template not found')
+        template = resource
+        resource = self.parallelize(request, resource)
+        if batch:
+            resource = BatchResource(resource, contexts)
+        writers = self.get_writers(request, resource, context)
+        render_cache = self.get_render_cache(request)
+        single_flight = self.get_single_flight(request)
+        render_key = render_etag = None
+        if self.needs_tree_info(request, template) or render_cache \
+                is not None or single_flight is not None:
+            render_key = self.get_render_key(request, resource,
+                                             context_digest, writers)
+            if not self.is_volatile(request, template, render_key):
+                render_etag = etag(*render_key)
+        if render_etag is not None and is_not_modified(request, render_etag):
+            request.response.status_int = 304
+            request.response.etag = render_etag
+            del request.response.content_type
+            return request.response
+        if render_etag is None or self.get_profiling_policy(request) \
+                .is_requested(request):  # Not shared.
+            render_cache = single_flight = None
+        if render_cache is not None:
+            cached = render_cache.get(render_key)
+            if cached is not None:
+                return render_cache.restore(cached, request.response)
+        leader = False
+        if single_flight is not None:
+            flight, leader = single_flight.join(render_key)
+            if not leader:
+                shared = single_flight.wait(flight)
+                if shared is not None:
+                    return restore(shared, request.response)
+        release = None
+        try:
+            release = self.admit(request,
+                                 'file' if resource.is_file else 'directory')
+            dispatcher = self.get_dispatcher(request, resource, context,
+                                             writers)
+            response = self.dispatch(request, dispatcher, resource, context)
+        except Exception:
+            if release is not None:
+                release()
+            if leader:
+                single_flight.land(render_key, flight)
+            raise
+        if response.status_int == 200 and render_etag is not None:
+            response.etag = render_etag
+        if render_cache is not None:
+            render_cache.store(render_key, response)
+        if leader:
+            single_flight.lead(render_key, flight, response)
+        return call_after(response, lambda size: release())
+
+    def manifest(self, request):
+        try:
+            with get_timings(request).timer('context'):
+                entries = extract_manifest(request)
+        except DataParsingError as e:
+            raise HTTPBadRequest(str(e))
+        diecutter_context = self.get_diecutter_context(request)
+        items = []
+        for entry in entries:
+            template_path = entry['template_path']
+            resource = self.get_resource(request, template_path)
+            if not resource or not resource.exists:
+                return NotFound('Template not found: %s' % template_path)
+            resource = self.parallelize(request, resource)
+            context = dict(entry['context'], diecutter=diecutter_context)
+            items.append((template_path, resource, entry['output_name'],
+                          context))
+        resource = ManifestResource(items)
+        context = {'diecutter': diecutter_context}
         writers = self.get_writers(request, resource, context)
-        dispatcher = self.get_dispatcher(request, resource, context, writers)
-        response = dispatcher(request, resource, context)
-        return response
+        release = self.admit(request, 'directory')
+        try:
+            dispatcher = self.get_dispatcher(request, resource, context,
+                                             writers)
+            response = dispatcher(request, resource, context)
+        except Exception:
+            release()
+            raise
+        return call_after(response, lambda size: release())
 
     def put(self, request):
         if self.is_readonly(request):
@@ -54,55 +182,124 @@ class LocalService(diecutter.service.Service):
 
         file_path = self.get_resource_path(request)
 
-        if not exists(dirname(file_path)):
-            makedirs(dirname(file_path))
+        release = self.admit(request, 'put')
+        try:
+            if not exists(dirname(file_path)):
+                makedirs(dirname(file_path))
 
-        with open(file_path, 'w') as output_file:
-            # Finally write the data to the output file
-            input_file.seek(0)
-            for line in input_file.readlines():
-                output_file.write(line)
+            with open(file_path, 'w') as output_file:
+                # Finally write the data to the output file
+                input_file.seek(0)
+                for line in input_file.readlines():
+                    output_file.write(line)
+            if self.template_index is not None:
+                self.template_index.refresh()
+        finally:
+            release()
         request.response.status_int = 201
         request.response.headers['location'] = str('/%s' % filename)
         return {'diecutter': 'Ok'}
 
-    def get_resource(self, request):
+    def get_diecutter_context(self, request):
+        """Return ``diecutter`` variables injected in contexts."""
+        return {
+            'api_url': '%s://%s' % (request.scheme, request.host),
+            'version': VERSION,
+            'now': datetime.now()}
+
+    def get_resource(self, request, template_path=None):
         """Return the resource matching request.
 
         Return value is a :py:class:`FileResource` or :py:class`DirResource`.
+        With a template index, return value is ``None`` if template does not
+        exist, so that engines are not built.
+
+        ``template_path`` defaults to path in request's URL.
+
+        """
+        with get_timings(request).timer('resource'):
+            path = self.get_resource_path(request, template_path)
+            if self.template_index is not None:
+                return self.get_indexed_resource(request, path)
+            engine = self.get_engine(request)
+            filename_engine = self.get_filename_engine(request)
+            if isdir(path):
+                resource = resources.DirResource(
+                    path=path, engine=engine, filename_engine=filename_engine)
+            else:
+                resource = resources.FileResource(
+                    path=path, engine=engine, filename_engine=filename_engine)
+        return resource
+
+    def get_indexed_resource(self, request, path):
+        """Return resource at ``path`` using index, or ``None``.
+
+        Paths with a trailing slash only match directories.
 
         """
-        path = self.get_resource_path(request)
+        entry = self.template_index.lookup(path)
+        if entry is None or (path.endswith('/') and entry.kind == 'file'):
+            return None
         engine = self.get_engine(request)
         filename_engine = self.get_filename_engine(request)
-        if isdir(path):
-            resource = resources.DirResource(path=path, engine=engine,
-                                             filename_engine=filename_engine)
-        else:
-            resource = resources.FileResource(path=path, engine=engine,
-                                              filename_engine=filename_engine)
-        return resource
+        if entry.kind == 'dir':
+            return IndexedDirResource(
+                path=path, engine=engine, filename_engine=filename_engine,
+                index=self.template_index)
+        return IndexedFileResource(
+            path=path, engine=engine, filename_engine=filename_engine)
+
+    def needs_tree_info(self, request, resource):
+        """Return whether version of ``resource`` is worth computing.
 
-    def get_resource_path(self, request):
+        With a template index, versions are computed without system calls.
+
+        """
+        if self.template_index is not None:
+            return True
+        return super(LocalService, self).needs_tree_info(request, resource)
+
+    def get_tree_info(self, request, resource):
+        """Return ``(version, mtime)`` of ``resource``, from index if any."""
+        if self.template_index is not None:
+            return self.template_index.tree_info(resource.path)
+        return super(LocalService, self).get_tree_info(request, resource)
+
+    def get_resource_path(self, request, template_path=None):
         """Return validated (absolute) resource path from request.
 
-        Checks that resource path is inside request's template_dir.
+        Checks that resource path is inside request's template_dir, and
+        that it is not one of :py:data:`diecutter.service.RESERVED_NAMES`:
+        they would be shadowed by API endpoints.
+
+        ``template_path`` defaults to path in request's URL.
 
         """
-        template_dir = self.get_template_dir(request)
-        filename = request.matchdict['template_path']
+        template_dir = normpath(abspath(self.get_template_dir(request)))
+        if template_path is None:
+            filename = request.matchdict['template_path']
+        else:
+            filename = template_path
         file_path = normpath(abspath(join(template_dir, filename)))
-        if not file_path.startswith(template_dir):
-            NotFound('Ressource not found.')
+        if file_path != template_dir \
+                and not file_path.startswith(template_dir + sep):
+            raise NotFound('Ressource not found.')
+        relative_path = file_path[len(template_dir) + 1:]
+        if relative_path in diecutter.service.RESERVED_NAMES:
+            raise Forbidden('"{name}" is a reserved name.'.format(
+                name=relative_path))
         if filename.endswith('/'):  # Preserve trailing '/'
             file_path += '/'
         return file_path
 
     def get_template_dir(self, request):
         """Return validated template directory configuration for request."""
-        try:
-            template_dir = request.registry.settings['diecutter.template_dir']
-        except KeyError:
+        template_dir = self.get_configuration(request).template_dir
+        return self.validate_template_dir(template_dir)
+
+    def validate_template_dir(self, template_dir):
+        """Return ``template_dir`` or raise ConfigurationError if invalid."""
+        if template_dir is None:
             error_msg = 'Missing mandatory "diecutter.template_dir" setting.'
             raise ConfigurationError(error_msg)
         if not template_dir:
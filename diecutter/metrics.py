@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""Metrics in Prometheus text format.
+
+Counters are kept per thread, so that requests never wait for each other:
+each thread increments its own dictionary, and dictionaries are merged when
+metrics are scraped.
+
+"""
+import threading
+import time
+
+from diecutter.utils.http import call_after
+
+
+#: Upper bounds of latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10)
+
+#: Content type of Prometheus text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Type and description of metrics, indexed by name.
+METRICS = {
+    'diecutter_requests_total': (
+        'counter', 'Requests, by route, HTTP method, engine and status.'),
+    'diecutter_request_duration_seconds': (
+        'histogram', 'Duration of requests, including streaming of body.'),
+    'diecutter_response_bytes_total': (
+        'counter', 'Bytes sent in response bodies (rendered bytes for POST).'),
+    'diecutter_archives_total': (
+        'counter', 'Archives sent, by content type.'),
+    'diecutter_template_not_found_total': (
+        'counter', 'Requests for templates that do not exist.'),
+    'diecutter_cache_hits_total': (
+        'counter', 'Cache hits, by cache.'),
+    'diecutter_cache_misses_total': (
+        'counter', 'Cache misses, by cache.'),
+    'diecutter_cache_hit_ratio': (
+        'gauge', 'Ratio of cache hits since startup, by cache.'),
+    'diecutter_admission_active': (
+        'gauge', 'Requests being processed, by request class.'),
+    'diecutter_admission_queued': (
+        'gauge', 'Requests waiting for admission, by request class.'),
+    'diecutter_admission_admitted_total': (
+        'counter', 'Admitted requests, by request class.'),
+    'diecutter_admission_rejected_total': (
+        'counter', 'Rejected requests (503), by request class and reason.'),
+}
+
+#: Content types of archives.
+ARCHIVE_TYPES = ('application/zip', 'application/gzip', 'application/x-gzip')
+
+#: Routes which render templates, i.e. may answer "template not found".
+TEMPLATE_ROUTES = ('template', 'manifest')
+
+
+class Counters(object):
+    """Counters, indexed by keys, with one dictionary per thread.
+
+    >>> from diecutter.metrics import Counters
+    >>> counters = Counters()
+    >>> counters.inc('a')
+    >>> counters.inc('a', 2)
+    >>> counters.merge()
+    {'a': 3}
+
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def shard(self):
+        """Return dictionary of counters of current thread."""
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = {}
+            with self._lock:
+                self._shards.append(counters)
+            return counters
+
+    def inc(self, key, value=1):
+        """Increment counter ``key`` by ``value``. Lock-free."""
+        counters = self.shard()
+        counters[key] = counters.get(key, 0) + value
+
+    def merge(self):
+        """Return dictionary of totals of all threads."""
+        with self._lock:
+            shards = list(self._shards)
+        totals = {}
+        for shard in shards:
+            for key, value in shard.items():  # Atomic copy.
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+def format_labels(labels):
+    """Return Prometheus representation of ``labels``, a sequence of pairs.
+
+    >>> from diecutter.metrics import format_labels
+    >>> print format_labels([('route', 'template'), ('engine', 'a"b')])
+    {route="template",engine="a\\"b"}
+    >>> format_labels([])
+    ''
+
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '{name}="{value}"'.format(
+            name=name,
+            value=str(value).replace('\\', '\\\\').replace('"', '\\"')
+                            .replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def format_value(value):
+    """Return Prometheus representation of numeric ``value``."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+    """Counters and histograms, with labels."""
+    def __init__(self, buckets=BUCKETS):
+        #: Upper bounds of histogram buckets.
+        self.buckets = tuple(buckets)
+        #: :py:class:`Counters` instance. Keys are ``(name, labels)``.
+        self.counters = Counters()
+
+    def inc(self, name, labels=(), value=1):
+        """Increment counter ``name`` with ``labels`` by ``value``."""
+        self.counters.inc((name, tuple(labels)), value)
+
+    def observe(self, name, labels, value):
+        """Add ``value`` to histogram ``name`` with ``labels``."""
+        labels = tuple(labels)
+        bound = '+Inf'
+        for upper in self.buckets:
+            if value <= upper:
+                bound = upper
+                break
+        self.counters.inc((name + '_bucket', labels + (('le', bound),)))
+        self.counters.inc((name + '_sum', labels), value)
+        self.counters.inc((name + '_count', labels))
+
+    def samples(self):
+        """Return merged samples as a dictionary ``{(name, labels): value}``.
+
+        Histogram buckets are made cumulative.
+
+        """
+        samples = self.counters.merge()
+        buckets = {}
+        for (name, labels), value in samples.items():
+            if name.endswith('_bucket'):
+                series = (name, labels[:-1])
+                buckets.setdefault(series, {})[labels[-1][1]] = value
+        for (name, labels), counts in buckets.items():
+            total = 0
+            for bound in self.buckets + ('+Inf',):
+                total += counts.get(bound, 0)
+                samples[(name, labels + (('le', bound),))] = total
+        return samples
+
+
+def format_samples(samples):
+    """Return ``samples`` in Prometheus text format.
+
+    ``samples`` is a dictionary ``{(name, labels): value}``, as returned by
+    :py:meth:`Metrics.samples`.
+
+    """
+    families = {}
+    for (name, labels), value in samples.items():
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                family = name[:-len(suffix)]
+        families.setdefault(family, []).append((name, labels, value))
+    lines = []
+    for family in sorted(families):
+        if family in METRICS:
+            metric_type, description = METRICS[family]
+            lines.append('# HELP {name} {help}'.format(
+                name=family, help=description))
+            lines.append('# TYPE {name} {type}'.format(
+                name=family, type=metric_type))
+        for name, labels, value in sorted(families[family],
+                                          key=sample_order):
+            lines.append('{name}{labels} {value}'.format(
+                name=name, labels=format_labels(labels),
+                value=format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def sample_order(sample):
+    """Return sort key of ``(name, labels, value)`` sample.
+
+    Histogram buckets are sorted by upper bound, "+Inf" last.
+
+    """
+    name, labels, value = sample
+    if labels and labels[-1][0] == 'le':
+        bound = labels[-1][1]
+        bound = float('inf') if bound == '+Inf' else bound
+        return (name, labels[:-1], bound)
+    return (name, labels, 0)
+
+
+def cache_samples(caches):
+    """Return samples about ``caches``, a dictionary of ``info()`` results.
+
+    See :py:meth:`diecutter.utils.cache.LRUCache.info`.
+
+    """
+    samples = {}
+    for cache_name, info in caches.items():
+        labels = (('cache', cache_name),)
+        hits, misses = info['hits'], info['misses']
+        samples[('diecutter_cache_hits_total', labels)] = hits
+        samples[('diecutter_cache_misses_total', labels)] = misses
+        if hits + misses:
+            ratio = float(hits) / (hits + misses)
+            samples[('diecutter_cache_hit_ratio', labels)] = ratio
+    return samples
+
+
+def admission_samples(limiters):
+    """Return samples about admission control.
+
+    ``limiters`` is a dictionary of ``info()`` results, see
+    :py:meth:`diecutter.admission.AdmissionControl.info`.
+
+    """
+    samples = {}
+    for request_class, info in limiters.items():
+        labels = (('class', request_class),)
+        samples[('diecutter_admission_active', labels)] = info['active']
+        samples[('diecutter_admission_queued', labels)] = info['waiting']
+        samples[('diecutter_admission_admitted_total', labels)] = \
+            info['admitted']
+        for reason, key in [('queue_full', 'rejected'),
+                            ('timeout', 'timeouts')]:
+            samples[('diecutter_admission_rejected_total',
+                     labels + (('reason', reason),))] = info[key]
+    return samples
+
+
+def get_metrics(request):
+    """Return :py:class:`Metrics` of application, or ``None``."""
+    return getattr(request.registry, 'diecutter_metrics', None)
+
+
+def route_name(request):
+    """Return short name of route which matched request, or ``''``.
+
+    Prefix of service (as in :py:func:`diecutter.service.register_service`)
+    is removed, i.e. names are "hello", "template", "manifest"...
+
+    """
+    route = getattr(request, 'matched_route', None)
+    if route is None:
+        return ''
+    return route.name.rsplit('_', 1)[-1]
+
+
+def record_request(metrics, request, response, duration, size):
+    """Record metrics about ``request`` and its ``response``."""
+    route = route_name(request)
+    cache = getattr(request, 'cache', {})
+    engine = cache.get('diecutter_engine_slug', '')
+    labels = (('route', route),
+              ('method', request.method),
+              ('engine', engine))
+    metrics.inc('diecutter_requests_total',
+                labels + (('status', response.status_int),))
+    metrics.observe('diecutter_request_duration_seconds', labels, duration)
+    metrics.inc('diecutter_response_bytes_total', labels, size)
+    content_type = response.content_type
+    if content_type in ARCHIVE_TYPES and response.status_int == 200:
+        metrics.inc('diecutter_archives_total',
+                    (('content_type', content_type),))
+    if response.status_int == 404 and route in TEMPLATE_ROUTES:
+        metrics.inc('diecutter_template_not_found_total',
+                    (('route', route),))
+
+
+def metrics_tween_factory(handler, registry):
+    """Pyramid tween which records metrics about requests."""
+    metrics = registry.diecutter_metrics
+
+    def metrics_tween(request):
+        start = time.time()
+        response = handler(request)
+
+        def record(size):
+            record_request(metrics, request, response, time.time() - start,
+                           size)
+        return call_after(response, record)
+    return metrics_tween
+
+
+def includeme(config):
+    """Setup metrics in Pyramid ``config``."""
+    if getattr(config.registry, 'diecutter_metrics', None) is None:
+        config.registry.diecutter_metrics = Metrics()
+        config.add_tween('diecutter.metrics.metrics_tween_factory')
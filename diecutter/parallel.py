@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Render files of directory resources concurrently, in worker processes.
+
+Rendering templates is CPU-bound and holds the interpreter lock, so files are
+rendered by a pool of processes. Jobs are picklable: path and source of
+template, engine slug and context. Each worker builds its own engines from
+settings, on first use, and keeps their compiled templates.
+
+"""
+from collections import deque
+import signal
+
+from piecutter.exceptions import TemplateError
+
+
+#: Engines of worker process, indexed by slug. See :py:func:`init_worker`.
+_engines = {}
+
+#: :py:class:`~diecutter.settings.Configuration` of worker process.
+_configuration = None
+
+
+def render_pool(workers, settings=None):
+    """Return pool of ``workers`` processes, or ``None`` if ``workers`` <= 1.
+
+    Workers build engines from ``settings``, see
+    :py:func:`diecutter.settings.configure`.
+
+    """
+    if workers <= 1:
+        return None
+    import multiprocessing
+    return multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                initargs=(settings or {},))
+
+
+def init_worker(settings):
+    """Setup worker process: read configuration from ``settings``.
+
+    Interruptions are handled by parent process.
+
+    """
+    global _configuration
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from diecutter.settings import configure
+    _configuration = configure(settings)
+    _engines.clear()
+
+
+def get_engine(engine_slug):
+    """Return engine of worker process for ``engine_slug``."""
+    try:
+        return _engines[engine_slug]
+    except KeyError:
+        pass
+    from diecutter.engines import CachedEngine, set_bytecode_cache
+    from diecutter.utils.cache import LRUCache
+    engine = _configuration.engines[engine_slug]()
+    if _configuration.bytecode_cache_dir:
+        set_bytecode_cache(engine, _configuration.bytecode_cache_dir)
+    _engines[engine_slug] = CachedEngine(
+        engine, LRUCache(max_size=_configuration.template_cache_size),
+        engine_slug)
+    return _engines[engine_slug]
+
+
+def render_job(job):
+    """Render ``(path, template, engine_slug, context)`` job in worker.
+
+    Return ``(content, error)``: rendered content as UTF-8, or error message.
+    Errors are returned rather than raised, since they must be pickled.
+
+    """
+    path, template, engine_slug, context = job
+    try:
+        content = get_engine(engine_slug).render(template, context)
+        return content.encode('utf-8'), None
+    except TemplateError as e:
+        return None, '%s: %s' % (path, e)
+
+
+def parallel_render(resource, context, pool, window):
+    """Generate ``(filename, content)`` for directory ``resource``.
+
+    Output is the same as :py:meth:`piecutter.resources.DirResource.render`,
+    in the same order, but files are rendered by ``pool``. At most
+    ``window`` files are rendered in advance.
+
+    """
+    engine_slug = resource.engine.slug
+    pending = deque()
+
+    def result():
+        filename, async_result = pending.popleft()
+        content, error = async_result.get()
+        if error is not None:
+            raise TemplateError(error)
+        return filename, [content]
+
+    for resource_path, filename, item_context in resource.render_tree(context):
+        file_resource = resource.get_file_resource(resource_path)
+        try:
+            template = file_resource.read()
+        except UnicodeDecodeError as e:
+            raise TemplateError('%s: %s' % (file_resource.path, e))
+        # Dynamic trees update context in place, and jobs are pickled later:
+        # take a snapshot.
+        job = (file_resource.path, template, engine_slug, dict(item_context))
+        pending.append((filename, pool.apply_async(render_job, (job,))))
+        if len(pending) >= window:
+            yield result()
+    while pending:
+        yield result()
+
+
+class ParallelDirResource(object):
+    """Proxy to a directory resource, whose files are rendered by a pool.
+
+    Resource's engine must be a :py:class:`~diecutter.engines.CachedEngine`,
+    whose slug tells workers which engine to use.
+
+    """
+    def __init__(self, resource, pool, window):
+        #: Wrapped :py:class:`piecutter.resources.DirResource` instance.
+        self.resource = resource
+        #: Pool of worker processes, see :py:func:`render_pool`.
+        self.pool = pool
+        #: Maximum number of files rendered in advance.
+        self.window = window
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def render(self, context):
+        """Generate ``(filename, content)`` rendered against context."""
+        return parallel_render(self.resource, context, self.pool, self.window)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Profile renders with cProfile, on demand or by sampling.
+
+A request is profiled if:
+
+* it has a ``profile`` query parameter, whose value is ``diecutter.token``
+  (see :py:func:`diecutter.validators.get_token`). Profiling is disabled if
+  ``diecutter.token`` is empty.
+
+* or it is one in ``diecutter.profile_sample_rate`` requests.
+
+Since responses are streamed, the profiler runs while the response is
+generated, then statistics are saved in ``diecutter.profile_dir`` as a pstats
+dump and a JSON summary. Only the ``diecutter.profile_keep`` most recent
+profiles are kept.
+
+"""
+import cProfile
+import itertools
+import json
+import logging
+import marshal
+import os
+import pstats
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+
+from diecutter.validators import get_token
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Number of functions in JSON summaries.
+TOP = 30
+
+
+def summary(profiler, top=TOP):
+    """Return dictionary with total time and ``top`` functions of profiler.
+
+    Functions are sorted by cumulative time.
+
+    """
+    profiler.create_stats()
+    if not profiler.stats:  # Nothing profiled.
+        return {'total_time': 0, 'functions': []}
+    stats = pstats.Stats(profiler, stream=StringIO())
+    functions = []
+    for function, (primitive_calls, calls, total_time, cumulative_time,
+                   callers) in stats.stats.items():
+        functions.append({
+            'function': '{0}:{1}({2})'.format(*function),
+            'calls': calls,
+            'tottime': total_time,
+            'cumtime': cumulative_time})
+    functions.sort(key=lambda item: item['cumtime'], reverse=True)
+    return {'total_time': stats.total_tt, 'functions': functions[:top]}
+
+
+class Profiler(object):
+    """Profiles parts of one request, saves statistics on demand."""
+    def __init__(self, name):
+        #: Name of profile, used as file name.
+        self.name = name
+        #: :py:class:`cProfile.Profile` instance.
+        self.profile = cProfile.Profile()
+
+    def call(self, function, *args, **kwargs):
+        """Return ``function(*args, **kwargs)``, profiled."""
+        self.profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.profile.disable()
+
+    def iterate(self, iterable, callback=None):
+        """Generate items of ``iterable``, profiling their generation.
+
+        ``callback(self)`` is called at the end.
+
+        """
+        iterator = iter(iterable)
+        try:
+            while True:
+                try:
+                    item = self.call(next, iterator)
+                except StopIteration:
+                    break
+                yield item
+        finally:
+            if hasattr(iterable, 'close'):
+                self.call(iterable.close)
+            if callback is not None:
+                callback(self)
+
+    def summary(self, top=TOP):
+        """Return summary of statistics, see :py:func:`summary`."""
+        return summary(self.profile, top)
+
+    def save(self, directory):
+        """Write pstats dump and JSON summary in ``directory``.
+
+        Files are written atomically, as ``<name>.prof`` and ``<name>.json``.
+
+        """
+        for extension, write in [('.prof', self.write_dump),
+                                 ('.json', self.write_summary)]:
+            path = os.path.join(directory, self.name + extension)
+            handle, temp_path = tempfile.mkstemp(prefix='.tmp-',
+                                                 dir=directory)
+            try:
+                with os.fdopen(handle, 'w') as temp_file:
+                    write(temp_file)
+                os.rename(temp_path, path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+
+    def write_dump(self, output):
+        """Write pstats dump of statistics to ``output`` file."""
+        self.profile.create_stats()
+        marshal.dump(self.profile.stats, output)
+
+    def write_summary(self, output):
+        """Write JSON summary of statistics to ``output`` file."""
+        json.dump(self.summary(), output, indent=2)
+
+
+def rotate(directory, keep):
+    """Remove oldest profiles in ``directory``, keep ``keep`` most recent.
+    """
+    names = [name[:-len('.prof')] for name in os.listdir(directory)
+             if name.endswith('.prof')]
+    names.sort()  # Names start with timestamps.
+    for name in names[:max(0, len(names) - keep)]:
+        for extension in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(directory, name + extension))
+            except OSError:
+                pass
+
+
+class ProfilingPolicy(object):
+    """Decide which requests are profiled, save profiles.
+
+    One in ``sample_rate`` requests are profiled (``0`` disables sampling).
+    Profiles are saved in ``directory`` (empty disables saving and
+    sampling), which keeps ``keep`` profiles.
+
+    """
+    def __init__(self, directory='', sample_rate=0, keep=100):
+        #: Directory where profiles are saved.
+        self.directory = directory
+        #: Profile one in ``sample_rate`` requests.
+        self.sample_rate = sample_rate
+        #: Maximum number of profiles in directory.
+        self.keep = keep
+        self._requests = itertools.count(1)
+        self._profiles = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def is_requested(self, request):
+        """Return True if request asks for profiling, with valid token."""
+        token = get_token(request)
+        return bool(token) and request.GET.get('profile') == token
+
+    def is_sampled(self):
+        """Return True for one in ``sample_rate`` calls."""
+        if self.sample_rate <= 0 or not self.directory:
+            return False
+        return next(self._requests) % self.sample_rate == 0
+
+    def profiler(self, request):
+        """Return :py:class:`Profiler` for request, or ``None``."""
+        if not (self.is_requested(request) or self.is_sampled()):
+            return None
+        name = '{time}-{pid}-{number:06d}'.format(
+            time=time.strftime('%Y%m%dT%H%M%S'), pid=os.getpid(),
+            number=next(self._profiles) % 1000000)
+        return Profiler(name)
+
+    def save(self, profiler):
+        """Save profile in directory, if any, and remove oldest profiles."""
+        if not self.directory:
+            return
+        try:
+            with self._lock:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                profiler.save(self.directory)
+                rotate(self.directory, self.keep)
+        except (IOError, OSError) as e:
+            logger.error('Failed to save profile {name}: {error}'
+                         .format(name=profiler.name, error=e))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Cache of rendered responses."""
+from collections import namedtuple
+
+from diecutter.utils.cache import LRUCache
+
+
+#: Cached response: status line, list of headers and body.
+CachedResponse = namedtuple('CachedResponse', ['status', 'headers', 'body'])
+
+
+#: Headers which are not replayed with cached or shared responses, lower
+#: case: length may change, profiles are specific to a request.
+PRIVATE_HEADERS = ('content-length', 'diecutter-profile')
+
+
+def shared_headers(response):
+    """Return list of headers of ``response`` which can be replayed."""
+    return [(name, value) for (name, value) in response.headerlist
+            if name.lower() not in PRIVATE_HEADERS]
+
+
+def restore(cached, response):
+    """Populate and return ``response`` using :py:class:`CachedResponse`."""
+    response.status = cached.status
+    response.headerlist = list(cached.headers)
+    response.body = cached.body
+    return response
+
+
+class RenderCache(object):
+    """LRU cache of rendered responses, bounded by total size of bodies.
+
+    Keys are computed by services, typically from template path and version,
+    engines, hash of context and writers.
+
+    """
+    def __init__(self, max_bytes):
+        #: Maximum total size of cached bodies, in bytes.
+        self.max_bytes = max_bytes
+        #: :py:class:`~diecutter.utils.cache.LRUCache` instance.
+        self.cache = LRUCache(max_size=None, max_bytes=max_bytes,
+                              sizeof=lambda cached: len(cached.body))
+
+    def get(self, key):
+        """Return :py:class:`CachedResponse` for ``key``, or ``None``."""
+        return self.cache.get(key)
+
+    def restore(self, cached, response):
+        """Populate and return ``response`` using ``cached`` one."""
+        return restore(cached, response)
+
+    def store(self, key, response):
+        """Arrange for ``response`` to be cached once its body is generated.
+
+        Only successful responses are cached. Response's ``app_iter`` is
+        wrapped: body is cached only if it is generated until the end.
+
+        """
+        if response.status_int != 200:
+            return response
+        response.app_iter = self.tee(key, response.status,
+                                     shared_headers(response),
+                                     response.app_iter)
+        return response
+
+    def tee(self, key, status, headers, app_iter):
+        """Generate items of ``app_iter``, and cache them at the end."""
+        chunks = []
+        size = 0
+        try:
+            for chunk in app_iter:
+                if chunks is not None:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        chunks = None  # Too big, give up caching.
+                    else:
+                        chunks.append(chunk)
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if chunks is not None:
+            self.cache.set(key, CachedResponse(status=status,
+                                               headers=headers,
+                                               body=''.join(chunks)))
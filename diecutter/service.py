@@ -4,38 +4,126 @@ try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
+import json
+import re
+import threading
 
-import cornice
-from pyramid.config import Configurator
-from pyramid.exceptions import ConfigurationError
-from pyramid.httpexceptions import HTTPNotImplemented, HTTPNotAcceptable
+from pyramid.httpexceptions import HTTPNotImplemented, HTTPNotAcceptable, \
+    HTTPServiceUnavailable
+from pyramid.response import Response
 
 import diecutter
+import diecutter.settings
 import diecutter.validators
 import diecutter.utils
-from diecutter.writers import (zip_directory_response,
-                               file_response,
-                               targz_directory_response)
+from diecutter.admission import AdmissionControl
+from diecutter.metrics import CONTENT_TYPE, admission_samples, \
+    cache_samples, format_samples, get_metrics
+from diecutter.profiling import ProfilingPolicy
+from diecutter.rendercache import RenderCache
+from diecutter.singleflight import SingleFlight
+from diecutter.stats import get_stats, get_timings
+from diecutter.utils.cache import LRUCache
+from diecutter.utils import is_conditional
+from diecutter.utils.fingerprints import tree_info
 
 
-def supported_engines(request):
-    """Return the list of supported template engines."""
-    engines = []
-    for key in request.registry.settings.keys():
-        if key.startswith('diecutter.engine.'):
-            engine_slug = key[len('diecutter.engine.'):]
-            engines.append(engine_slug)
-    return engines
+#: Paths of API endpoints, relative to service root. Templates cannot use
+#: these names at the root of templates directory.
+RESERVED_NAMES = ('_manifest', '_stats', '_metrics')
+
+#: References to ``diecutter`` variables which do not change between
+#: requests.
+STABLE_VARIABLES = re.compile(
+    r"""diecutter\s*(\.\s*(api_url|version)\b"""
+    r"""|\[\s*['"](api_url|version)['"]\s*\])""")
+
+
+def is_volatile(source):
+    """Return whether template ``source`` may read ``diecutter.now``.
+
+    Templates which refer to ``diecutter`` other than through ``api_url``
+    or ``version`` are volatile: their output changes with time.
+
+    >>> from diecutter.service import is_volatile
+    >>> is_volatile(u'{{ diecutter.api_url }} {{ diecutter["version"] }}')
+    False
+    >>> is_volatile(u'{{ diecutter.now }}')
+    True
+    >>> is_volatile(u'{% for key in diecutter %}{{ key }}{% endfor %}')
+    True
+
+    """
+    return 'diecutter' in STABLE_VARIABLES.sub('', source)
 
 
 class Service(object):
     """Base class for diecutter services."""
+    def __init__(self, configuration=None):
+        #: Runtime :py:class:`~diecutter.settings.Configuration`. Set by
+        #: :py:meth:`configure`.
+        self.configuration = configuration
+        #: Engine instances, indexed by slug. Shared by all requests.
+        self.engines = {}
+        #: Compiled templates cache, shared by all engines. Initialized on
+        #: first use, since it depends on configuration.
+        self.template_cache = None
+        #: Pool of workers to render directories, or ``None``. Initialized on
+        #: first use, since it depends on configuration.
+        self.render_pool = None
+        #: Cache of rendered responses, or ``None``. Initialized on first
+        #: use, since it depends on configuration.
+        self.render_cache = None
+        #: :py:class:`~diecutter.singleflight.SingleFlight` which coalesces
+        #: identical renders, or ``None``. Initialized on first use, since it
+        #: depends on configuration.
+        self.single_flight = None
+        #: :py:class:`~diecutter.admission.AdmissionControl`, or ``None``.
+        #: Initialized on first use, since it depends on configuration.
+        self.admission_control = None
+        #: :py:class:`~diecutter.profiling.ProfilingPolicy`. Initialized on
+        #: first use, since it depends on configuration.
+        self.profiling_policy = None
+        #: Whether templates are volatile, indexed by path and version.
+        #: Initialized on first use, since it depends on configuration.
+        self.volatile_templates = None
+        self._lock = threading.Lock()
+
+    def configure(self, configuration):
+        """Setup service with ``configuration``, once at startup.
+
+        Subclasses may override this method to validate service-specific
+        settings, raising :py:class:`~pyramid.exceptions.ConfigurationError`.
+
+        Pool of render workers, if any, is started here, i.e. before server
+        starts threads.
+
+        """
+        self.configuration = configuration
+        if configuration.render_workers > 1 and self.render_pool is None:
+            from diecutter.parallel import render_pool
+            self.render_pool = render_pool(configuration.render_workers,
+                                           configuration.settings)
+
+    def get_configuration(self, request):
+        """Return runtime configuration for request.
+
+        Services that were not configured at startup (i.e. not through
+        :py:func:`diecutter.wsgi.for_paste`) use
+        :py:func:`diecutter.settings.get_configuration`.
+
+        """
+        if self.configuration is not None:
+            return self.configuration
+        return diecutter.settings.get_configuration(request)
+
     def hello(self, request):
         """Returns Hello and API version in JSON."""
+        configuration = self.get_configuration(request)
         return OrderedDict((
             ('diecutter', 'Hello'),
             ('version', diecutter.__version__),
-            ('engines', sorted(supported_engines(request)))
+            ('engines', list(configuration.engine_slugs))
         ))
 
     def get(self, request):
@@ -47,6 +135,48 @@ class Service(object):
     def put(self, request):
         raise HTTPNotImplemented()
 
+    def manifest(self, request):
+        """Render several templates, each against its own context."""
+        raise HTTPNotImplemented()
+
+    def stats(self, request):
+        """Return histograms of durations of request stages, in JSON."""
+        stats = get_stats(request)
+        snapshot = OrderedDict() if stats is None else stats.snapshot()
+        admission_control = self.get_admission_control(request)
+        if admission_control is not None:
+            snapshot['admission'] = admission_control.info()
+        return snapshot
+
+    def metrics(self, request):
+        """Return metrics in Prometheus text format."""
+        metrics = get_metrics(request)
+        samples = {} if metrics is None else metrics.samples()
+        samples.update(cache_samples(self.cache_info(request)))
+        admission_control = self.get_admission_control(request)
+        if admission_control is not None:
+            samples.update(admission_samples(admission_control.info()))
+        response = request.response
+        response.headers['Content-Type'] = CONTENT_TYPE
+        response.body = format_samples(samples)
+        return response
+
+    def cache_info(self, request):
+        """Return statistics about caches, as a dictionary.
+
+        Keys are cache names, values are
+        :py:meth:`~diecutter.utils.cache.LRUCache.info` results.
+
+        """
+        info = OrderedDict()
+        if self.template_cache is not None:
+            info['template'] = self.template_cache.info()
+        if self.render_cache is not None:
+            info['render'] = self.render_cache.cache.info()
+        if self.single_flight is not None:
+            info['coalesce'] = self.single_flight.info()
+        return info
+
     def get_resource(self, request):
         """Return the resource object (instance) matching request."""
         raise NotImplementedError()
@@ -59,33 +189,35 @@ class Service(object):
         engine to render files.
 
         """
+        configuration = self.get_configuration(request)
         # Try engine from request's GET.
         try:
             engine_slug = request.GET['engine']
         except KeyError:
-            engine_type = 'diecutter.filename_engine' if filename \
-                else 'diecutter.engine'
-            engine_slug = request.registry.settings[engine_type]
+            engine_slug = configuration.filename_engine if filename \
+                else configuration.engine
+        try:
+            engine_factory = configuration.engines[engine_slug]
+        except KeyError:
+            raise HTTPNotAcceptable(
+                'Supported template engines: %s'
+                % ', '.join(configuration.engine_slugs))
+        # Only known slugs are remembered: they are used as metrics labels.
         if not hasattr(request, 'cache'):
             request.cache = {}
         if filename:
             request.cache['diecutter_filename_engine_slug'] = engine_slug
         else:
             request.cache['diecutter_engine_slug'] = engine_slug
-        try:
-            engine_path_setting = 'diecutter.engine.{0}'.format(engine_slug)
-            engine_path = request.registry.settings[engine_path_setting]
-        except KeyError:
-            raise HTTPNotAcceptable(
-                'Supported template engines: %s'
-                % ', '.join(sorted(supported_engines(request))))
-        config = Configurator(request.registry.settings)
-        engine_factory = config.maybe_dotted(engine_path)
         return engine_factory
 
     def get_engine(self, request):
         """Return configured template engine to render templates."""
-        return self.get_engine_factory(request)()
+        with get_timings(request).timer('engine'):
+            engine_factory = self.get_engine_factory(request)
+            engine_slug = request.cache['diecutter_engine_slug']
+            return self.get_engine_instance(request, engine_slug,
+                                            engine_factory)
 
     def get_filename_engine(self, request):
         """Return configured template engine to render filenames.
@@ -93,40 +225,281 @@ class Service(object):
         This is not used for dynamic trees.
 
         """
-        return self.get_engine_factory(request, filename=True)()
+        with get_timings(request).timer('engine'):
+            engine_factory = self.get_engine_factory(request, filename=True)
+            engine_slug = request.cache['diecutter_filename_engine_slug']
+            return self.get_engine_instance(request, engine_slug,
+                                            engine_factory)
+
+    def get_engine_instance(self, request, engine_slug, engine_factory):
+        """Return long-lived engine instance for ``engine_slug``.
+
+        Engines are instantiated once per slug, then reused by every request.
+        They are wrapped in :py:class:`~diecutter.engines.CachedEngine`, so
+        that unchanged templates are compiled once. Jinja2 engines use
+        ``diecutter.bytecode_cache_dir`` setting, if any.
+
+        """
+        try:
+            return self.engines[engine_slug]
+        except KeyError:
+            pass
+        from diecutter.engines import CachedEngine, set_bytecode_cache
+        template_cache = self.get_template_cache(request)
+        bytecode_cache_dir = self.get_configuration(request) \
+            .bytecode_cache_dir
+        with self._lock:
+            if engine_slug not in self.engines:
+                engine = engine_factory()
+                if bytecode_cache_dir:
+                    set_bytecode_cache(engine, bytecode_cache_dir)
+                self.engines[engine_slug] = CachedEngine(
+                    engine, template_cache, engine_slug)
+            return self.engines[engine_slug]
+
+    def get_template_cache(self, request):
+        """Return LRU cache of compiled templates.
+
+        Size is read from ``diecutter.template_cache_size`` setting.
+
+        """
+        if self.template_cache is None:
+            configuration = self.get_configuration(request)
+            with self._lock:
+                if self.template_cache is None:
+                    self.template_cache = LRUCache(
+                        max_size=configuration.template_cache_size)
+        return self.template_cache
+
+    def get_render_cache(self, request):
+        """Return cache of rendered responses, or ``None`` if disabled.
+
+        Size of cache, in bytes, is read from ``diecutter.render_cache_size``
+        setting.
+
+        """
+        max_bytes = self.get_configuration(request).render_cache_size
+        if max_bytes > 0 and self.render_cache is None:
+            with self._lock:
+                if self.render_cache is None:
+                    self.render_cache = RenderCache(max_bytes)
+        return self.render_cache
+
+    def get_single_flight(self, request):
+        """Return registry of in-flight renders, or ``None`` if disabled.
+
+        Read from ``diecutter.coalesce_timeout`` and
+        ``diecutter.coalesce_max_size`` settings.
+
+        """
+        configuration = self.get_configuration(request)
+        if configuration.coalesce_timeout > 0 and self.single_flight is None:
+            with self._lock:
+                if self.single_flight is None:
+                    self.single_flight = SingleFlight(
+                        configuration.coalesce_timeout,
+                        configuration.coalesce_max_size)
+        return self.single_flight
+
+    def get_admission_control(self, request):
+        """Return admission control, or ``None`` if no class is limited.
+
+        Read from ``diecutter.admission.*`` settings.
+
+        """
+        configuration = self.get_configuration(request)
+        if configuration.admission_limits and self.admission_control is None:
+            with self._lock:
+                if self.admission_control is None:
+                    self.admission_control = AdmissionControl(
+                        configuration.admission_limits,
+                        configuration.admission_timeout,
+                        configuration.admission_retry_after)
+        return self.admission_control
+
+    def admit(self, request, request_class):
+        """Wait for admission of request, return function that releases it.
+
+        Raise ``503 Service Unavailable``, with ``Retry-After`` header, if
+        request is rejected. See :py:mod:`diecutter.admission`.
+
+        """
+        admission_control = self.get_admission_control(request)
+        if admission_control is None:
+            return lambda: None
+        with get_timings(request).timer('admission'):
+            release = admission_control.acquire(request_class)
+        if release is None:
+            raise HTTPServiceUnavailable(
+                'Too many {name} requests, retry later.'.format(
+                    name=request_class),
+                headers={'Retry-After': str(admission_control.retry_after)})
+        return release
+
+    def get_profiling_policy(self, request):
+        """Return :py:class:`~diecutter.profiling.ProfilingPolicy`.
+
+        Policy is read from ``diecutter.profile_*`` settings.
+
+        """
+        if self.profiling_policy is None:
+            configuration = self.get_configuration(request)
+            with self._lock:
+                if self.profiling_policy is None:
+                    self.profiling_policy = ProfilingPolicy(
+                        directory=configuration.profile_dir,
+                        sample_rate=configuration.profile_sample_rate,
+                        keep=configuration.profile_keep)
+        return self.profiling_policy
+
+    def dispatch(self, request, dispatcher, resource, context):
+        """Return ``dispatcher(request, resource, context)``.
+
+        Rendering is profiled if requested or sampled, see
+        :py:mod:`diecutter.profiling`. If profile is requested with
+        ``profile_format=json`` query parameter, response is replaced by a
+        JSON summary of profile. Else, if profile is saved, response has a
+        ``Diecutter-Profile`` header with profile's name.
+
+        """
+        policy = self.get_profiling_policy(request)
+        profiler = policy.profiler(request)
+        if profiler is None:
+            return dispatcher(request, resource, context)
+        response = profiler.call(dispatcher, request, resource, context)
+        if request.GET.get('profile_format') == 'json' \
+                and policy.is_requested(request):
+            size = 0
+            for chunk in profiler.iterate(response.app_iter):
+                size += len(chunk)
+            policy.save(profiler)
+            report = OrderedDict((('status', response.status_int),
+                                  ('size', size),
+                                  ('name', profiler.name),
+                                  ('profile', profiler.summary())))
+            return Response(body=json.dumps(report),
+                            content_type='application/json')
+        if policy.directory:
+            response.headers['Diecutter-Profile'] = profiler.name
+        content_length = response.content_length
+        response.app_iter = profiler.iterate(response.app_iter, policy.save)
+        response.content_length = content_length
+        return response
+
+    def get_render_key(self, request, resource, context_digest, writers):
+        """Return key that identifies a rendered response.
+
+        Key depends on resource's path and version, engines, context (as
+        ``context_digest``), API URL and writers (i.e. output format). It is
+        used as render cache key and to compute entity tags.
+
+        Tree's modification time is kept in ``request.cache``, to date
+        archive entries, see :py:func:`diecutter.writers.archive_mtime`.
+
+        """
+        version, mtime = self.get_tree_info(request, resource)
+        request.cache['diecutter_tree_mtime'] = mtime
+        return (resource.path,
+                version,
+                request.cache['diecutter_engine_slug'],
+                request.cache['diecutter_filename_engine_slug'],
+                context_digest,
+                request.scheme,
+                request.host,
+                tuple(writer.__name__ for writer in writers))
+
+    def is_volatile(self, request, resource, render_key):
+        """Return whether output of ``resource`` may read ``diecutter.now``.
+
+        Such outputs change with time: they are not cached, shared or
+        given entity tags. Sources and filenames of templates are checked
+        once per version, see :py:func:`is_volatile`.
+
+        """
+        if self.volatile_templates is None:
+            configuration = self.get_configuration(request)
+            with self._lock:
+                if self.volatile_templates is None:
+                    self.volatile_templates = LRUCache(
+                        max_size=configuration.template_cache_size)
+
+        def check():
+            try:
+                if resource.is_file:
+                    return is_volatile(resource.read())
+                for path in resource.read_tree():
+                    if is_volatile(path) or is_volatile(
+                            resource.get_file_resource(path).read()):
+                        return True
+            except (EnvironmentError, UnicodeDecodeError):
+                return True  # Rendering will report the error.
+            return False
+        return self.volatile_templates.get_or_set(render_key[:2], check)
+
+    def needs_tree_info(self, request, resource):
+        """Return whether version of ``resource`` is worth computing.
+
+        Version of directories is computed by walking the tree: only for
+        conditional requests. Services which read versions from an index
+        override this method.
+
+        """
+        return resource.is_file or is_conditional(request)
+
+    def get_tree_info(self, request, resource):
+        """Return ``(version, mtime)`` of ``resource``.
+
+        See :py:func:`diecutter.utils.fingerprints.tree_info`.
+
+        """
+        return tree_info(resource.path)
+
+    def get_render_pool(self, request):
+        """Return pool of workers to render directories, or ``None``.
+
+        Size of pool is read from ``diecutter.render_workers`` setting.
+
+        """
+        configuration = self.get_configuration(request)
+        if configuration.render_workers > 1 and self.render_pool is None:
+            with self._lock:
+                if self.render_pool is None:
+                    from diecutter.parallel import render_pool
+                    self.render_pool = render_pool(
+                        configuration.render_workers, configuration.settings)
+        return self.render_pool
+
+    def parallelize(self, request, resource):
+        """Return resource which renders files concurrently, if configured.
+
+        Only directories are affected. Output order does not change.
+
+        """
+        if resource.is_file:
+            return resource
+        pool = self.get_render_pool(request)
+        if pool is None:
+            return resource
+        window = 2 * self.get_configuration(request).render_workers
+        from diecutter.parallel import ParallelDirResource
+        return ParallelDirResource(resource, pool, window)
 
     def get_writers(self, request, resource, context):
         """Return iterable of writers."""
         if resource.is_file:
+            from diecutter.writers import file_response
             return [file_response]
         else:
+            archive_writers = self.get_configuration(request).archive_writers
             accepted_mime_types = diecutter.utils.accepted_types(request)
-            # Reference.
-            mime_map = {'application/zip': [zip_directory_response],
-                        'application/gzip': [targz_directory_response],
-                        }
-            # Aliases.
-            mime_map['application/x-gzip'] = mime_map['application/gzip']
-            # Fallback.
-            settings = request.registry.settings
-            try:
-                default_type = settings['diecutter.default_archive_type']
-            except KeyError:
-                default_type = 'application/gzip'
-            if default_type not in mime_map.keys():
-                raise ConfigurationError(
-                    'Cannot use "{type}" as "default_archive_type". Supported '
-                    'types are: {supported}'.format(
-                        type=default_type,
-                        supported=','.join(mime_map.keys())))
-            mime_map['*/*'] = mime_map[default_type]
             for accepted_mime_type in accepted_mime_types:
                 try:
-                    return mime_map[accepted_mime_type]
+                    return archive_writers[accepted_mime_type]
                 except KeyError:
                     pass
-            raise HTTPNotAcceptable('Supported mime types: %s'
-                                    % ', '.join(sorted(mime_map.keys())))
+            raise HTTPNotAcceptable(
+                'Supported mime types: %s'
+                % ', '.join(sorted(archive_writers.keys())))
 
     def get_dispatcher(self, request, resource, context, writers):
         """Return simple dispatcher (later, would read configuration)."""
@@ -139,12 +512,12 @@ class Service(object):
         On.
 
         """
-        readonly = request.registry.settings.get('diecutter.readonly', False)
-        return diecutter.utils.to_boolean(readonly)
+        return self.get_configuration(request).readonly
 
 
 def register_service(config, name, service, path):
     """Register a diecutter service in Pyramid routing."""
+    import cornice
     hello = cornice.Service(name='{name}_hello'.format(name=name),
                             path=path,
                             description="The template API",
@@ -153,12 +526,33 @@ def register_service(config, name, service, path):
         name='{name}_template'.format(name=name),
         path='%s{template_path:.+}' % path,
         description="Return the template render or raw")
+    manifest = cornice.Service(
+        name='{name}_manifest'.format(name=name),
+        path='%s_manifest' % path,
+        description="Render several templates as one archive")
+    stats = cornice.Service(
+        name='{name}_stats'.format(name=name),
+        path='%s_stats' % path,
+        description="Statistics about durations of requests")
+    metrics = cornice.Service(
+        name='{name}_metrics'.format(name=name),
+        path='%s_metrics' % path,
+        description="Metrics in Prometheus text format")
     hello.add_view('GET', service.hello)
     template.add_view('PUT', service.put,
                       validators=(diecutter.validators.token_validator,))
     template.add_view('GET', service.get)
     template.add_view('POST', service.post)
+    manifest.add_view('POST', service.manifest)
+    stats.add_view('GET', service.stats)
+    metrics.add_view('GET', service.metrics)
+    config.include('diecutter.stats')
+    config.include('diecutter.metrics')
     cornice.register_service_views(config, hello)
+    # Register before template, since template's path matches everything.
+    cornice.register_service_views(config, manifest)
+    cornice.register_service_views(config, stats)
+    cornice.register_service_views(config, metrics)
     cornice.register_service_views(config, template)
     # Deprecate 'template_engine' and 'filename_template_engine' settings.
     deprecated_settings = ['diecutter.filename_template_engine',
@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 """Parse settings, set defaults."""
+from collections import Mapping, namedtuple
+import pkgutil
+
+from pyramid.exceptions import ConfigurationError
+
+from diecutter.admission import REQUEST_CLASSES, parse_limits
+from diecutter.utils.forms import to_boolean
+
 
 #: Default values for settings.
 DEFAULTS = {
@@ -9,6 +17,31 @@ DEFAULTS = {
     'diecutter.engine.django': 'piecutter.engines.django:DjangoEngine',
     'diecutter.engine.jinja2': 'piecutter.engines.jinja:Jinja2Engine',
     'diecutter.engine.filename': 'piecutter.engines.filename:FilenameEngine',
+    'diecutter.template_cache_size': 256,
+    'diecutter.bytecode_cache_dir': '',
+    'diecutter.stream_chunk_size': 64 * 1024,
+    'diecutter.render_workers': 0,
+    'diecutter.render_cache_size': 0,
+    'diecutter.coalesce_timeout': 0,
+    'diecutter.coalesce_max_size': 16 * 1024 * 1024,
+    'diecutter.admission_timeout': 30,
+    'diecutter.admission_retry_after': 1,
+    'diecutter.profile_dir': '',
+    'diecutter.profile_sample_rate': 0,
+    'diecutter.profile_keep': 100,
+    'diecutter.template_index': 'off',
+    'diecutter.template_index_interval': 2,
+    'diecutter.warmup': False,
+    'diecutter.warmup_access_log': '',
+    'diecutter.warmup_top': 100,
+    'diecutter.github.cache_size': 512 * 1024 * 1024,
+    'diecutter.github.api_url': 'https://api.github.com',
+    'diecutter.github.ref_ttl': 60,
+    'diecutter.git.repositories_dir': '',
+    'diecutter.git.cache_size': 64 * 1024 * 1024,
+    'diecutter.bundle.path': '',
+    'diecutter.bundle.overlay_dir': '',
+    'diecutter.bundle.reload_interval': 2,
 }
 
 
@@ -22,3 +55,317 @@ def normalize(settings={}):
     for key, value in DEFAULTS.items():
         normalized.setdefault(key, value)
     return normalized
+
+
+#: Prefix of settings that register template engines.
+ENGINE_PREFIX = 'diecutter.engine.'
+
+#: Prefix of settings that limit concurrent requests, by class.
+ADMISSION_PREFIX = 'diecutter.admission.'
+
+#: Supported values of ``diecutter.template_index`` setting.
+TEMPLATE_INDEX_MODES = ('off', 'on', 'poll')
+
+
+def is_importable(path):
+    """Return True if module of dotted ``path`` can be found.
+
+    Module itself is not imported, only its parent packages are.
+
+    >>> from diecutter.settings import is_importable
+    >>> is_importable('diecutter.settings:Configuration')
+    True
+    >>> is_importable('diecutter.settings.Configuration')
+    True
+    >>> is_importable('diecutter.does_not_exist:Engine')
+    False
+    >>> is_importable('does.not:Exist')
+    False
+
+    """
+    if ':' in path:
+        module = path.split(':', 1)[0]
+    else:
+        module = path.rsplit('.', 1)[0]
+    try:
+        return pkgutil.find_loader(module) is not None
+    except ImportError:
+        return False
+
+
+class EngineFactories(Mapping):
+    """Read-only dictionary of engine classes, imported on first access.
+
+    Values are dotted paths, as in ``diecutter.engine.*`` settings, or
+    classes. Template engines (Django...) can take long to import: this way,
+    only engines that are used are imported.
+
+    """
+    def __init__(self, paths):
+        #: Dotted paths (or classes), indexed by slug.
+        self.paths = dict(paths)
+        self._factories = {}
+
+    def __getitem__(self, slug):
+        try:
+            return self._factories[slug]
+        except KeyError:
+            pass
+        path = self.paths[slug]
+        if isinstance(path, basestring):
+            from pyramid.path import DottedNameResolver
+            try:
+                factory = DottedNameResolver().resolve(path)
+            except (ImportError, ValueError) as e:
+                raise ConfigurationError(
+                    'Cannot import engine "{slug}" from "{path}": {error}'
+                    .format(slug=slug, path=path, error=e))
+        else:
+            factory = path
+        self._factories[slug] = factory  # Atomic, idempotent.
+        return factory
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class Configuration(namedtuple('Configuration', ['settings',
+                                                 'template_dir',
+                                                 'engine',
+                                                 'filename_engine',
+                                                 'engines',
+                                                 'engine_slugs',
+                                                 'readonly',
+                                                 'default_archive_type',
+                                                 'archive_writers',
+                                                 'template_cache_size',
+                                                 'bytecode_cache_dir',
+                                                 'stream_chunk_size',
+                                                 'render_workers',
+                                                 'render_cache_size',
+                                                 'coalesce_timeout',
+                                                 'coalesce_max_size',
+                                                 'admission_limits',
+                                                 'admission_timeout',
+                                                 'admission_retry_after',
+                                                 'profile_dir',
+                                                 'profile_sample_rate',
+                                                 'profile_keep',
+                                                 'template_index',
+                                                 'template_index_interval',
+                                                 'warmup',
+                                                 'warmup_access_log',
+                                                 'warmup_top'])):
+    """Immutable runtime configuration, resolved once from settings.
+
+    Attributes:
+
+    * ``settings``: normalized settings dictionary.
+    * ``template_dir``: value of ``diecutter.template_dir``, or ``None``.
+    * ``engine``: slug of default engine to render files.
+    * ``filename_engine``: slug of default engine to render filenames.
+    * ``engines``: dictionary of engine classes, indexed by slug. Default
+      engines are imported by :py:func:`configure`, others on first access,
+      see :py:class:`EngineFactories`.
+    * ``engine_slugs``: sorted tuple of supported engine slugs.
+    * ``readonly``: boolean, whether PUT is forbidden.
+    * ``default_archive_type``: MIME type used when client accepts ``*/*``.
+    * ``archive_writers``: dictionary of directory writers (lists), indexed
+      by MIME type. Includes ``*/*``.
+    * ``template_cache_size``: maximum number of compiled templates.
+    * ``bytecode_cache_dir``: directory of Jinja2 bytecode cache, or ``''``.
+    * ``stream_chunk_size``: size of chunks when streaming single files.
+    * ``render_workers``: number of processes rendering files of
+      directories.
+    * ``render_cache_size``: maximum size of rendered responses cache, in
+      bytes.
+    * ``coalesce_timeout``: maximum time identical concurrent renders wait
+      for the first one, in seconds. ``0`` disables coalescing.
+    * ``coalesce_max_size``: maximum size of bodies shared by coalesced
+      renders, in bytes.
+    * ``admission_limits``: dictionary of ``(limit, queue)`` of concurrent
+      requests, indexed by request class. See :py:mod:`diecutter.admission`.
+    * ``admission_timeout``: maximum time requests wait in admission queues,
+      in seconds.
+    * ``admission_retry_after``: ``Retry-After`` of rejected requests, in
+      seconds.
+    * ``profile_dir``: directory where profiles are saved, or ``''``.
+    * ``profile_sample_rate``: profile one in ``profile_sample_rate``
+      requests, ``0`` disables sampling.
+    * ``profile_keep``: maximum number of profiles in ``profile_dir``.
+    * ``template_index``: "off", "on" (watch with inotify if available) or
+      "poll".
+    * ``template_index_interval``: delay between scans of template directory
+      when polling, in seconds.
+    * ``warmup``: boolean, whether templates are compiled at startup.
+    * ``warmup_access_log``: access log whose most requested paths are
+      compiled at startup, or ``''`` to compile all templates.
+    * ``warmup_top``: number of paths read from ``warmup_access_log``.
+
+    Dictionaries must not be modified once configuration is built.
+
+    """
+
+
+def configure(settings={}):
+    """Return :py:class:`Configuration` built from ``settings``.
+
+    Settings are normalized first. Raise
+    :py:class:`~pyramid.exceptions.ConfigurationError` if some setting is
+    invalid.
+
+    """
+    from diecutter.writers import ARCHIVE_WRITERS
+    settings = normalize(settings)
+    engine_paths = {}
+    for key, value in settings.items():
+        if key.startswith(ENGINE_PREFIX):
+            slug = key[len(ENGINE_PREFIX):]
+            if isinstance(value, basestring) and not is_importable(value):
+                raise ConfigurationError(
+                    'Cannot import engine "{slug}" from "{path}".'
+                    .format(slug=slug, path=value))
+            engine_paths[slug] = value
+    engines = EngineFactories(engine_paths)
+    for key in ['diecutter.engine', 'diecutter.filename_engine']:
+        if settings[key] not in engines:
+            raise ConfigurationError(
+                'Setting {key} is "{value}", which is not a supported engine. '
+                'Supported engines are: {supported}'.format(
+                    key=key,
+                    value=settings[key],
+                    supported=', '.join(sorted(engines.keys()))))
+        # Default engines are used by every request: import them now, so
+        # that typos in their paths fail at startup.
+        engines[settings[key]]
+    archive_writers = dict(ARCHIVE_WRITERS)
+    default_archive_type = settings.get('diecutter.default_archive_type',
+                                        'application/gzip')
+    if default_archive_type not in archive_writers:
+        raise ConfigurationError(
+            'Cannot use "{type}" as "default_archive_type". Supported '
+            'types are: {supported}'.format(
+                type=default_archive_type,
+                supported=','.join(sorted(archive_writers.keys()))))
+    archive_writers['*/*'] = archive_writers[default_archive_type]
+    try:
+        readonly = to_boolean(settings.get('diecutter.readonly', False))
+    except ValueError as e:
+        raise ConfigurationError(
+            'Invalid boolean for diecutter.readonly: "{value}"'.format(
+                value=e))
+    try:
+        warmup = to_boolean(settings['diecutter.warmup'])
+    except ValueError as e:
+        raise ConfigurationError(
+            'Invalid boolean for diecutter.warmup: "{value}"'.format(
+                value=e))
+    template_cache_size = to_integer(settings,
+                                     'diecutter.template_cache_size')
+    stream_chunk_size = to_integer(settings, 'diecutter.stream_chunk_size')
+    render_workers = to_integer(settings, 'diecutter.render_workers')
+    render_cache_size = to_integer(settings, 'diecutter.render_cache_size')
+    coalesce_timeout = to_float(settings, 'diecutter.coalesce_timeout')
+    coalesce_max_size = to_integer(settings, 'diecutter.coalesce_max_size')
+    admission_limits = {}
+    for key, value in settings.items():
+        if key.startswith(ADMISSION_PREFIX):
+            request_class = key[len(ADMISSION_PREFIX):]
+            if request_class not in REQUEST_CLASSES:
+                raise ConfigurationError(
+                    'Unknown request class in {key}. Supported classes '
+                    'are: {supported}'.format(
+                        key=key, supported=', '.join(REQUEST_CLASSES)))
+            if not str(value).strip():
+                continue
+            try:
+                admission_limits[request_class] = parse_limits(value)
+            except ValueError:
+                raise ConfigurationError(
+                    'Invalid value for {key}: "{value}". Use "LIMIT" or '
+                    '"LIMIT QUEUE".'.format(key=key, value=value))
+    admission_timeout = to_integer(settings, 'diecutter.admission_timeout')
+    admission_retry_after = to_integer(settings,
+                                       'diecutter.admission_retry_after')
+    profile_sample_rate = to_integer(settings,
+                                     'diecutter.profile_sample_rate')
+    profile_keep = to_integer(settings, 'diecutter.profile_keep')
+    template_index = settings['diecutter.template_index']
+    if template_index not in TEMPLATE_INDEX_MODES:
+        raise ConfigurationError(
+            'Invalid value for diecutter.template_index: "{value}". '
+            'Supported values are: {supported}'.format(
+                value=template_index,
+                supported=', '.join(TEMPLATE_INDEX_MODES)))
+    template_index_interval = to_integer(settings,
+                                         'diecutter.template_index_interval')
+    warmup_top = to_integer(settings, 'diecutter.warmup_top')
+    return Configuration(
+        settings=settings,
+        template_dir=settings.get('diecutter.template_dir'),
+        engine=settings['diecutter.engine'],
+        filename_engine=settings['diecutter.filename_engine'],
+        engines=engines,
+        engine_slugs=tuple(sorted(engines.keys())),
+        readonly=readonly,
+        default_archive_type=default_archive_type,
+        archive_writers=archive_writers,
+        template_cache_size=template_cache_size,
+        bytecode_cache_dir=settings['diecutter.bytecode_cache_dir'],
+        stream_chunk_size=stream_chunk_size,
+        render_workers=render_workers,
+        render_cache_size=render_cache_size,
+        coalesce_timeout=coalesce_timeout,
+        coalesce_max_size=coalesce_max_size,
+        admission_limits=admission_limits,
+        admission_timeout=admission_timeout,
+        admission_retry_after=admission_retry_after,
+        profile_dir=settings['diecutter.profile_dir'],
+        profile_sample_rate=profile_sample_rate,
+        profile_keep=profile_keep,
+        template_index=template_index,
+        template_index_interval=template_index_interval,
+        warmup=warmup,
+        warmup_access_log=settings['diecutter.warmup_access_log'],
+        warmup_top=warmup_top)
+
+
+def to_integer(settings, key):
+    """Return integer value of ``settings[key]``, or raise ConfigurationError.
+    """
+    try:
+        return int(settings[key])
+    except ValueError:
+        raise ConfigurationError(
+            'Invalid integer for {key}: "{value}"'.format(
+                key=key, value=settings[key]))
+
+
+def to_float(settings, key):
+    """Return float value of ``settings[key]``, or raise ConfigurationError.
+    """
+    try:
+        return float(settings[key])
+    except ValueError:
+        raise ConfigurationError(
+            'Invalid number for {key}: "{value}"'.format(
+                key=key, value=settings[key]))
+
+
+def get_configuration(request):
+    """Return :py:class:`Configuration` attached to request's registry.
+
+    :py:func:`diecutter.wsgi.for_paste` attaches configuration to registry as
+    ``diecutter_configuration``. If missing, configuration is built from
+    request's settings, then attached to registry, so that it is built once.
+
+    """
+    registry = request.registry
+    configuration = getattr(registry, 'diecutter_configuration', None)
+    if not isinstance(configuration, Configuration):
+        configuration = configure(registry.settings or {})
+        registry.diecutter_configuration = configuration
+    return configuration
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Coalescing of identical concurrent renders ("single flight").
+
+When several requests with the same render key (see
+:py:meth:`diecutter.service.Service.get_render_key`) arrive at the same time,
+the first one renders, the others wait for its body then send a copy of it.
+
+Waiting requests give up after ``timeout`` seconds and render on their own.
+They also do if the first render fails, or if its body is bigger than
+``max_bytes``.
+
+"""
+import threading
+import time
+
+from diecutter.rendercache import CachedResponse, shared_headers
+from diecutter.utils.http import ClosingIterator
+
+
+class Flight(object):
+    """Render in progress. Followers wait for :py:attr:`result`."""
+    def __init__(self, started):
+        #: Time when leader started rendering.
+        self.started = started
+        #: :py:class:`~diecutter.rendercache.CachedResponse`, or ``None`` if
+        #: render failed. Available once :py:attr:`done` is set.
+        self.result = None
+        #: :py:class:`threading.Event`, set when render is over.
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """Registry of in-flight renders, indexed by render key."""
+    def __init__(self, timeout, max_bytes, clock=time.time):
+        #: Maximum time followers wait for leader, in seconds.
+        self.timeout = timeout
+        #: Maximum size of shared bodies, in bytes.
+        self.max_bytes = max_bytes
+        #: Function that returns current time, in seconds.
+        self.clock = clock
+        #: Number of requests served with body of another request.
+        self.hits = 0
+        #: Number of requests that rendered on their own.
+        self.misses = 0
+        #: Number of followers that gave up waiting.
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return ``(flight, is_leader)`` for ``key``.
+
+        Leader must call :py:meth:`lead`, or :py:meth:`land` on error.
+        Flights older than :py:attr:`timeout` are replaced, so that a leader
+        which never lands, e.g. because its response was not iterated, does
+        not block next requests.
+
+        """
+        now = self.clock()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or now - flight.started > self.timeout:
+                flight = self._flights[key] = Flight(now)
+                self.misses += 1
+                return flight, True
+            return flight, False
+
+    def wait(self, flight):
+        """Wait for ``flight``, return its result or ``None``.
+
+        ``None`` means caller has to render on its own.
+
+        """
+        flight.done.wait(self.timeout)
+        with self._lock:
+            if flight.result is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if not flight.done.is_set():
+                    self.timeouts += 1
+        return flight.result
+
+    def land(self, key, flight, result=None):
+        """Publish ``result`` of ``flight`` and wake followers up."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.done.set()
+
+    def lead(self, key, flight, response):
+        """Arrange for ``response``'s body to be shared once generated.
+
+        Only successful responses are shared. Response's ``app_iter`` is
+        wrapped, ``Content-Length`` header is preserved.
+
+        """
+        if response.status_int != 200:
+            self.land(key, flight)
+            return response
+        content_length = response.content_length
+        response.app_iter = self.tee(key, flight, response.status,
+                                     shared_headers(response),
+                                     response.app_iter)
+        response.content_length = content_length
+        return response
+
+    def tee(self, key, flight, status, headers, app_iter):
+        """Return iterator over ``app_iter``, whose items are shared at the
+        end.
+
+        Flight lands when iterator is exhausted or closed, even if it is
+        never iterated (HEAD requests, client disconnects...).
+
+        """
+        state = {'chunks': [], 'size': 0, 'complete': False}
+
+        def copy():
+            for chunk in app_iter:
+                if state['chunks'] is not None:
+                    state['size'] += len(chunk)
+                    if state['size'] > self.max_bytes:
+                        state['chunks'] = None  # Too big, followers render.
+                        self.land(key, flight)
+                    else:
+                        state['chunks'].append(chunk)
+                yield chunk
+            state['complete'] = True
+
+        def share(size):
+            try:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            finally:
+                if not flight.done.is_set():
+                    result = None
+                    if state['complete'] and state['chunks'] is not None:
+                        result = CachedResponse(
+                            status=status, headers=headers,
+                            body=''.join(state['chunks']))
+                    self.land(key, flight, result)
+        return ClosingIterator(copy(), share)
+
+    def info(self):
+        """Return dictionary of statistics."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'timeouts': self.timeouts,
+                    'size': len(self._flights)}
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Per-stage timings of requests: Server-Timing header and histograms.
+
+Services and writers time stages of requests with :py:func:`get_timings`,
+either as blocks (``with timings.timer('engine'): ...``) or as iterators
+(:py:func:`timed_iter`), since renders are streamed. Nested timers are
+exclusive, i.e. time spent in "render" is not counted in "archive".
+
+:py:func:`timing_tween_factory` sends timings of stages which happened before
+response started as ``Server-Timing`` header. Once response has been sent,
+timings are collected in :py:class:`Stats` histograms.
+
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from diecutter.utils.http import call_after
+
+
+#: Upper bounds of histogram buckets, in milliseconds.
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Timings(object):
+    """Durations of stages of one request.
+
+    >>> from diecutter.stats import Timings
+    >>> clock = iter([0.0, 1.0, 1.5, 3.0]).next
+    >>> timings = Timings(clock=clock)
+    >>> with timings.timer('archive'):
+    ...     with timings.timer('render'):
+    ...         pass
+    >>> timings.durations['archive'], timings.durations['render']
+    (2.5, 0.5)
+
+    """
+    def __init__(self, clock=time.time):
+        #: Callable that returns current time.
+        self.clock = clock
+        #: Total durations in seconds, indexed by stage, in order of
+        #: appearance.
+        self.durations = OrderedDict()
+        #: Time spent in nested timers, for each running timer.
+        self._nested = []
+
+    def add(self, stage, duration):
+        """Add ``duration`` (seconds) to ``stage``."""
+        self.durations[stage] = self.durations.get(stage, 0) + duration
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager that adds duration of block to ``stage``.
+
+        Time spent in nested timers is not counted.
+
+        """
+        start = self.clock()
+        self._nested.append(0)
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - start
+            nested = self._nested.pop()
+            self.add(stage, elapsed - nested)
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def header(self):
+        """Return value of ``Server-Timing`` header.
+
+        >>> from diecutter.stats import Timings
+        >>> timings = Timings()
+        >>> timings.add('context', 0.0012)
+        >>> timings.add('render', 0.5)
+        >>> timings.header()
+        'context;dur=1.200, render;dur=500.000'
+
+        """
+        return ', '.join('{stage};dur={ms:.3f}'.format(stage=stage,
+                                                       ms=duration * 1000)
+                         for stage, duration in self.durations.items())
+
+
+def get_timings(request):
+    """Return :py:class:`Timings` of ``request``, created on first call."""
+    if not hasattr(request, 'cache'):
+        request.cache = {}
+    try:
+        return request.cache['diecutter_timings']
+    except KeyError:
+        timings = request.cache['diecutter_timings'] = Timings()
+        return timings
+
+
+def timed_iter(iterable, timings, stage):
+    """Generate items of ``iterable``, adding time spent in it to ``stage``.
+    """
+    iterator = iter(iterable)
+    while True:
+        with timings.timer(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class Histogram(object):
+    """Distribution of durations, with fixed buckets in milliseconds.
+
+    >>> from diecutter.stats import Histogram
+    >>> histogram = Histogram(buckets=(10, 100))
+    >>> for duration in (0.005, 0.05, 0.5):
+    ...     histogram.observe(duration)
+    >>> histogram.snapshot()['buckets']
+    [[10, 1], [100, 2], ['+Inf', 3]]
+
+    """
+    def __init__(self, buckets=BUCKETS):
+        #: Upper bounds of buckets, in milliseconds.
+        self.bounds = tuple(buckets)
+        #: Number of observations in each bucket (not cumulative), plus one
+        #: for values above last bound.
+        self.counts = [0] * (len(self.bounds) + 1)
+        #: Number of observations.
+        self.count = 0
+        #: Sum of observations, in milliseconds.
+        self.sum = 0.0
+
+    def observe(self, duration):
+        """Add ``duration`` (seconds)."""
+        milliseconds = duration * 1000
+        index = len(self.bounds)
+        for position, bound in enumerate(self.bounds):
+            if milliseconds <= bound:
+                index = position
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += milliseconds
+
+    def snapshot(self):
+        """Return dictionary with count, sum and cumulative buckets."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets.append([bound, total])
+        return OrderedDict((('count', self.count),
+                            ('sum_ms', round(self.sum, 3)),
+                            ('buckets', buckets)))
+
+
+class Stats(object):
+    """Histograms of stage durations, shared by requests (thread-safe)."""
+    def __init__(self, buckets=BUCKETS):
+        #: Upper bounds of buckets, in milliseconds.
+        self.buckets = buckets
+        #: :py:class:`Histogram` instances, indexed by stage.
+        self.histograms = OrderedDict()
+        #: Number of recorded requests.
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def record(self, timings):
+        """Add durations of :py:class:`Timings` instance."""
+        with self._lock:
+            self.requests += 1
+            for stage, duration in timings.durations.items():
+                try:
+                    histogram = self.histograms[stage]
+                except KeyError:
+                    histogram = self.histograms[stage] = Histogram(
+                        self.buckets)
+                histogram.observe(duration)
+
+    def snapshot(self):
+        """Return dictionary of statistics, ready for JSON."""
+        with self._lock:
+            return OrderedDict((
+                ('requests', self.requests),
+                ('stages', OrderedDict(
+                    (stage, histogram.snapshot())
+                    for stage, histogram in self.histograms.items())),
+            ))
+
+
+def get_stats(request):
+    """Return :py:class:`Stats` of application, or ``None``."""
+    return getattr(request.registry, 'diecutter_stats', None)
+
+
+def timing_tween_factory(handler, registry):
+    """Pyramid tween which sends and collects timings of requests."""
+    stats = registry.diecutter_stats
+
+    def timing_tween(request):
+        timings = get_timings(request)
+        start = timings.clock()
+        response = handler(request)
+        if timings.durations:
+            response.headers['Server-Timing'] = timings.header()
+
+        def record(size):
+            timings.add('total', timings.clock() - start)
+            stats.record(timings)
+        return call_after(response, record)
+    return timing_tween
+
+
+def includeme(config):
+    """Setup timings and statistics in Pyramid ``config``."""
+    if getattr(config.registry, 'diecutter_stats', None) is None:
+        config.registry.diecutter_stats = Stats()
+        config.add_tween('diecutter.stats.timing_tween_factory')
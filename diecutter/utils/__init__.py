@@ -2,9 +2,13 @@
 """Utilities that could be packaged in separate project."""
 from diecutter.utils import dispatchers
 from diecutter.utils.forms import to_boolean
-from diecutter.utils.http import accepted_types
+from diecutter.utils.http import accepted_types, call_after, \
+    is_conditional, is_not_modified
 
 
 __all__ = ['dispatchers',
            'to_boolean',
-           'accepted_types']
+           'accepted_types',
+           'call_after',
+           'is_conditional',
+           'is_not_modified']
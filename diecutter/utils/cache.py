@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Caches."""
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe mapping that keeps at most ``max_size`` items.
+
+    Least recently used items are evicted first.
+
+    >>> from diecutter.utils.cache import LRUCache
+    >>> cache = LRUCache(max_size=2)
+    >>> cache.get_or_set('a', lambda: 'A')
+    'A'
+    >>> cache.get_or_set('b', lambda: 'B')
+    'B'
+    >>> cache.get_or_set('a', lambda: 'not called')
+    'A'
+    >>> cache.get_or_set('c', lambda: 'C')  # Evicts 'b'.
+    'C'
+    >>> 'b' in cache
+    False
+    >>> sorted(cache.info().items())
+    [('hits', 1), ('max_size', 2), ('misses', 3), ('size', 2)]
+
+    A ``max_size`` of ``0`` disables the cache: values are computed every
+    time. A ``max_size`` of ``None`` means no limit on number of items.
+
+    Cache can also be bounded by total size of values, with ``max_bytes``.
+    Size of values is computed by ``sizeof`` callable. Values bigger than
+    ``max_bytes`` are not stored.
+
+    >>> cache = LRUCache(max_size=None, max_bytes=10)
+    >>> cache.set('a', '12345')
+    >>> cache.set('b', '1234')
+    >>> cache.set('c', '123')  # Evicts 'a'.
+    >>> 'a' in cache, cache.bytes
+    (False, 7)
+    >>> cache.set('d', '12345678901')  # Too big.
+    >>> 'd' in cache
+    False
+
+    """
+    def __init__(self, max_size=128, max_bytes=None, sizeof=len):
+        #: Maximum number of items, or ``None``.
+        self.max_size = max_size
+        #: Maximum total size of items, or ``None``.
+        self.max_bytes = max_bytes
+        #: Callable that returns size of values.
+        self.sizeof = sizeof
+        #: Number of lookups that found a value.
+        self.hits = 0
+        #: Number of lookups that had to compute a value.
+        self.misses = 0
+        #: Total size of values, if ``max_bytes`` is set.
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        """Return value for ``key`` (marked as recently used) or default."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store ``value`` for ``key``, evicting old items if necessary."""
+        if self.max_size is not None and self.max_size <= 0:
+            return
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_bytes:
+                return
+        with self._lock:
+            self._discard(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            while (self.max_size is not None
+                   and len(self._data) > self.max_size) \
+                    or (self.max_bytes is not None
+                        and self.bytes > self.max_bytes):
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        """Remove ``key`` if present. Caller must hold lock."""
+        if key in self._data:
+            del self._data[key]
+            self.bytes -= self._sizes.pop(key)
+
+    def get_or_set(self, key, factory):
+        """Return value for ``key``, computing it with ``factory()`` on miss.
+
+        ``factory`` is called outside the lock, so that slow computations do
+        not block other threads. Exceptions raised by ``factory`` are not
+        cached.
+
+        """
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        """Remove all items and reset counters."""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.hits = 0
+            self.misses = 0
+            self.bytes = 0
+
+    def info(self):
+        """Return dictionary of statistics about cache usage."""
+        with self._lock:
+            info = {'hits': self.hits,
+                    'misses': self.misses,
+                    'max_size': self.max_size,
+                    'size': len(self._data)}
+            if self.max_bytes is not None:
+                info['max_bytes'] = self.max_bytes
+                info['bytes'] = self.bytes
+            return info
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Compute fingerprints of templates and contexts."""
+import hashlib
+import json
+import os
+
+
+def context_hash(context):
+    """Return hexadecimal digest of ``context``, independent of keys order.
+
+    >>> from diecutter.utils.fingerprints import context_hash
+    >>> context_hash({'a': 1, 'b': [u'x']}) == context_hash({'b': ['x'],
+    ...                                                      'a': 1})
+    True
+    >>> context_hash({'a': 1}) == context_hash({'a': 2})
+    False
+
+    Values that cannot be serialized as JSON (dates...) are represented as
+    strings.
+
+    """
+    canonical = json.dumps(context, sort_keys=True, separators=(',', ':'),
+                           default=repr)
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def file_version(path):
+    """Return ``(mtime, size)`` of file at ``path``, or ``None``."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def tree_info(path):
+    """Return ``(version, mtime)`` of template at ``path``.
+
+    Return ``(None, None)`` if ``path`` does not exist.
+
+    ``version`` is an hexadecimal digest. For files, it depends on
+    modification time and size. For directories, it depends on names,
+    modification times and sizes of all files inside, recursively.
+
+    ``mtime`` is the most recent modification time.
+
+    """
+    if not os.path.isdir(path):
+        version = file_version(path)
+        if version is None:
+            return (None, None)
+        return (hashlib.sha1(repr(version)).hexdigest(), version[0])
+    digest = hashlib.sha1()
+    mtime = os.stat(path).st_mtime
+    for root, dirs, files in os.walk(path, topdown=True):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            version = file_version(file_path)
+            digest.update(repr((os.path.relpath(file_path, path), version)))
+            if version is not None:
+                mtime = max(mtime, version[0])
+    return (digest.hexdigest(), mtime)
+
+
+def tree_version(path):
+    """Return hexadecimal digest of template at ``path``, or ``None``.
+
+    See :py:func:`tree_info`.
+
+    """
+    return tree_info(path)[0]
+
+
+def etag(*parts):
+    """Return strong entity tag (without quotes) for ``parts``.
+
+    >>> from diecutter.utils.fingerprints import etag
+    >>> etag('path', 'version') == etag('path', 'version')
+    True
+    >>> etag('path', 'version') == etag('path', 'other-version')
+    False
+
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
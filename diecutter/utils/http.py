@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 """Tools around webob requests."""
+from datetime import datetime
+
 from webob.acceptparse import MIMENilAccept
+from webob.datetime_utils import UTC
 
 
 def accepted_types(request):
@@ -8,3 +11,100 @@ def accepted_types(request):
     if isinstance(request.accept, MIMENilAccept):  # Not explicitely requested.
         return ['*/*']  # Default.
     return [item for item in request.accept]
+
+
+def is_conditional(request):
+    """Return True if request has ``If-None-Match`` or ``If-Modified-Since``
+    header."""
+    return 'If-None-Match' in request.headers \
+        or 'If-Modified-Since' in request.headers
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """Return True if request's conditional headers match resource's state.
+
+    ``If-None-Match`` is checked against ``etag``. If absent,
+    ``If-Modified-Since`` is checked against ``last_modified``, a timestamp
+    or timezone-aware datetime. ``last_modified`` should be ``None`` for
+    representations that do not only depend on modification time.
+
+    """
+    if 'If-None-Match' in request.headers:
+        return etag in request.if_none_match
+    if last_modified is not None and request.if_modified_since is not None:
+        if not isinstance(last_modified, datetime):
+            last_modified = datetime.fromtimestamp(int(last_modified), UTC)
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def call_after(response, callback):
+    """Arrange for ``callback(size)`` to be called once body has been sent.
+
+    ``size`` is the number of bytes generated by ``response``'s
+    ``app_iter``. ``callback`` is also called if client disconnects.
+    ``Content-Length`` header is preserved.
+
+    """
+    content_length = response.content_length
+    response.app_iter = iter_then(response.app_iter, callback)
+    response.content_length = content_length
+    return response
+
+
+def iter_then(app_iter, callback):
+    """Return iterable over ``app_iter``, which calls ``callback(size)``.
+
+    ``callback`` is called once, when ``app_iter`` is exhausted or when
+    returned iterable is closed, whichever comes first. WSGI servers close
+    bodies even if they do not iterate them, e.g. on client disconnect.
+
+    >>> from diecutter.utils.http import iter_then
+    >>> def callback(size):
+    ...     print 'size:', size
+    >>> list(iter_then(['a', 'bc'], callback))
+    size: 3
+    ['a', 'bc']
+    >>> iter_then(['a', 'bc'], callback).close()
+    size: 0
+
+    """
+    return ClosingIterator(app_iter, callback)
+
+
+class ClosingIterator(object):
+    """Iterator over WSGI ``app_iter``, see :py:func:`iter_then`."""
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+        #: Number of bytes generated so far.
+        self.size = 0
+        self._iterator = None
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iterator is None:
+            self._iterator = iter(self.app_iter)
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+        self.size += len(item)
+        return item
+
+    __next__ = next
+
+    def close(self):
+        """Close ``app_iter`` and call ``callback``, once."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.callback(self.size)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Write ZIP archives as a stream, i.e. without seeking.
+
+Standard library's :py:mod:`zipfile` needs a seekable file, because it writes
+sizes and CRC in local file headers once data has been written. This module
+uses data descriptors instead: sizes and CRC are written after file data.
+Entries use ZIP64 extensions, so that neither file sizes nor archive size are
+limited to 4GB.
+
+"""
+import struct
+import time
+import zlib
+
+
+#: Size of blocks given to compressor, in bytes.
+BLOCK_SIZE = 64 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+VERSION = 45  # ZIP64 requires version 4.5.
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+DEFLATED = 8
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR = struct.Struct('<IIQQ')
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+ZIP64_END = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_SIGNATURE = 0x06064b50
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+ZIP64_LOCATOR_SIGNATURE = 0x07064b50
+END = struct.Struct('<IHHHHIIH')
+END_SIGNATURE = 0x06054b50
+
+
+def dos_datetime(timestamp):
+    """Return (date, time) tuple in MS-DOS format for ``timestamp``."""
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    dos_date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_date, dos_time
+
+
+def zip64_extra(*values):
+    """Return ZIP64 "extended information" extra field holding ``values``."""
+    return struct.pack('<HH', 0x0001, 8 * len(values)) \
+        + struct.pack('<%dQ' % len(values), *values)
+
+
+def encode_filename(filename):
+    """Return (bytes, flags) for ``filename``."""
+    if isinstance(filename, unicode):
+        encoded = filename.encode('utf-8')
+    else:
+        encoded = filename
+    try:
+        encoded.decode('ascii')
+    except UnicodeDecodeError:
+        return encoded, FLAG_UTF8
+    return encoded, 0
+
+
+def iter_blocks(content_generator, block_size=BLOCK_SIZE):
+    """Generate blocks of at most ``block_size`` bytes from generator."""
+    for chunk in content_generator:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        for start in xrange(0, len(chunk), block_size):
+            yield chunk[start:start + block_size]
+
+
+def zip_stream(directory_content, mtime=None, compresslevel=6):
+    """Generate chunks of a ZIP archive built from ``directory_content``.
+
+    ``directory_content`` is an iterable of ``(filename, content_generator)``
+    items, as :py:meth:`piecutter.resources.DirResource.render` output.
+
+    Each entry is written as soon as its content generator is exhausted:
+    memory usage does not depend on the number of files.
+
+    >>> from StringIO import StringIO
+    >>> import zipfile
+    >>> content = [('hello.txt', ['Hello ', 'world']), ('empty.txt', [])]
+    >>> archive = zipfile.ZipFile(StringIO(''.join(zip_stream(content))))
+    >>> archive.testzip() is None
+    True
+    >>> archive.namelist()
+    ['hello.txt', 'empty.txt']
+    >>> archive.read('hello.txt')
+    'Hello world'
+
+    """
+    if mtime is None:
+        mtime = time.time()
+    dos_date, dos_time = dos_datetime(mtime)
+    offset = 0
+    entries = []
+    for filename, content_generator in directory_content:
+        name, flags = encode_filename(filename)
+        flags |= FLAG_DATA_DESCRIPTOR
+        extra = zip64_extra(0, 0)
+        header = LOCAL_HEADER.pack(
+            LOCAL_HEADER_SIGNATURE, VERSION, flags, DEFLATED,
+            dos_time, dos_date, 0, ZIP64_LIMIT, ZIP64_LIMIT,
+            len(name), len(extra)) + name + extra
+        header_offset = offset
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        # Content is rendered when iterating, so header is sent along with
+        # first data block, i.e. once rendering succeeded.
+        chunks = [header]
+        for block in iter_blocks(content_generator):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            compressed = compressor.compress(block)
+            if compressed:
+                compressed_size += len(compressed)
+                chunks.append(compressed)
+            if chunks:
+                data = ''.join(chunks)
+                offset += len(data)
+                yield data
+                chunks = []
+        crc &= 0xFFFFFFFF
+        compressed = compressor.flush()
+        compressed_size += len(compressed)
+        chunks.append(compressed)
+        chunks.append(DATA_DESCRIPTOR.pack(
+            DATA_DESCRIPTOR_SIGNATURE, crc, compressed_size, size))
+        data = ''.join(chunks)
+        offset += len(data)
+        yield data
+        entries.append((name, flags, crc, compressed_size, size,
+                        header_offset))
+    # Central directory.
+    central_offset = offset
+    chunks = []
+    for name, flags, crc, compressed_size, size, header_offset in entries:
+        zip64_values = []
+        if size >= ZIP64_LIMIT:
+            zip64_values.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            zip64_values.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if header_offset >= ZIP64_LIMIT:
+            zip64_values.append(header_offset)
+            header_offset = ZIP64_LIMIT
+        extra = zip64_extra(*zip64_values) if zip64_values else ''
+        chunks.append(CENTRAL_HEADER.pack(
+            CENTRAL_HEADER_SIGNATURE, 3 << 8 | VERSION, VERSION, flags,
+            DEFLATED, dos_time, dos_date, crc, compressed_size, size,
+            len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+            header_offset) + name + extra)
+    central = ''.join(chunks)
+    central_size = len(central)
+    count = len(entries)
+    end_offset = central_offset + central_size
+    # End of central directory, with ZIP64 records if necessary.
+    if count >= ZIP64_COUNT_LIMIT or central_offset >= ZIP64_LIMIT \
+            or central_size >= ZIP64_LIMIT:
+        central += ZIP64_END.pack(
+            ZIP64_END_SIGNATURE, ZIP64_END.size - 12, 3 << 8 | VERSION,
+            VERSION, 0, 0, count, count, central_size, central_offset)
+        central += ZIP64_LOCATOR.pack(
+            ZIP64_LOCATOR_SIGNATURE, 0, end_offset, 1)
+        count = ZIP64_COUNT_LIMIT
+        central_size = ZIP64_LIMIT
+        central_offset = ZIP64_LIMIT
+    central += END.pack(END_SIGNATURE, 0, 0, count, count, central_size,
+                        central_offset, 0)
+    yield central
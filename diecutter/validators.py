@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
+def get_token(request):
+    """Return reference token, i.e. ``diecutter.token`` setting."""
+    return request.registry.settings.get('diecutter.token', u'')
+
+
 def token_validator(request):
     default = u''
-    reference_token = request.registry.settings.get('diecutter.token', default)
+    reference_token = get_token(request)
     request_token = request.POST.get('token', default)
     if request_token != reference_token:
         request.errors.add('authentication', 'token', 'invalid token')
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Precompile templates, so that first requests do not pay for it.
+
+:py:func:`warmup` compiles templates of ``diecutter.template_dir`` with the
+engines of a service, which fills the compiled-template cache and the
+bytecode cache (see ``diecutter.bytecode_cache_dir``).
+
+Use it from command line, as ``diecutter warmup diecutter.ini``, or at startup
+with ``diecutter.warmup`` setting.
+
+"""
+from collections import Counter
+import logging
+import os
+import re
+import time
+import urllib
+import urlparse
+
+from pyramid.request import Request
+
+from piecutter.exceptions import TemplateError
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Regular expression matching request line in access logs, such as Common
+#: Log Format.
+REQUEST_LINE = re.compile(r'"(?:GET|POST|PUT) (?P<path>\S+) HTTP/[0-9.]+"')
+
+
+def template_files(template_dir, paths=None):
+    """Generate paths of files in ``template_dir``, relative to it.
+
+    If ``paths`` is given, only files matching those paths (files, or
+    directories scanned recursively) are listed, in order. Missing paths and
+    paths outside ``template_dir`` are skipped.
+
+    """
+    template_dir = os.path.normpath(os.path.abspath(template_dir))
+    if paths is None:
+        paths = ['']
+    seen = set()
+    for path in paths:
+        path = os.path.normpath(os.path.join(template_dir, path))
+        if path != template_dir and \
+                not path.startswith(template_dir + os.sep):
+            continue
+        if os.path.isfile(path):
+            found = [path]
+        else:
+            found = []
+            for directory, dirs, files in os.walk(path, topdown=True):
+                dirs.sort()
+                found.extend(os.path.join(directory, name)
+                             for name in sorted(files))
+        for file_path in found:
+            relative = os.path.relpath(file_path, template_dir)
+            if relative not in seen:
+                seen.add(relative)
+                yield relative
+
+
+def access_log_paths(lines, top=100):
+    """Return the ``top`` most requested template paths in access log.
+
+    ``lines`` is an iterable of lines, in Common Log Format or similar.
+    Returned paths have no leading slash. Reserved endpoints, such as
+    ``/_stats``, are ignored.
+
+    >>> from diecutter.warmup import access_log_paths
+    >>> access_log_paths([
+    ...     '1.2.3.4 - - [18/Oct/2014:12:00:00] "POST /a.txt HTTP/1.1" 200 5',
+    ...     '1.2.3.4 - - [18/Oct/2014:12:00:01] "POST /b/?x=1 HTTP/1.1" 200 5',
+    ...     '1.2.3.4 - - [18/Oct/2014:12:00:02] "GET /b/ HTTP/1.1" 200 5',
+    ...     '1.2.3.4 - - [18/Oct/2014:12:00:03] "GET /_stats HTTP/1.1" 200 5',
+    ...     'garbage'])
+    ['b/', 'a.txt']
+
+    """
+    counter = Counter()
+    for line in lines:
+        match = REQUEST_LINE.search(line)
+        if match is None:
+            continue
+        path = urllib.unquote(urlparse.urlsplit(match.group('path')).path)
+        path = path.lstrip('/')
+        if not path or path.startswith('_'):
+            continue
+        counter[path] += 1
+    return [item for item, count in counter.most_common(top)]
+
+
+def compile_template(engine, template):
+    """Compile ``template`` with ``engine``, if engine supports it."""
+    if getattr(engine, 'compiler', None) is not None:
+        engine.compile(template)
+
+
+def warmup(service, paths=None):
+    """Compile templates of ``service``'s template directory.
+
+    ``paths`` restricts templates, see :py:func:`template_files`.
+
+    File contents are compiled with default engine. Filenames are not: they
+    are rendered relative to the requested directory, which is not known
+    in advance.
+
+    Return dictionary with number of ``templates``, ``errors`` as a list of
+    ``(path, message)``, and ``duration`` in seconds.
+
+    """
+    start = time.time()
+    template_dir = service.configuration.template_dir
+    if not template_dir:  # Such as GithubService.
+        return {'templates': 0, 'errors': [], 'duration': 0}
+    request = Request.blank('/')
+    engine = service.get_engine(request)
+    count = 0
+    errors = []
+    for relative in template_files(template_dir, paths):
+        count += 1
+        try:
+            path = os.path.join(template_dir, relative)
+            with open(path) as template_file:
+                template = template_file.read().decode('utf-8')
+            compile_template(engine, template)
+        except (TemplateError, UnicodeDecodeError, IOError) as e:
+            errors.append((relative, str(e)))
+    return {'templates': count,
+            'errors': errors,
+            'duration': time.time() - start}
+
+
+def warmup_service(service, access_log='', top=100):
+    """Warm up ``service`` and log report. Return :py:func:`warmup` report.
+
+    If ``access_log`` is set, only the ``top`` most requested paths in this
+    file are compiled. Else all templates are.
+
+    """
+    paths = None
+    if access_log:
+        with open(access_log) as log_file:
+            paths = access_log_paths(log_file, top)
+    report = warmup(service, paths)
+    for path, message in report['errors']:
+        logger.error('Failed to compile template {path}: {message}'
+                     .format(path=path, message=message))
+    logger.info('Compiled {templates} templates in {duration:.3f}s, '
+                '{errors} errors.'.format(templates=report['templates'],
+                                          duration=report['duration'],
+                                          errors=len(report['errors'])))
+    return report
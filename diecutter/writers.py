@@ -1,37 +1,194 @@
 # -*- coding: utf-8 -*-
 """Writers: utilities that write template output as response, files..."""
+import gzip
+import itertools
 import time
 import json
 import logging
 import os
 import tarfile
-import tempfile
-import zipfile
 from cStringIO import StringIO
 
 from piecutter.exceptions import TemplateError
 
+from diecutter.settings import get_configuration
+from diecutter.stats import get_timings, timed_iter
+
+from diecutter.utils.zipstream import zip_stream
+
 
 logger = logging.getLogger(__name__)
 
 
 def file_response(request, resource, context):
-    """Render file resource against context, return plain text response."""
+    """Render file resource against context, return plain text response.
+
+    Content is streamed, in chunks of ``diecutter.stream_chunk_size`` bytes.
+    With engines that support it, chunks are sent as the template is
+    evaluated (see :py:func:`render_file`).
+
+    """
     request.response.content_type = 'text/plain'
+    chunk_size = get_configuration(request).stream_chunk_size
+    timings = get_timings(request)
     try:
-        file_generator = resource.render(context)
+        with timings.timer('render'):
+            content = render_file(resource, context)
+        content = timed_iter(content, timings, 'render')
+        file_generator = prime(coalesce(content, chunk_size))
     except TemplateError as e:
         request.response.status_int = 500
         logger.error('TemplateError caught: {error}'.format(error=e))
         request.response.write(json.dumps(str(e)))
     else:
-        file_content = ''.join(file_generator)
-        request.response.write(file_content)
+        request.response.app_iter = log_stream_errors(file_generator)
         engine_slug = request.cache['diecutter_engine_slug']
         request.response.headers['Diecutter-Engine'] = str(engine_slug)
     return request.response
 
 
+def render_file(resource, context):
+    """Return iterator over chunks of file ``resource`` rendered against
+    ``context``.
+
+    If resource's engine has a ``generate()`` method, such as
+    :py:class:`~diecutter.engines.CachedEngine`, chunks are generated as the
+    template is evaluated, so output is never held in memory as a whole.
+    Else resource is rendered at once.
+
+    """
+    generate = getattr(getattr(resource, 'engine', None), 'generate', None)
+    if generate is None:
+        return resource.render(context)
+    try:
+        return path_errors(generate(resource.read(), context), resource.path)
+    except (TemplateError, UnicodeDecodeError) as e:
+        raise TemplateError('%s: %s' % (resource.path, e))
+
+
+def path_errors(iterable, path):
+    """Generate items from ``iterable``, prefixing TemplateError with path.
+    """
+    try:
+        for item in iterable:
+            yield item
+    except (TemplateError, UnicodeDecodeError) as e:
+        raise TemplateError('%s: %s' % (path, e))
+
+
+def prime(iterable):
+    """Return iterator over ``iterable``, with first item already computed.
+
+    Use it to make errors raised before the first item happen immediately,
+    i.e. while response status can still be changed.
+
+    >>> from diecutter.writers import prime
+    >>> def generator():
+    ...     print 'Started'
+    ...     yield 1
+    ...     yield 2
+    >>> iterator = prime(generator())
+    Started
+    >>> list(iterator)
+    [1, 2]
+
+    """
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], iterator)
+
+
+def log_stream_errors(iterable):
+    """Generate items from ``iterable``, logging TemplateError.
+
+    Errors raised once response has started cannot be turned into 500
+    responses. They are logged then raised again, so that the WSGI server
+    aborts the response.
+
+    """
+    try:
+        for item in iterable:
+            yield item
+    except TemplateError as e:
+        logger.error('TemplateError caught while streaming: {error}'
+                     .format(error=e))
+        raise
+
+
+def coalesce(iterable, chunk_size):
+    """Generate chunks of ``chunk_size`` bytes from ``iterable`` of strings.
+
+    Small items are joined, big items are split. Last chunk may be smaller.
+    Unicode items are encoded as UTF-8. If ``chunk_size`` is ``0``, items are
+    generated as is.
+
+    >>> from diecutter.writers import coalesce
+    >>> list(coalesce(['a', 'bc', 'defgh', '', 'i'], 3))
+    ['abc', 'def', 'ghi']
+    >>> list(coalesce(['a', 'bc'], 0))
+    ['a', 'bc']
+
+    """
+    buffer = []
+    buffer_size = 0
+    for item in iterable:
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        if not chunk_size:
+            yield item
+            continue
+        buffer.append(item)
+        buffer_size += len(item)
+        if buffer_size >= chunk_size:
+            data = ''.join(buffer)
+            end = buffer_size - buffer_size % chunk_size
+            for start in xrange(0, end, chunk_size):
+                yield data[start:start + chunk_size]
+            buffer = [data[end:]]
+            buffer_size = len(buffer[0])
+    if buffer_size:
+        yield ''.join(buffer)
+
+
+def archive_name(resource, context):
+    """Return name of archive for ``resource``, without extension.
+
+    Resources may provide an ``archive_name(context)`` method. Else name is
+    resource's basename, rendered against context with filename engine.
+
+    """
+    if hasattr(resource, 'archive_name'):
+        return resource.archive_name(context)
+    filename = os.path.basename(resource.path.rstrip('/'))
+    return resource.filename_engine.render(filename, context)
+
+
+def archive_mtime(request):
+    """Return modification time of archive entries for ``request``.
+
+    Time is template tree's one if the service read it, so that archives with
+    an entity tag are the same bytes for the same tag. Else it is ``None``,
+    i.e. current time.
+
+    """
+    return getattr(request, 'cache', {}).get('diecutter_tree_mtime')
+
+
+def zip_directory_stream(directory_content, mtime=None):
+    """Generate chunks of a zip file built from ``directory_content``.
+
+    ``directory_content`` has the same format as
+    :py:meth:`diecutter.resources.DirResource.render` output.
+
+    Entries are dated ``mtime``, default is current time.
+
+    """
+    return zip_stream(directory_content, mtime)
+
+
 def zip_directory(directory_content):
     """Return a zip file built from iterable ``directory_contents``.
 
@@ -39,36 +196,96 @@ def zip_directory(directory_content):
     :py:meth:`diecutter.resources.DirResource.render` output.
 
     """
-    temp_file = StringIO()
-    temp_zip = zipfile.ZipFile(temp_file, 'w',
-                               compression=zipfile.ZIP_DEFLATED)
-    for filename, file_generator in directory_content:
-        file_content = ''.join(file_generator)
-        temp_zip.writestr(filename, file_content)
-    temp_zip.close()
-    return temp_file.getvalue()
+    return ''.join(zip_directory_stream(directory_content))
 
 
 def zip_directory_response(request, resource, context):
-    """Render dir resource against context, return result as zip response."""
-    filename = os.path.basename(resource.path.rstrip('/'))
-    filename = resource.filename_engine.render(filename, context)
+    """Render dir resource against context, return result as zip response.
+
+    Archive is streamed: each file is sent as soon as it is rendered.
+
+    """
+    filename = archive_name(resource, context)
 
     request.response.content_type = 'application/zip'
     request.response.content_disposition = 'attachment; filename=%s.zip' % (
         filename
     )
     try:
-        directory_generator = resource.render(context)
-        zip_content = zip_directory(directory_generator)
+        timings = get_timings(request)
+        directory_generator = timed_iter(resource.render(context), timings,
+                                         'render')
+        mtime = archive_mtime(request)
+        zip_content = prime(timed_iter(
+            zip_directory_stream(directory_generator, mtime), timings,
+            'archive'))
     except TemplateError as e:
         request.response.status_int = 500
         logger.error('TemplateError caught: {error}'.format(error=e))
         request.response.write(json.dumps(str(e)))
-    request.response.write(zip_content)
+    else:
+        request.response.app_iter = log_stream_errors(zip_content)
     return request.response
 
 
+class StreamBuffer(object):
+    """Write-only file-like object, drained by generators.
+
+    >>> from diecutter.writers import StreamBuffer
+    >>> stream = StreamBuffer()
+    >>> stream.write('Hello ')
+    >>> stream.write('world')
+    >>> stream.drain()
+    'Hello world'
+    >>> stream.drain()
+    ''
+
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        """Return data written since last call, and forget it."""
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def targz_directory_stream(directory_content, mtime=None):
+    """Generate chunks of a tar.gz file built from ``directory_content``.
+
+    ``directory_content`` has the same format as
+    :py:meth:`diecutter.resources.DirResource.render` output.
+
+    Compressed blocks are yielded as soon as files are rendered. Entries and
+    gzip header are dated ``mtime``, default is current time.
+
+    """
+    if mtime is None:
+        mtime = time.time()
+    stream = StreamBuffer()
+    compressed = gzip.GzipFile(fileobj=stream, mode='wb', mtime=mtime)
+    archive = tarfile.open(mode='w|', fileobj=compressed)
+    try:
+        for filename, file_generator in directory_content:
+            content_text = ''.join(file_generator)
+            content_file = StringIO(content_text)
+            info = tarfile.TarInfo(name=filename)
+            info.size = len(content_text)
+            info.mtime = mtime
+            archive.addfile(tarinfo=info, fileobj=content_file)
+            data = stream.drain()
+            if data:
+                yield data
+    finally:
+        archive.close()
+        compressed.close()
+    yield stream.drain()
+
+
 def targz_directory(directory_content):
     """Return a tar.gz file built from iterable ``directory_content``.
 
@@ -76,42 +293,41 @@ def targz_directory(directory_content):
     :py:meth:`diecutter.resources.DirResource.render` output.
 
     """
-    mtime = time.time()
-    with tempfile.TemporaryFile() as temporary_file:
-        try:
-            archive = tarfile.open(mode='w|gz', fileobj=temporary_file)
-            for filename, file_generator in directory_content:
-                content_text = ''.join(file_generator)
-                content_file = StringIO(content_text)
-                content_file.seek(0)
-                info = tarfile.TarInfo(name=filename)
-                info.size = len(content_text)
-                info.mtime = mtime
-                archive.addfile(tarinfo=info, fileobj=content_file)
-        finally:
-            archive.close()
-        temporary_file.seek(0)
-        return temporary_file.read()
+    return ''.join(targz_directory_stream(directory_content))
 
 
 def targz_directory_response(request, resource, context):
     """Render dir resource against context, return result as tar.gz response.
 
+    Archive is streamed: each file is sent as soon as it is rendered.
+
     """
-    filename = os.path.basename(resource.path.rstrip('/'))
-    filename = resource.filename_engine.render(filename, context)
+    filename = archive_name(resource, context)
 
     request.response.content_type = 'application/gzip'
     request.response.content_disposition = 'attachment; filename=%s.tar.gz' % (
         filename
     )
     try:
-        directory_generator = resource.render(context)
-        content = targz_directory(directory_generator)
+        timings = get_timings(request)
+        directory_generator = timed_iter(resource.render(context), timings,
+                                         'render')
+        mtime = archive_mtime(request)
+        content = prime(timed_iter(
+            targz_directory_stream(directory_generator, mtime), timings,
+            'archive'))
     except TemplateError as e:
         request.response.status_int = 500
         logger.error('TemplateError caught: {error}'.format(error=e))
         request.response.write(json.dumps(str(e)))
     else:
-        request.response.write(content)
+        request.response.app_iter = log_stream_errors(content)
     return request.response
+
+
+#: Writers for directory resources, indexed by MIME type.
+ARCHIVE_WRITERS = {
+    'application/zip': [zip_directory_response],
+    'application/gzip': [targz_directory_response],
+    'application/x-gzip': [targz_directory_response],  # Alias.
+}
@@ -24,12 +24,29 @@ def for_file(settings_file):
 
 
 def for_paste(global_config, **settings):
-    """Return WSGI application using ``global_config`` and ``settings``."""
-    settings = diecutter.settings.normalize(settings)
+    """Return WSGI application using ``global_config`` and ``settings``.
+
+    Settings are resolved once, as a
+    :py:class:`diecutter.settings.Configuration` passed to the service.
+    Invalid settings raise :py:class:`~pyramid.exceptions.ConfigurationError`
+    here, i.e. at startup.
+
+    If ``diecutter.warmup`` setting is true, templates are compiled before
+    the application is returned, see :py:mod:`diecutter.warmup`.
+
+    """
+    configuration = diecutter.settings.configure(settings)
+    settings = configuration.settings
     config = Configurator(settings=settings)
+    config.registry.diecutter_configuration = configuration
     service_factory_path = settings['diecutter.service']
     service_factory = DottedNameResolver().resolve(service_factory_path)
     service = service_factory()
+    service.configure(configuration)
+    if configuration.warmup:
+        from diecutter.warmup import warmup_service
+        warmup_service(service, configuration.warmup_access_log,
+                       configuration.warmup_top)
     config.include("cornice")  # Diecutter uses Cornice.
     diecutter.service.register_service(config, 'diecutter', service, '/')
     return config.make_wsgi_app()
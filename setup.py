@@ -43,5 +43,6 @@ if __name__ == '__main__':  # Don't run setup() when we import this module.
           install_requires=REQUIREMENTS,
           entry_points={
               'paste.app_factory': ['main = diecutter.wsgi:for_paste'],
+              'console_scripts': ['diecutter = diecutter.cli:main'],
           },
           paster_plugins=['pyramid'])
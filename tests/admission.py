@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.admission."""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pyramid.config import Configurator
+import webtest
+
+from diecutter.admission import AdmissionControl, Limiter
+from diecutter.local import LocalService
+from diecutter.service import register_service
+from diecutter.settings import configure
+from diecutter.utils.http import iter_then
+
+from tests.singleflight import SlowEngine
+
+
+class LimiterTestCase(unittest.TestCase):
+    """Tests around diecutter.admission.Limiter."""
+    def test_queue_full(self):
+        """Requests beyond limit and queue are rejected at once."""
+        limiter = Limiter(limit=1, queue=0)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        info = limiter.info()
+        self.assertEqual((info['active'], info['admitted'], info['rejected']),
+                         (1, 2, 1))
+
+    def test_timeout(self):
+        """Queued requests are rejected after timeout."""
+        limiter = Limiter(limit=1, queue=1, timeout=0.01)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        info = limiter.info()
+        self.assertEqual((info['waiting'], info['timeouts']), (0, 1))
+
+    def test_wait(self):
+        """Queued requests are admitted when a slot is released."""
+        limiter = Limiter(limit=1, queue=1, timeout=5)
+        self.assertTrue(limiter.acquire())
+        admitted = []
+        waiter = threading.Thread(
+            target=lambda: admitted.append(limiter.acquire()))
+        waiter.start()
+        while not limiter.info()['waiting']:
+            time.sleep(0.001)
+        limiter.release()
+        waiter.join()
+        self.assertEqual(admitted, [True])
+
+    def test_release_once(self):
+        """AdmissionControl's release functions release slot once."""
+        admission_control = AdmissionControl({'file': (1, 0)})
+        release = admission_control.acquire('file')
+        release()
+        release()
+        self.assertEqual(admission_control.info()['file']['active'], 0)
+        self.assertTrue(admission_control.acquire('get') is not None)
+
+
+class IterThenTestCase(unittest.TestCase):
+    """Tests around diecutter.utils.http.iter_then."""
+    def test_close(self):
+        """Callback runs when iterator is closed without being iterated."""
+        sizes = []
+        iterator = iter_then(['a', 'b'], sizes.append)
+        iterator.close()
+        iterator.close()
+        self.assertEqual(sizes, [0])
+
+
+class AdmissionServiceTestCase(unittest.TestCase):
+    """Admission control in LocalService."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.template_dir, 'hello.txt'), 'w') as f:
+            f.write('Hello +name+')
+        configuration = configure({
+            'diecutter.template_dir': self.template_dir,
+            'diecutter.engine.slow': SlowEngine,
+            'diecutter.admission.file': '1 0',
+            'diecutter.admission_retry_after': '7'})
+        self.service = LocalService()
+        self.service.configure(configuration)
+        config = Configurator(settings=configuration.settings)
+        config.registry.diecutter_configuration = configuration
+        config.include('cornice')
+        register_service(config, 'diecutter', self.service, '/')
+        self.app = webtest.TestApp(config.make_wsgi_app())
+        SlowEngine.release.clear()
+        del SlowEngine.renders[:]
+
+    def tearDown(self):
+        SlowEngine.release.set()
+        shutil.rmtree(self.template_dir)
+
+    def test_reject(self):
+        """Requests beyond limit get 503, other classes are not affected."""
+        bodies = []
+        render = threading.Thread(target=lambda: bodies.append(
+            self.app.post('/hello.txt?engine=slow', {'name': 'a'}).body))
+        render.start()
+        while not SlowEngine.renders:
+            time.sleep(0.001)
+        response = self.app.post('/hello.txt?engine=slow', {'name': 'b'},
+                                 status=503)
+        self.assertEqual(response.headers['Retry-After'], '7')
+        self.app.get('/hello.txt', status=200)
+        SlowEngine.release.set()
+        render.join()
+        self.assertEqual(bodies, ['Hello a'])
+        self.app.post('/hello.txt', {'name': 'c'}, status=200)
+        info = self.app.get('/_stats').json['admission']['file']
+        self.assertEqual((info['active'], info['admitted'], info['rejected']),
+                         (0, 2, 1))
+        metrics = self.app.get('/_metrics').body
+        self.assertIn('diecutter_admission_rejected_total{class="file",'
+                      'reason="queue_full"} 1', metrics)
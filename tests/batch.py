@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.batch."""
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+
+import webtest
+
+import diecutter.wsgi
+
+
+class BatchServiceTestCase(unittest.TestCase):
+    """Batch renders in LocalService.post()."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.template_dir, '+host+.conf'), 'w') as f:
+            f.write('host={{ host }} index={{ diecutter.index }}')
+        os.mkdir(os.path.join(self.template_dir, '+host+'))
+        hello = os.path.join(self.template_dir, '+host+', 'hello.txt')
+        with open(hello, 'w') as f:
+            f.write('Hello {{ host }}')
+        settings = {'diecutter.template_dir': self.template_dir}
+        self.app = webtest.TestApp(diecutter.wsgi.for_paste({}, **settings))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_json_array(self):
+        """POST a JSON array renders a file once per context, as archive."""
+        contexts = [{'host': 'alpha'}, {'host': 'beta'}, {'host': 'alpha'}]
+        response = self.app.post('/+host+.conf', json.dumps(contexts),
+                                 content_type='application/json',
+                                 headers={'Accept': 'application/zip'})
+        self.assertEqual(response.content_type, 'application/zip')
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'attachment; filename=batch.zip')
+        archive = zipfile.ZipFile(StringIO(response.body))
+        self.assertEqual(archive.namelist(),
+                         ['alpha.conf', 'beta.conf', '2-alpha.conf'])
+        self.assertEqual(archive.read('beta.conf'), 'host=beta index=1')
+        self.assertEqual(archive.read('2-alpha.conf'), 'host=alpha index=2')
+
+    def test_json_lines_directory(self):
+        """POST JSON lines on a directory renders one directory per context.
+        """
+        body = '{"host": "alpha"}\n{"host": "beta"}\n'
+        response = self.app.post('/+host+/', body,
+                                 content_type='application/x-ndjson')
+        archive = tarfile.open(fileobj=StringIO(response.body))
+        self.assertEqual(archive.getnames(),
+                         ['alpha/hello.txt', 'beta/hello.txt'])
+        self.assertEqual(archive.extractfile('beta/hello.txt').read(),
+                         'Hello beta')
+
+    def test_bad_request(self):
+        """Malformed JSON lines give 400 responses."""
+        self.app.post('/+host+/', '{"host": "alpha"}\n{"host"\n',
+                      content_type='application/x-ndjson', status=400)
+
+    def test_template_error(self):
+        """Errors in first render give 500 responses."""
+        with open(os.path.join(self.template_dir, 'error.txt'), 'w') as f:
+            f.write('{{ unclosed')
+        self.app.post('/error.txt', json.dumps([{}]),
+                      content_type='application/json', status=500)
+
+
+class ManifestServiceTestCase(unittest.TestCase):
+    """Manifest renders with LocalService.manifest()."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.template_dir, '+host+.conf'), 'w') as f:
+            f.write('host={{ host }}')
+        os.mkdir(os.path.join(self.template_dir, 'greetings'))
+        hello = os.path.join(self.template_dir, 'greetings', 'hello.txt')
+        with open(hello, 'w') as f:
+            f.write('Hello {{ name }}')
+        settings = {'diecutter.template_dir': self.template_dir}
+        self.app = webtest.TestApp(diecutter.wsgi.for_paste({}, **settings))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_manifest(self):
+        """POST /_manifest renders several templates as one archive."""
+        manifest = [
+            {'template_path': '+host+.conf', 'context': {'host': 'alpha'}},
+            {'template_path': '+host+.conf', 'output_name': 'etc/beta.conf',
+             'context': {'host': 'beta'}},
+            {'template_path': 'greetings/', 'output_name': 'docs',
+             'context': {'name': 'world'}},
+        ]
+        response = self.app.post('/_manifest', json.dumps(manifest),
+                                 content_type='application/json',
+                                 headers={'Accept': 'application/zip'})
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'attachment; filename=manifest.zip')
+        archive = zipfile.ZipFile(StringIO(response.body))
+        self.assertEqual(archive.namelist(),
+                         ['alpha.conf', 'etc/beta.conf', 'docs/hello.txt'])
+        self.assertEqual(archive.read('etc/beta.conf'), 'host=beta')
+        self.assertEqual(archive.read('docs/hello.txt'), 'Hello world')
+
+    def test_not_found(self):
+        """Manifests with unknown templates give 404 responses."""
+        manifest = [{'template_path': 'unknown.txt'}]
+        self.app.post('/_manifest', json.dumps(manifest),
+                      content_type='application/json', status=404)
+        manifest = [{'template_path': '../outside.txt'}]
+        self.app.post('/_manifest', json.dumps(manifest),
+                      content_type='application/json', status=404)
+
+    def test_bad_request(self):
+        """Invalid manifests give 400 responses."""
+        for manifest in [{}, [{}], [{'template_path': 'a', 'context': []}]]:
+            self.app.post('/_manifest', json.dumps(manifest),
+                          content_type='application/json', status=400)
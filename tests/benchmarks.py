@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of render and archive hot paths, with JSON output.
+
+Run from code repository's root:
+
+.. code:: sh
+
+   python tests/benchmarks.py --output var/benchmark.json
+
+Templates and contexts are synthetic, generated from command line options and
+a random seed, so that results of two versions of `diecutter` can be
+compared.
+
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+import unittest
+import urllib
+
+from pyramid import testing
+import requests
+from webob import Request
+
+from piecutter import resources
+from piecutter.engines.filename import FilenameEngine
+from piecutter.engines.jinja import Jinja2Engine
+
+import diecutter
+from diecutter import contextextractors
+from diecutter.engines import CachedEngine
+from diecutter.parallel import ParallelDirResource, render_pool
+from diecutter.settings import configure
+from diecutter.utils.cache import LRUCache
+from diecutter.writers import file_response, targz_directory, zip_directory
+
+from imports import STARTUP_MODULES, import_report
+from testserver import demo_server
+
+
+#: Words used to generate templates and contexts.
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+         'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor')
+
+
+def synthetic_context(size, rand):
+    """Return context with ``size`` variables, nested in groups of ten.
+
+    Top-level variables ``name`` and ``items`` are always set: templates of
+    :py:func:`synthetic_template` use them.
+
+    """
+    context = {'name': 'benchmark',
+               'items': [rand.choice(WORDS) for i in range(10)]}
+    for index in range(size):
+        group = context.setdefault('group{0}'.format(index // 10), {})
+        group['var{0}'.format(index)] = ' '.join(rand.sample(WORDS, 3))
+    return context
+
+
+def synthetic_template(size, rand):
+    """Return Jinja2 template of about ``size`` bytes, using variables."""
+    lines = []
+    length = 0
+    while length < size:
+        line = '{0} {{{{ name }}}} {1}\n'.format(rand.choice(WORDS),
+                                                 rand.choice(WORDS))
+        if len(lines) % 10 == 0:
+            line = ('{% for item in items %}{{ item }} {% endfor %}\n')
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+
+def synthetic_tree(root, files, depth, file_size, rand):
+    """Create ``files`` templates in ``root``, in ``depth`` nested dirs."""
+    os.makedirs(root)
+    directories = [root]
+    for level in range(depth):
+        directories.append(os.path.join(directories[-1],
+                                        'level{0}'.format(level)))
+        os.makedirs(directories[-1])
+    for index in range(files):
+        directory = directories[index % len(directories)]
+        path = os.path.join(directory, 'file{0}-+name+.txt'.format(index))
+        with open(path, 'w') as template:
+            template.write(synthetic_template(file_size, rand))
+
+
+def summarize(durations):
+    """Return statistics about ``durations`` (seconds), as a dictionary."""
+    durations = sorted(durations)
+    count = len(durations)
+
+    def percentile(rank):
+        return durations[min(count - 1, int(rank * count))]
+    return {'count': count,
+            'min': durations[0],
+            'median': percentile(0.5),
+            'p95': percentile(0.95),
+            'max': durations[-1],
+            'mean': sum(durations) / count}
+
+
+def measure(function, repeat):
+    """Call ``function`` ``repeat`` times, return statistics of durations."""
+    function()  # Warm up caches.
+    durations = []
+    for index in range(repeat):
+        start = timeit.default_timer()
+        function()
+        durations.append(timeit.default_timer() - start)
+    return summarize(durations)
+
+
+def engines():
+    """Return ``(engine, filename_engine)``, as a diecutter server uses."""
+    cache = LRUCache(max_size=256)
+    return (CachedEngine(Jinja2Engine(), cache, 'jinja2'),
+            CachedEngine(FilenameEngine(), cache, 'filename'))
+
+
+def dummy_request(settings):
+    """Return request suitable for writers."""
+    request = testing.DummyRequest()
+    request.registry.diecutter_configuration = configure(settings)
+    request.cache = {'diecutter_engine_slug': 'jinja2',
+                     'diecutter_filename_engine_slug': 'filename'}
+    return request
+
+
+def bench_writers(template_dir, contexts, options):
+    """Return results of benchmarks of writers."""
+    results = {}
+    engine, filename_engine = engines()
+    settings = {'diecutter.template_dir': template_dir}
+    file_path = os.path.join(template_dir, 'tree', 'file0-+name+.txt')
+    file_resource = resources.FileResource(
+        path=file_path, engine=engine, filename_engine=filename_engine)
+    dir_resource = resources.DirResource(
+        path=os.path.join(template_dir, 'tree') + '/', engine=engine,
+        filename_engine=filename_engine)
+    for context_name, context in contexts:
+        def render_file():
+            response = file_response(dummy_request(settings), file_resource,
+                                     dict(context))
+            for chunk in response.app_iter:
+                pass
+
+        def render_zip():
+            zip_directory(dir_resource.render(dict(context)))
+
+        def render_targz():
+            targz_directory(dir_resource.render(dict(context)))
+
+        for name, function in [('file_response', render_file),
+                               ('zip_directory', render_zip),
+                               ('targz_directory', render_targz)]:
+            key = '{0}.{1}'.format(name, context_name)
+            results[key] = measure(function, options.repeat)
+    return results
+
+
+def bench_parallel(template_dir, contexts, options):
+    """Return results of benchmarks of directory renders by worker processes.
+
+    ``parallel.serial`` renders files one after the other, as with
+    ``diecutter.render_workers = 0``. ``parallel.workers<N>`` renders them
+    with ``N`` worker processes: compare them to measure speedup, which is
+    bounded by the number of CPU cores.
+
+    """
+    results = {}
+    engine, filename_engine = engines()
+    dir_resource = resources.DirResource(
+        path=os.path.join(template_dir, 'tree') + '/', engine=engine,
+        filename_engine=filename_engine)
+    context = dict(contexts[0][1])
+
+    def render(resource):
+        for filename, content in resource.render(dict(context)):
+            for chunk in content:
+                pass
+    results['parallel.serial'] = measure(lambda: render(dir_resource),
+                                         options.repeat)
+    for workers in map(int, options.workers.split(',')):
+        pool = render_pool(workers)
+        try:
+            parallel = ParallelDirResource(dir_resource, pool, 2 * workers)
+            results['parallel.workers{0}'.format(workers)] = measure(
+                lambda: render(parallel), options.repeat)
+        finally:
+            pool.terminate()
+            pool.join()
+    return results
+
+
+def bench_extractors(contexts, options):
+    """Return results of benchmarks of context extractors."""
+    results = {}
+    for context_name, context in contexts:
+        flat = {'name': context['name']}
+        ini = ['name = {0}'.format(context['name'])]
+        for key, value in sorted(context.items()):
+            if isinstance(value, dict):
+                ini.append('[{0}]'.format(key))
+                for sub_key, sub_value in sorted(value.items()):
+                    flat['{0}.{1}'.format(key, sub_key)] = sub_value
+                    ini.append('{0} = {1}'.format(sub_key, sub_value))
+        bodies = [
+            ('post', 'application/x-www-form-urlencoded',
+             urllib.urlencode(flat), contextextractors.extract_post_context),
+            ('json', 'application/json', json.dumps(context),
+             contextextractors.extract_json_context),
+            ('ini', 'text/plain', '\n'.join(ini),
+             contextextractors.extract_ini_context),
+        ]
+        for name, content_type, body, extractor in bodies:
+            def extract():
+                request = Request.blank('/', method='POST',
+                                        content_type=content_type, body=body)
+                extractor(request)
+            key = 'extract_{0}_context.{1}'.format(name, context_name)
+            results[key] = measure(extract, options.repeat)
+    return results
+
+
+def bench_imports(options):
+    """Return results of benchmarks of imports of startup modules.
+
+    Each import runs in a fresh interpreter.
+
+    """
+    results = {}
+    for module in STARTUP_MODULES:
+        durations = [import_report(module)['duration']
+                     for index in range(options.repeat)]
+        results['import.{0}'.format(module)] = summarize(durations)
+    return results
+
+
+def bench_server(template_dir, contexts, options):
+    """Return results of end-to-end benchmarks of POST against server."""
+    results = {}
+    server = demo_server(template_dir)
+    try:
+        session = requests.Session()
+        for context_name, context in contexts:
+            body = json.dumps(context)
+            headers = {'Content-Type': 'application/json'}
+            for target in ['tree/file0-+name+.txt', 'tree/']:
+                url = server.application_url + target
+                durations = []
+                lock = threading.Lock()
+
+                def post(count):
+                    client = requests.Session()
+                    for index in range(count):
+                        start = timeit.default_timer()
+                        response = client.post(url, data=body,
+                                               headers=headers)
+                        response.content
+                        duration = timeit.default_timer() - start
+                        assert response.status_code == 200, response.text
+                        with lock:
+                            durations.append(duration)
+
+                session.post(url, data=body, headers=headers)  # Warm up.
+                count = options.requests // options.concurrency
+                threads = [threading.Thread(target=post, args=(count,))
+                           for index in range(options.concurrency)]
+                start = timeit.default_timer()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = timeit.default_timer() - start
+                result = summarize(durations)
+                result['throughput'] = len(durations) / elapsed
+                kind = 'directory' if target.endswith('/') else 'file'
+                key = 'post_{0}.{1}'.format(kind, context_name)
+                results[key] = result
+    finally:
+        server.shutdown()
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=50,
+                        help='Number of templates in directory.')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Depth of directory tree.')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='Approximate size of templates, in bytes.')
+    parser.add_argument('--context-sizes', default='10,1000,10000',
+                        help='Comma-separated numbers of context variables.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of calls per function benchmark.')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Number of requests per server benchmark.')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Number of concurrent clients.')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed of random generator.')
+    parser.add_argument('--workers', default='2,4',
+                        help='Comma-separated numbers of render workers.')
+    parser.add_argument('--only',
+                        default='writers,extractors,server,imports,parallel',
+                        help='Comma-separated benchmarks to run.')
+    parser.add_argument('--output', default='-',
+                        help='JSON output file, "-" for standard output.')
+    options = parser.parse_args(args)
+    rand = random.Random(options.seed)
+    contexts = [('context{0}'.format(size), synthetic_context(size, rand))
+                for size in map(int, options.context_sizes.split(','))]
+    template_dir = tempfile.mkdtemp()
+    try:
+        synthetic_tree(os.path.join(template_dir, 'tree'), options.files,
+                       options.depth, options.file_size, rand)
+        results = {}
+        only = options.only.split(',')
+        if 'writers' in only:
+            results.update(bench_writers(template_dir, contexts, options))
+        if 'extractors' in only:
+            results.update(bench_extractors(contexts, options))
+        if 'server' in only:
+            results.update(bench_server(template_dir, contexts, options))
+        if 'imports' in only:
+            results.update(bench_imports(options))
+        if 'parallel' in only:
+            results.update(bench_parallel(template_dir, contexts, options))
+    finally:
+        shutil.rmtree(template_dir)
+    report = {
+        'diecutter': diecutter.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'options': vars(options),
+        'results': results,
+    }
+    if options.output == '-':
+        output = sys.stdout
+    else:
+        output = open(options.output, 'w')
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    """Make sure benchmarks run."""
+    def test_smoke(self):
+        """Benchmarks run with tiny parameters and output JSON."""
+        output_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(output_dir, 'benchmark.json')
+            main(['--files=3', '--depth=1', '--file-size=100',
+                  '--context-sizes=1', '--repeat=1', '--requests=2',
+                  '--concurrency=1', '--workers=2', '--output', output])
+            with open(output) as output_file:
+                report = json.load(output_file)
+        finally:
+            shutil.rmtree(output_dir)
+        self.assertEqual(report['results']['post_file.context1']['count'], 2)
+        self.assertTrue('zip_directory.context1' in report['results'])
+        self.assertEqual(report['results']['import.diecutter']['count'], 1)
+        self.assertEqual(report['results']['parallel.workers2']['count'], 1)
+
+
+if __name__ == '__main__':
+    main()
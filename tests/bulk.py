@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.bulk and ``diecutter render`` command."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+
+from diecutter.bulk import BulkRenderer, read_contexts, run
+from diecutter.cli import main
+from diecutter.exceptions import DataParsingError
+from diecutter.local import LocalService
+from diecutter.settings import configure
+
+
+class BulkTestCase(unittest.TestCase):
+    """Tests around diecutter.bulk."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        templates = {'+name+.txt': u'Hello {{ name }}',
+                     'broken.txt': u'Broken {{ name',
+                     'dir/+name+/a.txt': u'A {{ name }}',
+                     'dir/b.txt': u'B {{ diecutter.index }}'}
+        for path, content in templates.items():
+            path = os.path.join(self.template_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as template_file:
+                template_file.write(content.encode('utf-8'))
+        self.service = LocalService()
+        self.service.configure(configure(
+            {'diecutter.template_dir': self.template_dir}))
+        self.contexts = [{'name': u'a'}, {'name': u'b'}, {'name': u'c'}]
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+        shutil.rmtree(self.output_dir)
+
+    def read(self, name):
+        with open(os.path.join(self.output_dir, name)) as output_file:
+            return output_file.read()
+
+    def test_resume(self):
+        """Existing outputs are skipped, so that runs can be resumed."""
+        renderer = BulkRenderer(self.service, '+name+.txt',
+                                self.output_dir)
+        report = run(renderer, self.contexts)
+        self.assertEqual((report['rendered'], report['skipped']), (3, 0))
+        self.assertEqual(report['bytes'], 21)
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['a.txt', 'b.txt', 'c.txt'])
+        self.assertEqual(self.read('b.txt'), 'Hello b')
+        os.remove(os.path.join(self.output_dir, 'b.txt'))
+        report = run(renderer, self.contexts)
+        self.assertEqual((report['rendered'], report['skipped']), (1, 2))
+        report = run(renderer, self.contexts, force=True)
+        self.assertEqual((report['rendered'], report['skipped']), (3, 0))
+
+    def test_errors(self):
+        """Template errors are reported per item, without partial outputs.
+        """
+        renderer = BulkRenderer(self.service, 'broken.txt', self.output_dir)
+        report = run(renderer, self.contexts[:1])
+        self.assertEqual(report['rendered'], 0)
+        self.assertEqual([name for name, error in report['errors']],
+                         ['broken.txt'])
+        self.assertEqual(os.listdir(self.output_dir), [])
+        renderer = BulkRenderer(self.service, 'missing.txt', self.output_dir)
+        self.assertRaises(ValueError, run, renderer, self.contexts)
+        self.assertRaises(DataParsingError, list,
+                          read_contexts(['{"name": "a"}', '[1]']))
+
+    def test_directories(self):
+        """Directory templates give one directory per context."""
+        renderer = BulkRenderer(self.service, 'dir/', self.output_dir)
+        report = run(renderer, self.contexts[:2])
+        self.assertEqual(report['rendered'], 2)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['1-dir', 'dir'])
+        self.assertEqual(self.read('1-dir/b/a.txt'), 'A b')
+        self.assertEqual(self.read('1-dir/b.txt'), 'B 1')
+
+    def test_archives_processes(self):
+        """Worker processes can write directory templates as archives."""
+        renderer = BulkRenderer(self.service, 'dir', self.output_dir,
+                                archive_type='zip')
+        report = run(renderer, self.contexts, processes=2)
+        self.assertEqual((report['rendered'], report['errors']), (3, []))
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['1-dir.zip', '2-dir.zip', 'dir.zip'])
+        archive = zipfile.ZipFile(os.path.join(self.output_dir, '2-dir.zip'))
+        self.assertEqual(sorted(archive.namelist()),
+                         ['dir/b.txt', 'dir/c/a.txt'])
+
+    def test_command(self):
+        """``diecutter render`` reads contexts and reports throughput."""
+        contexts = os.path.join(self.output_dir, 'contexts.jsonl')
+        with open(contexts, 'w') as contexts_file:
+            contexts_file.write('{"name": "a"}\n\n{"name": "b"}\n')
+        output_dir = os.path.join(self.output_dir, 'out')
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            exit_code = main(['render', '+name+.txt', '--quiet',
+                              '--template-dir', self.template_dir,
+                              '--contexts', contexts, '-o', output_dir,
+                              '-j', '1'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(output.startswith('2 rendered, 0 skipped, 0 errors'))
+        self.assertEqual(sorted(os.listdir(output_dir)), ['a.txt', 'b.txt'])
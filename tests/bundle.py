@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.bundle."""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationError
+from pyramid.request import Request
+import webtest
+
+from diecutter.bundle import BundleService, write_bundle
+from diecutter.service import register_service
+from diecutter.settings import configure
+
+
+class BundleServiceTestCase(unittest.TestCase):
+    """Tests around diecutter.bundle.BundleService."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.template_dir = os.path.join(self.root, 'templates')
+        self.bundle_path = os.path.join(self.root, 'templates.zip')
+        self.overlay_dir = os.path.join(self.root, 'overlay')
+        self.write_templates({'hello.txt': 'Hello {{ name }}',
+                              'dir/a.txt': 'A {{ name }}',
+                              'dir/sub/b.txt': 'B {{ name }}'})
+        write_bundle(self.template_dir, self.bundle_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_templates(self, files):
+        for path, content in files.items():
+            path = os.path.join(self.template_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as template_file:
+                template_file.write(content)
+
+    def app_factory(self, **settings):
+        settings.setdefault('diecutter.bundle.path', self.bundle_path)
+        settings.setdefault('diecutter.bundle.reload_interval', '0')
+        configuration = configure(settings)
+        self.service = BundleService()
+        self.service.configure(configuration)
+        config = Configurator(settings=configuration.settings)
+        config.registry.diecutter_configuration = configuration
+        config.include('cornice')
+        register_service(config, 'diecutter', self.service, '/')
+        return webtest.TestApp(config.make_wsgi_app())
+
+    def test_render(self):
+        """Files and directories are rendered from bundle."""
+        app = self.app_factory()
+        response = app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')
+        self.assertEqual(app.get('/hello.txt').body, 'Hello {{ name }}')
+        response = app.post('/dir/', {'name': 'world'},
+                            headers={'Accept': 'application/zip'})
+        archive = zipfile.ZipFile(StringIO(response.body))
+        self.assertEqual(archive.namelist(), ['a.txt', 'sub/b.txt'])
+        self.assertEqual(archive.read('sub/b.txt'), 'B world')
+        app.post('/missing.txt', {'name': 'world'}, status=404)
+        app.post('/../hello.txt', {'name': 'world'}, status=404)
+        app.get('/hello.txt/', status=404)
+        app.post('/hello.txt/', {'name': 'world'}, status=404)
+        app.put('/new.txt', upload_files=[('file', 'new.txt', 'New')],
+                status=403)
+
+    def test_swap(self):
+        """New bundles are swapped atomically on reload."""
+        app = self.app_factory()
+        index = self.service.template_index
+        old = self.service.get_resource(Request.blank('/'), 'hello.txt')
+        etag = app.get('/hello.txt').etag
+        self.assertFalse(index.refresh())
+        self.write_templates({'hello.txt': 'Hi {{ name }}'})
+        write_bundle(self.template_dir, self.bundle_path)
+        self.assertTrue(index.refresh())
+        response = app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hi world')
+        self.assertNotEqual(app.get('/hello.txt').etag, etag)
+        self.assertEqual(old.read(), 'Hello {{ name }}')  # Still readable.
+        broken = os.path.join(self.root, 'broken.zip')
+        with open(broken, 'w') as bundle_file:
+            bundle_file.write('Not a zip file')
+        os.rename(broken, self.bundle_path)
+        self.assertFalse(index.refresh())  # Broken bundles are not loaded.
+        self.assertEqual(app.get('/hello.txt').body, 'Hi {{ name }}')
+
+    def test_overlay(self):
+        """PUT writes to overlay, whose files take precedence."""
+        app = self.app_factory(**{
+            'diecutter.bundle.overlay_dir': self.overlay_dir})
+        for path in ['hello.txt', 'dir/c.txt']:
+            app.put('/' + path,
+                    upload_files=[('file', path, 'New {{ name }}')],
+                    status=201)
+        response = app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'New world')
+        response = app.post('/dir/', {'name': 'world'},
+                            headers={'Accept': 'application/zip'})
+        archive = zipfile.ZipFile(StringIO(response.body))
+        self.assertEqual(archive.namelist(),
+                         ['a.txt', 'c.txt', 'sub/b.txt'])
+        self.assertEqual(archive.read('c.txt'), 'New world')
+        self.assertEqual(os.listdir(self.overlay_dir), ['dir', 'hello.txt'])
+
+    def test_invalid(self):
+        """Missing or invalid bundles make startup fail."""
+        self.assertRaises(ConfigurationError, self.app_factory,
+                          **{'diecutter.bundle.path': ''})
+        self.assertRaises(ConfigurationError, self.app_factory,
+                          **{'diecutter.bundle.path': self.template_dir})
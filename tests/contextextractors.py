@@ -74,6 +74,42 @@ class JsonTestCase(unittest.TestCase):
         self.assertEqual(context, {})
         self.assertTrue('dummy' in request.json_body)
 
+    def test_batch(self):
+        """extract_json_context() returns list of contexts for arrays."""
+        request = self.request_factory([{'a': 1}, {'a': 2}])
+        context = contextextractors.extract_json_context(request)
+        self.assertEqual(context, [{'a': 1}, {'a': 2}])
+        request = self.request_factory([{'a': 1}, 'not a dict'])
+        self.assertRaises(exceptions.DataParsingError,
+                          contextextractors.extract_json_context,
+                          request)
+
+
+class JsonLinesTestCase(unittest.TestCase):
+    """Test diecutter.contextextractors.extract_json_lines_context."""
+    def request_factory(self, body=''):
+        """Return mock request instance."""
+        class MockRequest(object):
+            def __init__(self, body=''):
+                self.body = body
+        return MockRequest(body)
+
+    def test_data(self):
+        """extract_json_lines_context() returns one context per line."""
+        request = self.request_factory('{"a": 1}\n\n{"a": 2}\n')
+        context = contextextractors.extract_json_lines_context(request)
+        self.assertEqual(context, [{'a': 1}, {'a': 2}])
+        request = self.request_factory('')
+        context = contextextractors.extract_json_lines_context(request)
+        self.assertEqual(context, [])
+
+    def test_error(self):
+        """extract_json_lines_context() raises DataParsingError on error."""
+        request = self.request_factory('{"a": 1}\nnot json\n')
+        self.assertRaises(exceptions.DataParsingError,
+                          contextextractors.extract_json_lines_context,
+                          request)
+
 
 class IniTestCase(unittest.TestCase):
     """Test diecutter.contextextractors.extract_ini_context."""
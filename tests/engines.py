@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.engines."""
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from piecutter.engines.django import DjangoEngine
+from piecutter.engines.filename import FilenameEngine
+from piecutter.engines.jinja import Jinja2Engine
+from piecutter.exceptions import TemplateError
+
+from diecutter.engines import CachedEngine, set_bytecode_cache
+from diecutter.service import Service
+from diecutter.settings import DEFAULTS
+from diecutter.utils.cache import LRUCache
+
+
+class CachedEngineTestCase(unittest.TestCase):
+    """Tests around diecutter.engines.CachedEngine."""
+    def test_render(self):
+        """CachedEngine renders like wrapped engine."""
+        for engine_factory, template in [(Jinja2Engine, u'Hello {{ name }}'),
+                                         (DjangoEngine, u'Hello {{ name }}'),
+                                         (FilenameEngine, u'Hello +name+')]:
+            engine = CachedEngine(engine_factory(), LRUCache())
+            self.assertEqual(engine.render(template, {'name': u'world'}),
+                             u'Hello world')
+
+    def test_compile_once(self):
+        """CachedEngine compiles unchanged templates once."""
+        cache = LRUCache()
+        engine = CachedEngine(Jinja2Engine(), cache, 'jinja2')
+        engine.render(u'Hello {{ name }}', {'name': u'world'})
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        output = engine.render(u'Hello {{ name }}', {'name': u'Remy'})
+        self.assertEqual(output, u'Hello Remy')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        engine.render(u'Goodbye {{ name }}', {'name': u'Remy'})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_template_error(self):
+        """CachedEngine raises TemplateError like wrapped engine."""
+        engine = CachedEngine(Jinja2Engine(), LRUCache())
+        self.assertRaises(TemplateError, engine.render, u'{{ foo', {})
+        self.assertRaises(TemplateError, engine.render, u'{{ foo.bar.baz }}',
+                          {})
+        self.assertEqual(len(engine.cache), 1)  # Syntax errors not cached.
+
+    def test_generate(self):
+        """CachedEngine.generate() renders in chunks, like render()."""
+        for engine_factory, template in [(Jinja2Engine, u'Hello {{ name }}'),
+                                         (DjangoEngine, u'Hello {{ name }}'),
+                                         (FilenameEngine, u'Hello +name+')]:
+            engine = CachedEngine(engine_factory(), LRUCache())
+            chunks = engine.generate(template, {'name': u'world'})
+            self.assertEqual(u''.join(chunks), u'Hello world')
+        engine = CachedEngine(Jinja2Engine(), LRUCache())
+        chunks = engine.generate(u'{{ foo.bar.baz }}', {})
+        self.assertRaises(TemplateError, list, chunks)
+
+
+class BytecodeCacheTestCase(unittest.TestCase):
+    """Tests around diecutter.engines.set_bytecode_cache()."""
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def engine_factory(self):
+        engine = Jinja2Engine()
+        self.assertTrue(set_bytecode_cache(engine, self.cache_dir))
+        return CachedEngine(engine, LRUCache())
+
+    def test_shared(self):
+        """Engines with same bytecode cache directory compile once."""
+        engine = self.engine_factory()
+        self.assertEqual(engine.render(u'Hello {{ name }}', {'name': u'a'}),
+                         u'Hello a')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        other = self.engine_factory()  # As in another process.
+        with mock.patch.object(other.environment, 'compile') as compile:
+            self.assertEqual(
+                other.render(u'Hello {{ name }}', {'name': u'b'}), u'Hello b')
+        self.assertFalse(compile.called)
+        other.render(u'Goodbye {{ name }}', {'name': u'b'})
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_template_error(self):
+        """Syntax errors raise TemplateError and are not cached."""
+        engine = self.engine_factory()
+        self.assertRaises(TemplateError, engine.render, u'{{ foo', {})
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_unsupported(self):
+        """Engines without Jinja2 environment are not affected."""
+        self.assertFalse(set_bytecode_cache(DjangoEngine(), self.cache_dir))
+        self.assertFalse(set_bytecode_cache(FilenameEngine(), self.cache_dir))
+
+
+class EngineInstanceTestCase(unittest.TestCase):
+    """Tests around diecutter.service.Service.get_engine()."""
+    def request_factory(self, GET={}, settings=DEFAULTS):
+        request = mock.Mock()
+        request.registry.settings = settings
+        request.cache = {}
+        request.GET = GET
+        return request
+
+    def test_instance_reused(self):
+        """Service.get_engine() returns one instance per engine slug."""
+        service = Service()
+        engine = service.get_engine(self.request_factory())
+        self.assertTrue(isinstance(engine.engine, Jinja2Engine))
+        self.assertTrue(service.get_engine(self.request_factory()) is engine)
+        other = service.get_engine(self.request_factory({'engine': 'django'}))
+        self.assertTrue(isinstance(other.engine, DjangoEngine))
+        self.assertTrue(other.cache is engine.cache)
+
+    def test_bytecode_cache(self):
+        """Jinja2 engines use "diecutter.bytecode_cache_dir" setting."""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            settings = dict(DEFAULTS)
+            settings['diecutter.bytecode_cache_dir'] = cache_dir
+            service = Service()
+            engine = service.get_engine(self.request_factory(
+                settings=settings))
+            self.assertEqual(engine.environment.bytecode_cache.directory,
+                             cache_dir)
+        finally:
+            shutil.rmtree(cache_dir)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.github."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyramid import testing
+from pyramid.response import Response
+
+from diecutter.github import CachedGithubLoader, CheckoutCache, \
+    GithubService, RefResolver
+
+from testserver import webtest_server
+
+
+SHA_1 = '1' * 40
+SHA_2 = '2' * 40
+SHA_3 = '3' * 40
+
+
+class FakeLoader(object):
+    """Loader that "downloads" a 100 bytes file and counts downloads."""
+    downloads = []
+
+    def __init__(self, checkout_dir):
+        self.checkout_dir = checkout_dir
+
+    def github_targz(self, user, project, commit):
+        self.downloads.append((user, project, commit))
+        root = os.path.join(self.checkout_dir,
+                            '{project}-{commit}'.format(project=project,
+                                                        commit=commit))
+        os.makedirs(root)
+        with open(os.path.join(root, 'README'), 'w') as readme:
+            readme.write('x' * 100)
+        return self.checkout_dir
+
+
+class CheckoutCacheTestCase(unittest.TestCase):
+    """Tests around diecutter.github.CheckoutCache."""
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        FakeLoader.downloads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_checkout_once(self):
+        """CheckoutCache downloads each commit once."""
+        cache = CheckoutCache(self.cache_dir, loader_factory=FakeLoader)
+        path = cache.checkout('user', 'project', SHA_1)
+        self.assertEqual(path, cache.checkout('user', 'project', SHA_1))
+        self.assertEqual(FakeLoader.downloads, [('user', 'project', SHA_1)])
+        readme = os.path.join(path, 'project-' + SHA_1, 'README')
+        self.assertTrue(os.path.exists(readme))
+        # No temporary files left.
+        self.assertEqual(os.listdir(os.path.dirname(path)), [SHA_1])
+
+    def test_concurrent_download(self):
+        """CheckoutCache keeps first checkout if another one won the race."""
+        cache = CheckoutCache(self.cache_dir, loader_factory=FakeLoader)
+        path = cache.path('user', 'project', SHA_1)
+        os.makedirs(os.path.join(path, 'winner'))
+        self.assertEqual(cache.fetch('user', 'project', SHA_1), path)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [SHA_1])
+        self.assertEqual(os.listdir(path), ['winner'])
+
+    def test_evict(self):
+        """CheckoutCache removes least recently used checkouts."""
+        cache = CheckoutCache(self.cache_dir, max_bytes=250,
+                              loader_factory=FakeLoader)
+        first = cache.checkout('user', 'project', SHA_1)
+        second = cache.checkout('user', 'project', SHA_2)
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        cache.checkout('user', 'project', SHA_3)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertEqual(len(cache.entries()), 2)
+        self.assertEqual(os.listdir(self.cache_dir), ['user'])
+
+    def test_evict_in_use(self):
+        """CheckoutCache does not remove checkouts whose locks are held."""
+        cache = CheckoutCache(self.cache_dir, max_bytes=250,
+                              loader_factory=FakeLoader)
+        locks = []
+        first = cache.checkout('user', 'project', SHA_1, locks=locks)
+        second = cache.checkout('user', 'project', SHA_2)
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        cache.checkout('user', 'project', SHA_3)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        for lock_file in locks:
+            lock_file.close()
+        cache.checkout('user', 'project', SHA_2)
+        self.assertFalse(os.path.exists(first))
+
+    def test_invalid_path(self):
+        """CheckoutCache rejects names that escape its directory."""
+        cache = CheckoutCache(self.cache_dir, loader_factory=FakeLoader)
+        for user, project, commit in [('..', 'project', SHA_1),
+                                      ('user', '.', SHA_1),
+                                      ('user', 'project', '../' + SHA_1)]:
+            self.assertRaises(ValueError, cache.checkout, user, project,
+                              commit)
+        self.assertEqual(FakeLoader.downloads, [])
+
+
+class CachedGithubLoaderTestCase(unittest.TestCase):
+    """Tests around diecutter.github.CachedGithubLoader."""
+    def test_branches_not_cached(self):
+        """CachedGithubLoader uses cache for full commit identifiers only."""
+        class Cache(object):
+            def checkout(self, user, project, commit, locks=None):
+                return 'cached'
+        loader = CachedGithubLoader('/tmp/checkout', Cache())
+        self.assertEqual(loader.github_targz('user', 'project', SHA_1),
+                         'cached')
+        loader._checkout = 'temporary'  # Skip download.
+        self.assertEqual(loader.github_targz('user', 'project', 'master'),
+                         'temporary')
+
+
+class GithubServiceTestCase(unittest.TestCase):
+    """Tests around diecutter.github.GithubService."""
+    def test_checkout_removed_on_close(self):
+        """Temporary checkout is removed when response is closed."""
+        service = GithubService()
+        request = testing.DummyRequest()
+        checkouts = []
+
+        def view(request):
+            checkouts.append(request.cache['diecutter_checkout_dir'])
+            return Response(app_iter=iter(['never', 'sent']))
+        response = service.stream_with_checkout(request, view)
+        self.assertTrue(os.path.isdir(checkouts[0]))
+        response.app_iter.close()  # E.g. client disconnected.
+        self.assertFalse(os.path.exists(checkouts[0]))
+
+    def test_checkout_released_on_close(self):
+        """Locks on cached checkouts are released when response is closed."""
+        service = GithubService()
+        request = testing.DummyRequest()
+        locks = []
+
+        def view(request):
+            lock_file = open(os.devnull)
+            request.cache['diecutter_checkout_locks'].append(lock_file)
+            locks.append(lock_file)
+            return Response(app_iter=iter(['never', 'sent']))
+        response = service.stream_with_checkout(request, view)
+        self.assertFalse(locks[0].closed)
+        response.app_iter.close()
+        self.assertTrue(locks[0].closed)
+
+    def test_invalid_names(self):
+        """Invalid user and project names give no resource."""
+        service = GithubService()
+        request = testing.DummyRequest()
+        for path in ['../project/master/file.txt', 'user/../master/file.txt',
+                     'user/./master/file.txt']:
+            self.assertTrue(service.get_resource(request, path) is None)
+
+
+class FakeGithubAPI(object):
+    """WSGI application that stands in for Github API."""
+    def __init__(self):
+        self.refs = {}
+        self.hits = 0
+
+    def __call__(self, environ, start_response):
+        self.hits += 1
+        path = environ['PATH_INFO']
+        try:
+            sha = self.refs[path]
+        except KeyError:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found']
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [sha]
+
+
+class RefResolverTestCase(unittest.TestCase):
+    """Tests around diecutter.github.RefResolver."""
+    def setUp(self):
+        self.api = FakeGithubAPI()
+        self.api.refs['/repos/user/project/commits/master'] = SHA_1
+        self.server = webtest_server(self.api)
+        self.now = 1000
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def resolver_factory(self, ttl=60):
+        return RefResolver(api_url=self.server.application_url, ttl=ttl,
+                           clock=lambda: self.now)
+
+    def test_resolve(self):
+        """RefResolver resolves references using Github API."""
+        resolver = self.resolver_factory()
+        self.assertEqual(resolver.resolve('user', 'project', 'master'), SHA_1)
+        self.assertEqual(resolver.resolve('user', 'project', SHA_2), SHA_2)
+        self.assertEqual(self.api.hits, 1)
+
+    def test_ttl(self):
+        """RefResolver keeps resolutions during TTL."""
+        resolver = self.resolver_factory(ttl=60)
+        resolver.resolve('user', 'project', 'master')
+        self.api.refs['/repos/user/project/commits/master'] = SHA_2
+        self.now += 59
+        self.assertEqual(resolver.resolve('user', 'project', 'master'), SHA_1)
+        self.assertEqual(self.api.hits, 1)
+        self.now += 1
+        self.assertEqual(resolver.resolve('user', 'project', 'master'), SHA_2)
+        self.assertEqual(self.api.hits, 2)
+
+    def test_not_found(self):
+        """RefResolver returns reference as is if resolution fails."""
+        resolver = self.resolver_factory()
+        self.assertEqual(resolver.resolve('user', 'project', 'unknown'),
+                         'unknown')
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.gitrepo."""
+from distutils.spawn import find_executable
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+
+from pyramid.config import Configurator
+import webtest
+
+from diecutter.gitrepo import GitService, Repository
+from diecutter.service import register_service
+from diecutter.settings import configure
+
+
+def git(cwd, *args):
+    """Run git command in ``cwd``, return output."""
+    environ = dict(os.environ,
+                   GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com',
+                   GIT_COMMITTER_NAME='Test',
+                   GIT_COMMITTER_EMAIL='test@example.com',
+                   GIT_COMMITTER_DATE='1413633600 +0000',
+                   GIT_CONFIG_NOSYSTEM='1', HOME=cwd)
+    return subprocess.check_output(('git',) + args, cwd=cwd, env=environ)
+
+
+def write(root, files):
+    for path, content in files.items():
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as template_file:
+            template_file.write(content)
+
+
+@unittest.skipIf(find_executable('git') is None, 'git is not installed')
+class GitTestCase(unittest.TestCase):
+    """Fixture repositories: "work" (loose objects) and "templates.git"
+    (bare, packed with deltas)."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        work = os.path.join(self.root, 'work')
+        os.mkdir(work)
+        git(work, 'init', '-q')
+        lines = ''.join('line {0}\n'.format(i) for i in range(200))
+        write(work, {'hello.txt': 'Hello {{ name }}',
+                     'big.txt': lines,
+                     'dir/a.txt': 'A {{ name }}',
+                     'dir/sub/b.txt': 'B {{ name }}'})
+        git(work, 'add', '.')
+        git(work, 'commit', '-q', '-m', 'First')
+        git(work, 'tag', '-a', '-m', 'Version 1', 'v1')
+        write(work, {'hello.txt': 'Hi {{ name }}',
+                     'big.txt': lines + 'one more line\n'})
+        git(work, 'commit', '-q', '-a', '-m', 'Second')
+        git(work, 'branch', '-M', 'master')
+        self.bare = os.path.join(self.root, 'templates.git')
+        git(self.root, 'clone', '-q', '--bare', work, self.bare)
+        git(self.bare, 'repack', '-q', '-a', '-d', '-f')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+class RepositoryTestCase(GitTestCase):
+    """Tests around diecutter.gitrepo.Repository."""
+    def test_objects(self):
+        """Objects read from loose objects and packs match git's."""
+        for path in [self.bare, os.path.join(self.root, 'work', '.git')]:
+            repository = Repository(path)
+            objects = git(path, 'rev-list', '--objects', '--all').split()
+            for sha in [item for item in objects if len(item) == 40]:
+                object_type = git(path, 'cat-file', '-t', sha).strip()
+                data = git(path, 'cat-file', object_type, sha)
+                self.assertEqual(repository.store.read(sha),
+                                 (object_type, data))
+            self.assertRaises(KeyError, repository.store.read, '0' * 40)
+            repository.close()
+
+    def test_resolve(self):
+        """Branches, annotated tags and commits resolve to commits."""
+        repository = Repository(self.bare)
+        master = git(self.bare, 'rev-parse', 'master').strip()
+        first = git(self.bare, 'rev-parse', 'v1^{commit}').strip()
+        self.assertEqual(repository.resolve('master'), master)
+        self.assertEqual(repository.resolve('HEAD'), master)
+        self.assertEqual(repository.resolve('v1'), first)
+        self.assertEqual(repository.resolve(first), first)
+        for ref in ['missing', '../config', '', '0' * 40]:
+            self.assertTrue(repository.resolve(ref) is None)
+
+    def test_lookup(self):
+        """Paths are looked up in trees, directories are walked in order."""
+        repository = Repository(self.bare)
+        tree, mtime = repository.commit_info(repository.resolve('master'))
+        self.assertEqual(mtime, 1413633600)
+        kind, sha = repository.lookup(tree, 'dir/sub/b.txt')
+        self.assertEqual((kind, repository.read_blob(sha)),
+                         ('file', 'B {{ name }}'))
+        kind, sha = repository.lookup(tree, 'dir/')
+        self.assertEqual(kind, 'dir')
+        self.assertEqual([path for path, blob in repository.walk(sha)],
+                         ['a.txt', 'sub/b.txt'])
+        for path in ['missing', 'hello.txt/x', 'dir/../hello.txt']:
+            self.assertTrue(repository.lookup(tree, path) is None)
+
+
+class GitServiceTestCase(GitTestCase):
+    """Tests around diecutter.gitrepo.GitService."""
+    def setUp(self):
+        super(GitServiceTestCase, self).setUp()
+        configuration = configure({
+            'diecutter.git.repositories_dir': self.root})
+        self.service = GitService()
+        self.service.configure(configuration)
+        config = Configurator(settings=configuration.settings)
+        config.registry.diecutter_configuration = configuration
+        config.include('cornice')
+        register_service(config, 'diecutter', self.service, '/')
+        self.app = webtest.TestApp(config.make_wsgi_app())
+
+    def test_render(self):
+        """Templates are rendered from refs of repositories."""
+        response = self.app.post('/templates/master/hello.txt',
+                                 {'name': 'world'})
+        self.assertEqual(response.body, 'Hi world')
+        response = self.app.post('/templates/v1/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')
+        response = self.app.post('/work/master/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hi world')
+        response = self.app.get('/templates/master/hello.txt')
+        self.assertEqual(response.body, 'Hi {{ name }}')
+        self.app.get('/templates/master/hello.txt', status=304,
+                     headers={'If-None-Match': response.headers['ETag']})
+        # Objects are shared by repositories: "work" hits cache.
+        self.assertTrue(
+            self.service.cache_info(None)['git_object']['hits'] >= 3)
+
+    def test_directory(self):
+        """Directories are rendered as archives."""
+        response = self.app.post('/templates/master/dir/', {'name': 'world'},
+                                 headers={'Accept': 'application/zip'})
+        archive = zipfile.ZipFile(StringIO(response.body))
+        self.assertEqual(archive.namelist(), ['a.txt', 'sub/b.txt'])
+        self.assertEqual(archive.read('sub/b.txt'), 'B world')
+
+    def test_errors(self):
+        """Missing repositories, refs and paths give 404, PUT gives 403."""
+        for path in ['/missing/master/hello.txt', '/templates/nope/hello.txt',
+                     '/templates/master/nope.txt', '/templates/master/..',
+                     '/.git/master/hello.txt']:
+            self.app.post(path, {'name': 'world'}, status=404)
+        self.app.put('/templates/master/new.txt',
+                     upload_files=[('file', 'new.txt', 'New')], status=403)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Modules used at startup must not import heavy dependencies.
+
+Durations of imports are measured by benchmarks, see ``tests/benchmarks.py``.
+
+"""
+import json
+import subprocess
+import sys
+import unittest
+
+
+#: Python code that imports a module, prints duration and loaded modules.
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+__import__({module!r})
+duration = time.time() - start
+json.dump({{'duration': duration, 'modules': sorted(sys.modules)}},
+          sys.stdout)
+"""
+
+#: Modules that take long to import, and are not needed at import time.
+HEAVY_MODULES = ('pkg_resources', 'cornice', 'pyramid.config', 'piecutter',
+                 'jinja2', 'django', 'diecutter.writers')
+
+
+def import_report(module):
+    """Import ``module`` in a fresh interpreter, return duration and modules.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)])
+    return json.loads(output)
+
+
+#: Modules which are imported at startup, e.g. by ``diecutter`` command.
+STARTUP_MODULES = ('diecutter', 'diecutter.cli', 'diecutter.service')
+
+
+class ImportTestCase(unittest.TestCase):
+    """Import of diecutter modules stays lightweight."""
+    def test_heavy_modules(self):
+        """Startup modules do not import heavy dependencies."""
+        for module in STARTUP_MODULES:
+            report = import_report(module)
+            loaded = [name for name in HEAVY_MODULES
+                      if name in report['modules']]
+            self.assertEqual(loaded, [],
+                             '{module} imports {loaded}'.format(
+                                 module=module, loaded=', '.join(loaded)))
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.index."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pyramid.config import Configurator
+import webtest
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from diecutter.index import InotifyWatcher, PollingWatcher, TemplateIndex, \
+    watcher_factory
+from diecutter.local import LocalService
+from diecutter.service import register_service
+from diecutter.settings import configure
+from diecutter.utils.fingerprints import tree_info
+
+
+def wait_for(condition, timeout=5, step=0.01):
+    """Return True as soon as ``condition()`` is true, False on timeout."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(step)
+    return condition()
+
+
+class TemplateIndexTestCase(unittest.TestCase):
+    """Tests around diecutter.index.TemplateIndex."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ['a.txt', 'b/c.txt', 'b/d/e.txt', 'b/f.txt', 'g/h.txt']:
+            self.write(path, path)
+        self.index = TemplateIndex(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as template_file:
+            template_file.write(content)
+
+    def path(self, relative):
+        return os.path.join(self.root, relative)
+
+    def test_lookup(self):
+        """TemplateIndex.lookup() returns kind of files and directories."""
+        self.assertEqual(self.index.lookup(self.path('a.txt')).kind, 'file')
+        self.assertEqual(self.index.lookup(self.path('a.txt')).size, 5)
+        self.assertEqual(self.index.lookup(self.path('b/d')).kind, 'dir')
+        self.assertEqual(self.index.lookup(self.path('b/d/')).kind, 'dir')
+        self.assertEqual(self.index.lookup(self.root).kind, 'dir')
+        self.assertTrue(self.index.lookup(self.path('missing')) is None)
+        self.assertTrue(self.index.lookup(self.path('../a.txt')) is None)
+        self.assertTrue(self.index.lookup(self.root + 'x') is None)
+
+    def test_walk(self):
+        """TemplateIndex.walk() lists files in os.walk() order."""
+        expected = []
+        for directory, dirs, files in os.walk(self.path('b')):
+            dirs.sort()
+            expected.extend(os.path.relpath(os.path.join(directory, name),
+                                            self.root)
+                            for name in sorted(files))
+        self.assertEqual(list(self.index.walk(self.path('b/'))), expected)
+        self.assertEqual(list(self.index.walk(self.path('a.txt'))), [])
+
+    def test_tree_info(self):
+        """TemplateIndex.tree_info() matches fingerprints.tree_info()."""
+        for relative in ['a.txt', 'b', 'b/d', '']:
+            path = self.path(relative)
+            self.assertEqual(self.index.tree_info(path), tree_info(path))
+        self.assertEqual(self.index.tree_info(self.path('missing')),
+                         (None, None))
+
+    def test_refresh(self):
+        """TemplateIndex.refresh() tells whether something changed."""
+        self.assertFalse(self.index.refresh())
+        self.write('b/new.txt', 'new')
+        self.assertTrue(self.index.lookup(self.path('b/new.txt')) is None)
+        self.assertTrue(self.index.refresh())
+        self.assertEqual(self.index.lookup(self.path('b/new.txt')).kind,
+                         'file')
+
+
+class WatcherTestCase(unittest.TestCase):
+    """Tests around watchers of diecutter.index."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = TemplateIndex(self.root)
+        self.path = os.path.join(self.root, 'new.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assertWatches(self, watcher):
+        watcher.start()
+        try:
+            with open(self.path, 'w') as template_file:
+                template_file.write('new')
+            self.assertTrue(
+                wait_for(lambda: self.index.lookup(self.path) is not None))
+            os.remove(self.path)
+            self.assertTrue(
+                wait_for(lambda: self.index.lookup(self.path) is None))
+        finally:
+            watcher.stop()
+
+    def test_polling(self):
+        """PollingWatcher refreshes index periodically."""
+        self.assertWatches(PollingWatcher(self.index, interval=0.01))
+
+    @unittest.skipIf(pyinotify is None, 'pyinotify is not installed')
+    def test_inotify(self):
+        """InotifyWatcher refreshes index on changes."""
+        self.assertWatches(InotifyWatcher(self.index, delay=0.01))
+
+    def test_factory(self):
+        """watcher_factory() returns polling watcher on demand."""
+        watcher = watcher_factory(self.index, 'poll', 3)
+        self.assertTrue(isinstance(watcher, PollingWatcher))
+        self.assertEqual(watcher.interval, 3)
+
+
+class IndexedServiceTestCase(unittest.TestCase):
+    """LocalService with "diecutter.template_index" setting."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.template_dir, 'dir'))
+        for path in ['hello.txt', 'dir/+name+.txt']:
+            with open(os.path.join(self.template_dir, path), 'w') as output:
+                output.write('Hello {{ name }}')
+        configuration = configure({
+            'diecutter.template_dir': self.template_dir,
+            'diecutter.template_index': 'poll',
+            'diecutter.template_index_interval': '3600'})
+        self.service = LocalService()
+        self.service.configure(configuration)
+        config = Configurator(settings=configuration.settings)
+        config.registry.diecutter_configuration = configuration
+        config.include('cornice')
+        register_service(config, 'diecutter', self.service, '/')
+        self.app = webtest.TestApp(config.make_wsgi_app())
+
+    def tearDown(self):
+        self.service.template_index_watcher.stop()
+        shutil.rmtree(self.template_dir)
+
+    def test_render(self):
+        """Files and directories are served from index."""
+        response = self.app.get('/hello.txt')
+        self.assertEqual(response.body, 'Hello {{ name }}')
+        response = self.app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')
+        response = self.app.post('/dir/', {'name': 'world'},
+                                 headers={'Accept': 'application/zip'})
+        self.assertEqual(response.content_type, 'application/zip')
+        self.assertTrue('world.txt' in response.body)
+
+    def test_not_found(self):
+        """Missing templates give 404 without building engines."""
+        self.app.get('/missing.txt', status=404)
+        self.app.post('/missing.txt', {'name': 'world'}, status=404)
+        self.app.get('/hello.txt/', status=404)
+        self.app.post('/hello.txt/', {'name': 'world'}, status=404)
+        self.assertEqual(self.service.engines, {})
+
+    def test_put(self):
+        """PUT refreshes index."""
+        self.app.put('/new.txt',
+                     upload_files=[('file', 'new.txt', 'New {{ name }}')])
+        response = self.app.post('/new.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'New world')
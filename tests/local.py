@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.local."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyramid import testing
+from pyramid.config import Configurator
+from pyramid.exceptions import Forbidden, NotFound
+from webob import Request
+import webtest
+
+from diecutter.local import LocalService
+from diecutter.service import register_service
+from diecutter.settings import configure
+
+
+class ConditionalRequestsTestCase(unittest.TestCase):
+    """Tests around ETag and Last-Modified headers of LocalService."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.template_dir, 'dir'))
+        for name in ['hello.txt', os.path.join('dir', 'hello.txt')]:
+            with open(os.path.join(self.template_dir, name), 'w') as output:
+                output.write('Hello {{ name }}')
+        self.services = []
+
+    def tearDown(self):
+        for service in self.services:
+            if service.template_index_watcher is not None:
+                service.template_index_watcher.stop()
+        shutil.rmtree(self.template_dir)
+
+    def app_factory(self, **settings):
+        settings['diecutter.template_dir'] = self.template_dir
+        configuration = configure(settings)
+        service = LocalService()
+        service.configure(configuration)
+        self.services.append(service)
+        config = Configurator(settings=configuration.settings)
+        config.registry.diecutter_configuration = configuration
+        config.include('cornice')
+        register_service(config, 'diecutter', service, '/')
+        return webtest.TestApp(config.make_wsgi_app())
+
+    def test_file(self):
+        """Files get ETag, conditional requests get bodiless 304."""
+        app = self.app_factory()
+        response = app.get('/hello.txt')
+        self.assertTrue(response.etag is not None)
+        response = app.get('/hello.txt', status=304,
+                           headers={'If-None-Match': str(response.etag)})
+        self.assertFalse('Content-Type' in response.headers)
+        response = app.post('/hello.txt', {'name': 'world'})
+        response = app.post('/hello.txt', {'name': 'world'}, status=304,
+                            headers={'If-None-Match': str(response.etag)})
+        self.assertFalse('Content-Type' in response.headers)
+
+    def test_directory(self):
+        """Directory versions are only computed when needed.
+
+        Without index nor cache, walking the tree on every request would be
+        expensive: only conditional requests get ETag.
+
+        """
+        app = self.app_factory()
+        self.assertTrue(app.get('/dir/').etag is None)
+        headers = {'If-None-Match': '"other"'}
+        etag = app.get('/dir/', headers=headers).etag
+        self.assertTrue(etag is not None)
+        app.get('/dir/', status=304, headers={'If-None-Match': str(etag)})
+        for settings in [{'diecutter.template_index': 'poll',
+                          'diecutter.template_index_interval': '3600'},
+                         {'diecutter.render_cache_size': '1000'}]:
+            app = self.app_factory(**settings)
+            response = app.post('/dir/', {'name': 'world'})
+            self.assertTrue(response.etag is not None)
+
+    def test_no_host(self):
+        """HTTP/1.0 requests without Host header use server's name."""
+        app = self.app_factory(**{'diecutter.render_cache_size': '1000'})
+        with open(os.path.join(self.template_dir, 'url.txt'), 'w') as output:
+            output.write('{{ diecutter.api_url }}')
+        request = Request.blank('/url.txt', POST={'name': 'world'})
+        request.http_version = 'HTTP/1.0'
+        del request.environ['HTTP_HOST']
+        response = request.get_response(app.app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, 'http://localhost:80')
+        self.assertTrue(response.etag is not None)
+
+
+class ResourcePathTestCase(unittest.TestCase):
+    """Tests around LocalService.get_resource_path()."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.other_dir = self.template_dir + '-other'
+        os.mkdir(self.other_dir)
+        with open(os.path.join(self.other_dir, 'secret.txt'), 'w') as output:
+            output.write('Secret')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+        shutil.rmtree(self.other_dir)
+
+    def test_sibling_directory(self):
+        """Paths in directories whose names start like template directory's
+        are outside template directory."""
+        service = LocalService()
+        service.configure(configure({
+            'diecutter.template_dir': self.template_dir}))
+        request = testing.DummyRequest()
+        request.matchdict = {'template_path': ''}
+        self.assertEqual(service.get_resource_path(request),
+                         self.template_dir)
+        path = '../{name}/secret.txt'.format(
+            name=os.path.basename(self.other_dir))
+        self.assertRaises(NotFound, service.get_resource_path, request, path)
+
+    def test_reserved_names(self):
+        """Names of API endpoints are forbidden at the root of template
+        directory."""
+        service = LocalService()
+        service.configure(configure({
+            'diecutter.template_dir': self.template_dir}))
+        request = testing.DummyRequest()
+        for path in ['_manifest', '_stats/', 'dir/../_metrics']:
+            self.assertRaises(Forbidden, service.get_resource_path, request,
+                              path)
+        self.assertEqual(service.get_resource_path(request, 'dir/_stats'),
+                         os.path.join(self.template_dir, 'dir', '_stats'))
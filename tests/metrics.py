@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.metrics."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import webtest
+
+import diecutter.wsgi
+from diecutter.metrics import Counters, Metrics, format_samples
+
+
+class CountersTestCase(unittest.TestCase):
+    """Tests around diecutter.metrics.Counters."""
+    def test_threads(self):
+        """Counters of all threads are merged."""
+        counters = Counters()
+
+        def increment():
+            for i in range(1000):
+                counters.inc('requests')
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counters.merge(), {'requests': 4000})
+        self.assertEqual(len(counters._shards), 4)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests around diecutter.metrics.Metrics."""
+    def test_histogram(self):
+        """Histogram buckets are cumulative, in Prometheus format."""
+        metrics = Metrics(buckets=(0.1, 1))
+        labels = (('route', 'template'),)
+        for value in (0.05, 0.5, 5):
+            metrics.observe('diecutter_request_duration_seconds', labels,
+                            value)
+        text = format_samples(metrics.samples())
+        self.assertEqual(text.splitlines(), [
+            '# HELP diecutter_request_duration_seconds Duration of requests, '
+            'including streaming of body.',
+            '# TYPE diecutter_request_duration_seconds histogram',
+            'diecutter_request_duration_seconds_bucket'
+            '{route="template",le="0.1"} 1',
+            'diecutter_request_duration_seconds_bucket'
+            '{route="template",le="1"} 2',
+            'diecutter_request_duration_seconds_bucket'
+            '{route="template",le="+Inf"} 3',
+            'diecutter_request_duration_seconds_count{route="template"} 3',
+            'diecutter_request_duration_seconds_sum{route="template"} 5.55',
+        ])
+
+
+class MetricsServiceTestCase(unittest.TestCase):
+    """/_metrics endpoint."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.template_dir, 'hello.txt'), 'w') as f:
+            f.write('Hello {{ name }}')
+        settings = {'diecutter.template_dir': self.template_dir}
+        self.app = webtest.TestApp(diecutter.wsgi.for_paste({}, **settings))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_metrics(self):
+        """GET /_metrics returns metrics in Prometheus text format."""
+        self.app.post('/hello.txt', {'name': 'world'})
+        self.app.post('/hello.txt', {'name': 'world'})
+        self.app.post('/unknown.txt', {'name': 'world'}, status=404)
+        response = self.app.get('/_metrics')
+        self.assertTrue(response.headers['Content-Type'].startswith(
+            'text/plain; version=0.0.4'))
+        lines = response.body.splitlines()
+        self.assertTrue(
+            'diecutter_requests_total{route="template",method="POST",'
+            'engine="jinja2",status="200"} 2' in lines)
+        self.assertTrue(
+            'diecutter_response_bytes_total{route="template",method="POST",'
+            'engine="jinja2"} 22' in lines)
+        self.assertTrue(
+            'diecutter_template_not_found_total{route="template"} 1' in lines)
+        self.assertTrue(
+            'diecutter_cache_hits_total{cache="template"} 1' in lines)
+        self.assertTrue(
+            'diecutter_cache_hit_ratio{cache="template"} 0.5' in lines)
+
+    def test_unknown_engine(self):
+        """Unknown engines do not create series."""
+        def series():
+            lines = self.app.get('/_metrics').body.splitlines()
+            return set(line.rsplit(' ', 1)[0] for line in lines
+                       if not line.startswith('#'))
+        series()  # Requests to /_metrics are counted too.
+        self.app.post('/hello.txt?engine=unknown-1', {'name': 'world'},
+                      status=406)
+        before = series()
+        self.app.post('/hello.txt?engine=unknown-2', {'name': 'world'},
+                      status=406)
+        after = series()
+        self.assertEqual(before, after)
+        self.assertFalse([name for name in after if 'unknown' in name])
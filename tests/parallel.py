@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.parallel."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from piecutter.engines.filename import FilenameEngine
+from piecutter.engines.jinja import Jinja2Engine
+from piecutter.exceptions import TemplateError
+from piecutter.resources import DirResource
+
+from diecutter.engines import CachedEngine
+from diecutter.parallel import ParallelDirResource, render_pool
+from diecutter.utils.cache import LRUCache
+
+from testserver import demo_template_dir
+
+
+class ParallelDirResourceTestCase(unittest.TestCase):
+    """Tests around diecutter.parallel.ParallelDirResource."""
+    def setUp(self):
+        self.pool = render_pool(4)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def resource_factory(self, name):
+        path = os.path.join(demo_template_dir(), name)
+        engine = CachedEngine(Jinja2Engine(), LRUCache(), 'jinja2')
+        return DirResource(path=path, engine=engine,
+                           filename_engine=FilenameEngine())
+
+    def render(self, resource, context):
+        return [(filename, ''.join(content))
+                for filename, content in resource.render(context)]
+
+    def test_same_output(self):
+        """ParallelDirResource renders like DirResource, in same order."""
+        for name, context in [
+                ('simple-tree/', {'name': u'world'}),
+                ('dynamic-tree/', {'name': u'world',
+                                   'greeting_list': [u'a', u'b', u'c']})]:
+            resource = self.resource_factory(name)
+            expected = self.render(resource, dict(context))
+            parallel = ParallelDirResource(resource, self.pool, window=2)
+            self.assertEqual(self.render(parallel, dict(context)), expected)
+
+    def test_dynamic_tree_context(self):
+        """Each file of dynamic tree gets its own context."""
+        resource = self.resource_factory('dynamic-tree/')
+        parallel = ParallelDirResource(resource, self.pool, window=10)
+        output = self.render(parallel, {'name': u'world'})
+        self.assertEqual(output, [('hello.txt', 'hello world!'),
+                                  ('goodbye.txt', 'goodbye world!')])
+
+    def test_template_error(self):
+        """Errors raised in workers are raised as TemplateError."""
+        template_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(template_dir, 'broken.txt'), 'w') as f:
+                f.write('{{ foo.bar.baz }}')
+            resource = self.resource_factory(template_dir + '/')
+            parallel = ParallelDirResource(resource, self.pool, window=2)
+            self.assertRaises(TemplateError, self.render, parallel, {})
+        finally:
+            shutil.rmtree(template_dir)
+
+    def test_render_pool(self):
+        """render_pool() returns None if there is no concurrency."""
+        self.assertTrue(render_pool(0) is None)
+        self.assertTrue(render_pool(1) is None)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.profiling."""
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import webtest
+
+import diecutter.wsgi
+from diecutter.profiling import Profiler, rotate
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """Tests around diecutter.profiling.Profiler."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save(self):
+        """Profiler saves pstats dump and JSON summary."""
+        profiler = Profiler('name')
+        self.assertEqual(list(profiler.iterate(iter(['a', 'b']))),
+                         ['a', 'b'])
+        profiler.save(self.directory)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['name.json', 'name.prof'])
+        pstats.Stats(os.path.join(self.directory, 'name.prof'))
+
+    def test_rotate(self):
+        """rotate() keeps most recent profiles."""
+        for name in ['1', '2', '3']:
+            Profiler(name).save(self.directory)
+        rotate(self.directory, 2)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['2.json', '2.prof', '3.json', '3.prof'])
+
+
+class ProfilingServiceTestCase(unittest.TestCase):
+    """Profiling of LocalService.post()."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.profile_dir = os.path.join(self.template_dir, '.profiles')
+        with open(os.path.join(self.template_dir, 'hello.txt'), 'w') as f:
+            f.write('Hello {{ name }}')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def app_factory(self, **settings):
+        settings['diecutter.template_dir'] = self.template_dir
+        settings['diecutter.profile_dir'] = self.profile_dir
+        return webtest.TestApp(diecutter.wsgi.for_paste({}, **settings))
+
+    def test_token(self):
+        """Requests are profiled only with valid token."""
+        app = self.app_factory(**{'diecutter.token': 'secret'})
+        response = app.post('/hello.txt?profile=wrong', {'name': 'world'})
+        self.assertFalse('Diecutter-Profile' in response.headers)
+        response = app.post('/hello.txt?profile=secret', {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')
+        name = response.headers['Diecutter-Profile']
+        self.assertTrue(os.path.exists(
+            os.path.join(self.profile_dir, name + '.prof')))
+
+    def test_no_token(self):
+        """Profiling is disabled if token is not configured."""
+        app = self.app_factory()
+        response = app.post('/hello.txt?profile=', {'name': 'world'})
+        self.assertFalse('Diecutter-Profile' in response.headers)
+
+    def test_json(self):
+        """profile_format=json returns summary of profile."""
+        app = self.app_factory(**{'diecutter.token': 'secret'})
+        response = app.post('/hello.txt?profile=secret&profile_format=json',
+                            {'name': 'world'})
+        self.assertEqual(response.json['status'], 200)
+        self.assertEqual(response.json['size'], len('Hello world'))
+        self.assertTrue(response.json['profile']['functions'])
+
+    def test_sampling(self):
+        """One in profile_sample_rate requests is profiled."""
+        app = self.app_factory(**{'diecutter.profile_sample_rate': '2',
+                                  'diecutter.profile_keep': '2'})
+        profiled = []
+        for i in range(6):
+            response = app.post('/hello.txt', {'name': 'world'})
+            profiled.append('Diecutter-Profile' in response.headers)
+        self.assertEqual(profiled, [False, True] * 3)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 4)
+
+    def test_cache(self):
+        """Only valid tokens bypass render cache. Sampled profiles are not
+        cached."""
+        app = self.app_factory(**{'diecutter.token': 'secret',
+                                  'diecutter.render_cache_size': '1000',
+                                  'diecutter.profile_sample_rate': '1'})
+        response = app.post('/hello.txt?profile=wrong', {'name': 'world'})
+        self.assertTrue('Diecutter-Profile' in response.headers)  # Sampled.
+        response = app.post('/hello.txt?profile=wrong&profile_format=json',
+                            {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')  # From cache.
+        self.assertFalse('Diecutter-Profile' in response.headers)
+        response = app.post('/hello.txt?profile=secret', {'name': 'world'})
+        self.assertTrue('Diecutter-Profile' in response.headers)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 4)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.rendercache."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from webob import Response
+import webtest
+
+import diecutter.wsgi
+from diecutter.rendercache import RenderCache
+
+
+class RenderCacheTestCase(unittest.TestCase):
+    """Tests around diecutter.rendercache.RenderCache."""
+    def response_factory(self, chunks):
+        response = Response(content_type='text/plain')
+        response.app_iter = iter(chunks)
+        return response
+
+    def test_store_restore(self):
+        """RenderCache stores streamed responses once consumed."""
+        cache = RenderCache(max_bytes=100)
+        response = cache.store('key', self.response_factory(['a', 'b']))
+        self.assertTrue(cache.get('key') is None)  # Not consumed yet.
+        self.assertEqual(response.body, 'ab')
+        restored = cache.restore(cache.get('key'), Response())
+        self.assertEqual(restored.body, 'ab')
+        self.assertEqual(restored.content_type, 'text/plain')
+        self.assertEqual(restored.content_length, 2)
+
+    def test_too_big(self):
+        """RenderCache does not store responses bigger than budget."""
+        cache = RenderCache(max_bytes=3)
+        response = cache.store('key', self.response_factory(['ab', 'cd']))
+        self.assertEqual(response.body, 'abcd')
+        self.assertTrue(cache.get('key') is None)
+
+    def test_errors(self):
+        """RenderCache does not store error responses."""
+        cache = RenderCache(max_bytes=100)
+        response = self.response_factory(['error'])
+        response.status_int = 500
+        response = cache.store('key', response)
+        self.assertEqual(response.body, 'error')
+        self.assertTrue(cache.get('key') is None)
+
+
+class RenderCacheServiceTestCase(unittest.TestCase):
+    """Render cache integration in LocalService.post()."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.template = os.path.join(self.template_dir, 'hello.txt')
+        self.write_template('Hello {{ name }}')
+        settings = {'diecutter.template_dir': self.template_dir,
+                    'diecutter.render_cache_size': '1000'}
+        self.app = webtest.TestApp(diecutter.wsgi.for_paste({}, **settings))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def write_template(self, content, mtime=1000000000):
+        with open(self.template, 'w') as template_file:
+            template_file.write(content)
+        os.utime(self.template, (mtime, mtime))
+
+    def test_cache(self):
+        """Renders are cached until template version changes."""
+        response = self.app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')
+        # Same size, same mtime: cached response.
+        self.write_template('Hallo {{ name }}')
+        response = self.app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hello world')
+        self.assertEqual(response.headers['Diecutter-Engine'], 'jinja2')
+        # Other context.
+        response = self.app.post('/hello.txt', {'name': 'Remy'})
+        self.assertEqual(response.body, 'Hallo Remy')
+        # Other version.
+        self.write_template('Hallo {{ name }}', mtime=1000000001)
+        response = self.app.post('/hello.txt', {'name': 'world'})
+        self.assertEqual(response.body, 'Hallo world')
+
+    def test_volatile(self):
+        """Templates which read diecutter.now are neither cached nor tagged.
+        """
+        self.write_template('{{ diecutter.now.isoformat() }}')
+        first = self.app.post('/hello.txt', {'name': 'world'})
+        second = self.app.post('/hello.txt', {'name': 'world'})
+        self.assertNotEqual(first.body, second.body)
+        self.assertTrue(second.etag is None)
+        # Other diecutter variables do not change between requests.
+        self.write_template('{{ diecutter.api_url }}', mtime=1000000001)
+        response = self.app.post('/hello.txt', {'name': 'world'})
+        self.assertTrue(response.etag is not None)
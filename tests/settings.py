@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.settings."""
+import unittest
+
+from piecutter.engines.jinja import Jinja2Engine
+from pyramid import testing
+from pyramid.exceptions import ConfigurationError
+
+from diecutter import settings
+from diecutter.writers import targz_directory_response, zip_directory_response
+
+
+class ConfigureTestCase(unittest.TestCase):
+    """Tests around diecutter.settings.configure()."""
+    def test_defaults(self):
+        """configure() resolves default settings."""
+        configuration = settings.configure({})
+        self.assertEqual(configuration.engine, 'jinja2')
+        self.assertEqual(configuration.filename_engine, 'filename')
+        self.assertEqual(configuration.engine_slugs,
+                         ('django', 'filename', 'jinja2'))
+        self.assertTrue(configuration.engines['jinja2'] is Jinja2Engine)
+        self.assertFalse(configuration.readonly)
+        self.assertEqual(configuration.archive_writers['*/*'],
+                         [targz_directory_response])
+        self.assertTrue(configuration.template_dir is None)
+
+    def test_values(self):
+        """configure() converts values."""
+        configuration = settings.configure({
+            'diecutter.readonly': 'true',
+            'diecutter.default_archive_type': 'application/zip',
+            'diecutter.template_cache_size': '12',
+            'diecutter.coalesce_timeout': '0.5'})
+        self.assertTrue(configuration.readonly)
+        self.assertEqual(configuration.archive_writers['*/*'],
+                         [zip_directory_response])
+        self.assertEqual(configuration.template_cache_size, 12)
+        self.assertEqual(configuration.coalesce_timeout, 0.5)
+
+    def test_immutable(self):
+        """Configuration attributes cannot be changed."""
+        configuration = settings.configure({})
+        self.assertRaises(AttributeError,
+                          setattr, configuration, 'readonly', True)
+
+    def test_invalid(self):
+        """configure() raises ConfigurationError for invalid settings."""
+        for invalid in [{'diecutter.engine': 'unknown'},
+                        {'diecutter.engine.foo': 'does.not:Exist'},
+                        {'diecutter.default_archive_type': 'fake/mime'},
+                        {'diecutter.readonly': 'maybe'},
+                        {'diecutter.template_cache_size': 'many'},
+                        {'diecutter.coalesce_timeout': 'soon'},
+                        {'diecutter.template_index': 'sometimes'},
+                        {'diecutter.admission.post': '4'},
+                        {'diecutter.admission.file': '0 4'},
+                        {'diecutter.admission.file': 'four'}]:
+            self.assertRaises(ConfigurationError, settings.configure, invalid)
+
+    def test_engines_lazy(self):
+        """Engine classes are imported on first access."""
+        configuration = settings.configure({
+            'diecutter.engine.foo': 'diecutter.settings:DoesNotExist'})
+        self.assertEqual(sorted(configuration.engines.keys()),
+                         ['django', 'filename', 'foo', 'jinja2'])
+        self.assertRaises(ConfigurationError,
+                          configuration.engines.__getitem__, 'foo')
+
+    def test_default_engines_resolved(self):
+        """Default engines are imported by configure()."""
+        for key in ['diecutter.engine.jinja2', 'diecutter.engine.filename']:
+            invalid = {key: 'piecutter.engines.jinja:Jinja2Engin'}
+            self.assertRaises(ConfigurationError, settings.configure, invalid)
+
+
+class GetConfigurationTestCase(unittest.TestCase):
+    """Tests around diecutter.settings.get_configuration()."""
+    def test_cached(self):
+        """get_configuration() builds configuration once per registry."""
+        config = testing.setUp(settings={'diecutter.readonly': 'true'})
+        try:
+            request = testing.DummyRequest()
+            configuration = settings.get_configuration(request)
+            self.assertTrue(configuration.readonly)
+            self.assertTrue(settings.get_configuration(request)
+                            is configuration)
+            self.assertTrue(config.registry.diecutter_configuration
+                            is configuration)
+        finally:
+            testing.tearDown()
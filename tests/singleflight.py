@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.singleflight."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pyramid.config import Configurator
+from webob import Response
+import webtest
+
+from piecutter.engines.filename import FilenameEngine
+
+from diecutter.local import LocalService
+from diecutter.service import register_service
+from diecutter.settings import configure
+from diecutter.singleflight import SingleFlight
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """Tests around diecutter.singleflight.SingleFlight."""
+    def response_factory(self, chunks, status=200):
+        response = Response(content_type='text/plain')
+        response.status_int = status
+        response.app_iter = iter(chunks)
+        return response
+
+    def test_share(self):
+        """Followers get body of leader once it has been generated."""
+        single_flight = SingleFlight(timeout=10, max_bytes=100)
+        flight, leader = single_flight.join('key')
+        self.assertTrue(leader)
+        self.assertEqual(single_flight.join('key'), (flight, False))
+        response = single_flight.lead('key', flight,
+                                      self.response_factory(['a', 'b']))
+        self.assertFalse(flight.done.is_set())
+        self.assertEqual(response.body, 'ab')
+        shared = single_flight.wait(flight)
+        self.assertEqual(shared.body, 'ab')
+        self.assertEqual(single_flight.info(),
+                         {'hits': 1, 'misses': 1, 'timeouts': 0, 'size': 0})
+        self.assertTrue(single_flight.join('key')[1])  # Flight landed.
+
+    def test_not_shared(self):
+        """Errors, big bodies and failures are not shared."""
+        single_flight = SingleFlight(timeout=10, max_bytes=3)
+        for response in [self.response_factory(['error'], status=500),
+                         self.response_factory(['ab', 'cd'])]:
+            flight, leader = single_flight.join('key')
+            single_flight.lead('key', flight, response).body
+            self.assertTrue(single_flight.wait(flight) is None)
+        flight, leader = single_flight.join('key')
+        single_flight.land('key', flight)  # Leader raised exception.
+        self.assertTrue(single_flight.wait(flight) is None)
+
+    def test_closed(self):
+        """Flight lands when leader's response is closed without being
+        iterated, e.g. by server."""
+        single_flight = SingleFlight(timeout=10, max_bytes=100)
+        flight, leader = single_flight.join('key')
+        response = single_flight.lead('key', flight,
+                                      self.response_factory(['a', 'b']))
+        response.app_iter.close()
+        self.assertTrue(flight.done.is_set())
+        self.assertTrue(single_flight.wait(flight) is None)
+        self.assertTrue(single_flight.join('key')[1])
+
+    def test_timeout(self):
+        """Followers give up after timeout, stale flights are replaced."""
+        clock = FakeClock()
+        single_flight = SingleFlight(timeout=0.01, max_bytes=100,
+                                     clock=clock)
+        flight, leader = single_flight.join('key')
+        self.assertTrue(single_flight.wait(flight) is None)
+        self.assertEqual(single_flight.info()['timeouts'], 1)
+        clock.now = 1
+        other, leader = single_flight.join('key')
+        self.assertTrue(leader)
+        self.assertFalse(other is flight)
+
+
+class SlowEngine(FilenameEngine):
+    """Engine which waits for :py:attr:`release` and counts renders."""
+    release = threading.Event()
+    renders = []
+
+    def render(self, template, context):
+        self.renders.append(template)
+        self.release.wait(5)
+        return super(SlowEngine, self).render(template, context)
+
+
+class WatchedSingleFlight(SingleFlight):
+    """SingleFlight which tells when a follower waits."""
+    waiting = threading.Event()
+
+    def wait(self, flight):
+        self.waiting.set()
+        return super(WatchedSingleFlight, self).wait(flight)
+
+
+class SingleFlightServiceTestCase(unittest.TestCase):
+    """Coalescing in LocalService.post()."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.template_dir, 'hello.txt'), 'w') as f:
+            f.write('Hello +name+')
+        configuration = configure({
+            'diecutter.template_dir': self.template_dir,
+            'diecutter.engine.slow': SlowEngine,
+            'diecutter.coalesce_timeout': '5'})
+        self.service = LocalService()
+        self.service.configure(configuration)
+        self.service.single_flight = WatchedSingleFlight(5, 1000)
+        config = Configurator(settings=configuration.settings)
+        config.registry.diecutter_configuration = configuration
+        config.include('cornice')
+        register_service(config, 'diecutter', self.service, '/')
+        self.app = webtest.TestApp(config.make_wsgi_app())
+        SlowEngine.release.clear()
+        del SlowEngine.renders[:]
+
+    def tearDown(self):
+        SlowEngine.release.set()
+        shutil.rmtree(self.template_dir)
+
+    def test_coalesce(self):
+        """Identical concurrent POST requests render once."""
+        bodies = []
+
+        def post():
+            response = self.app.post('/hello.txt?engine=slow',
+                                     {'name': 'world'})
+            bodies.append(response.body)
+        leader = threading.Thread(target=post)
+        leader.start()
+        follower = threading.Thread(target=post)
+        follower.start()
+        self.assertTrue(self.service.single_flight.waiting.wait(5))
+        SlowEngine.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(bodies, ['Hello world', 'Hello world'])
+        self.assertEqual(len(SlowEngine.renders), 1)
+        info = self.service.cache_info(None)['coalesce']
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
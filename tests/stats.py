@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.stats."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import webtest
+
+import diecutter.wsgi
+from diecutter.stats import Stats, Timings, timed_iter
+
+
+class TimingsTestCase(unittest.TestCase):
+    """Tests around diecutter.stats.Timings."""
+    def test_timed_iter(self):
+        """timed_iter() adds time spent in iterations, excluding nested."""
+        clock = iter([0, 1, 3, 4, 6, 10, 20, 30]).next
+        timings = Timings(clock=clock)
+        inner = timed_iter(['a'], timings, 'render')
+        outer = timed_iter(inner, timings, 'archive')
+        self.assertEqual(list(outer), ['a'])
+        # archive: (0 -> 4) + (6 -> 30), minus render: (1 -> 3) + (10 -> 20)
+        self.assertEqual(timings.durations['render'], 12)
+        self.assertEqual(timings.durations['archive'], 16)
+
+    def test_stats(self):
+        """Stats collect one observation per request and stage."""
+        stats = Stats(buckets=(10,))
+        for duration in (0.001, 0.1):
+            timings = Timings()
+            timings.add('render', duration)
+            stats.record(timings)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['requests'], 2)
+        self.assertEqual(snapshot['stages']['render']['count'], 2)
+        self.assertEqual(snapshot['stages']['render']['buckets'],
+                         [[10, 1], ['+Inf', 2]])
+
+
+class StatsServiceTestCase(unittest.TestCase):
+    """Server-Timing header and /_stats endpoint."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.template_dir, 'hello.txt'), 'w') as f:
+            f.write('Hello {{ name }}')
+        settings = {'diecutter.template_dir': self.template_dir}
+        self.app = webtest.TestApp(diecutter.wsgi.for_paste({}, **settings))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def test_server_timing(self):
+        """Responses have a Server-Timing header, stats are collected."""
+        response = self.app.post('/hello.txt', {'name': 'world'})
+        stages = [item.split(';')[0] for item
+                  in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(sorted(stages),
+                         ['context', 'engine', 'render', 'resource'])
+        stats = self.app.get('/_stats').json
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(sorted(stats['stages'].keys()),
+                         ['context', 'engine', 'render', 'resource', 'total'])
+        self.assertEqual(stats['stages']['render']['count'], 1)
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 """Tests around project's distribution and packaging."""
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 
@@ -65,3 +69,45 @@ class VersionTestCase(unittest.TestCase):
                              project=project_name,
                              installed=installed_version,
                              declared=file_version))
+
+    def test_version_metadata(self):
+        """Installed package reads __version__ from distribution metadata."""
+        site_dir = tempfile.mkdtemp()
+        try:
+            package_dir = os.path.join(site_dir, 'diecutter')
+            os.mkdir(package_dir)
+            shutil.copy(os.path.join(project_dir, 'diecutter', '__init__.py'),
+                        package_dir)
+            os.mkdir(os.path.join(site_dir,
+                                  'diecutter-1.2.3.dev0-py2.7.egg-info'))
+            output = subprocess.check_output(
+                [sys.executable, '-c',
+                 'import diecutter, sys; '
+                 'sys.stdout.write(diecutter.__version__)'],
+                cwd=site_dir)
+        finally:
+            shutil.rmtree(site_dir)
+        self.assertEqual(output, '1.2.3.dev0')
+
+    def test_version_metadata_ambiguous(self):
+        """Stale metadata next to package makes version come from
+        pkg_resources."""
+        site_dir = tempfile.mkdtemp()
+        try:
+            package_dir = os.path.join(site_dir, 'diecutter')
+            os.mkdir(package_dir)
+            shutil.copy(os.path.join(project_dir, 'diecutter', '__init__.py'),
+                        package_dir)
+            for version in ['1.2.3', '1.10.0']:
+                os.mkdir(os.path.join(
+                    site_dir, 'diecutter-{0}-py2.7.egg-info'.format(version)))
+            output = subprocess.check_output(
+                [sys.executable, '-c',
+                 'import diecutter, pkg_resources, sys; '
+                 'sys.stdout.write(diecutter.__version__ + " " + '
+                 'pkg_resources.get_distribution("diecutter").version)'],
+                cwd=site_dir)
+        finally:
+            shutil.rmtree(site_dir)
+        version, expected = output.split()
+        self.assertEqual(version, expected)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.warmup and ``diecutter warmup`` command."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from diecutter.cli import main
+from diecutter.local import LocalService
+from diecutter.settings import configure
+from diecutter.warmup import template_files, warmup, warmup_service
+import diecutter.wsgi
+
+
+class WarmupTestCase(unittest.TestCase):
+    """Tests around diecutter.warmup."""
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        templates = {'hello.txt': u'Hello {{ name }}',
+                     'dir/a.txt': u'A {{ name }}',
+                     'dir/sub/b.txt': u'B {{ name }}',
+                     'broken.txt': u'Broken {{ name'}
+        for path, content in templates.items():
+            path = os.path.join(self.template_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as template_file:
+                template_file.write(content.encode('utf-8'))
+        self.settings = {'diecutter.template_dir': self.template_dir,
+                         'diecutter.bytecode_cache_dir': self.cache_dir}
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def service_factory(self):
+        service = LocalService()
+        service.configure(configure(self.settings))
+        return service
+
+    def test_template_files(self):
+        """template_files() lists files, optionally restricted to paths."""
+        self.assertEqual(list(template_files(self.template_dir)),
+                         ['broken.txt', 'hello.txt', 'dir/a.txt',
+                          'dir/sub/b.txt'])
+        self.assertEqual(
+            list(template_files(self.template_dir,
+                                ['dir/', 'missing', 'dir/a.txt', '../etc'])),
+            ['dir/a.txt', 'dir/sub/b.txt'])
+
+    def test_warmup(self):
+        """warmup() fills caches and reports templates that do not compile.
+        """
+        service = self.service_factory()
+        report = warmup(service)
+        self.assertEqual(report['templates'], 4)
+        self.assertEqual([path for path, message in report['errors']],
+                         ['broken.txt'])
+        self.assertEqual(len(service.template_cache), 3)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_access_log(self):
+        """warmup_service() can compile paths from an access log only."""
+        access_log = os.path.join(self.cache_dir, 'access.log')
+        with open(access_log, 'w') as log_file:
+            log_file.write('- - - [] "POST /dir/sub/ HTTP/1.1" 200 1\n'
+                           '- - - [] "POST /hello.txt HTTP/1.1" 200 1\n'
+                           '- - - [] "POST /hello.txt HTTP/1.1" 200 1\n')
+        report = warmup_service(self.service_factory(), access_log, top=1)
+        self.assertEqual((report['templates'], report['errors']), (1, []))
+
+    def test_for_paste(self):
+        """for_paste() warms up service if "diecutter.warmup" is true."""
+        diecutter.wsgi.for_paste({}, **self.settings)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.settings['diecutter.warmup'] = 'true'
+        diecutter.wsgi.for_paste({}, **self.settings)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_command(self):
+        """``diecutter warmup`` reports errors in exit code and output."""
+        config_uri = os.path.join(self.cache_dir, 'diecutter.ini')
+        with open(config_uri, 'w') as config_file:
+            config_file.write('[app:main]\n'
+                              'use = call:diecutter.wsgi:for_paste\n')
+            for key, value in self.settings.items():
+                config_file.write('{0} = {1}\n'.format(key, value))
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            exit_code = main(['warmup', config_uri])
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(exit_code, 1)
+        self.assertTrue(output.startswith('Compiled 4 templates'))
+        self.assertTrue(errors.startswith('broken.txt: '))
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Tests around diecutter.writers."""
+from StringIO import StringIO
+import struct
+import tarfile
+import types
+import unittest
+import zipfile
+
+from piecutter.engines.filename import FilenameEngine
+from piecutter.engines.jinja import Jinja2Engine
+from piecutter.exceptions import TemplateError
+from pyramid import testing
+
+from diecutter import writers
+from diecutter.engines import CachedEngine
+from diecutter.utils.cache import LRUCache
+
+
+class MockDirResource(object):
+    """Fake directory resource, renders ``content``."""
+    def __init__(self, content, path='/tmp/dummy/'):
+        self.path = path
+        self.content = content
+        self.filename_engine = FilenameEngine()
+
+    def render(self, context):
+        for filename, content in self.content:
+            if isinstance(content, Exception):
+                raise content
+            yield filename, [content]
+
+
+class MockFileResource(object):
+    """Fake file resource, renders ``content``.
+
+    With an ``engine``, ``content`` is template source, returned by
+    ``read()``.
+
+    """
+    def __init__(self, content, engine=None):
+        self.path = '/tmp/dummy.txt'
+        self.content = content
+        self.engine = engine
+
+    def read(self):
+        return self.content
+
+    def render(self, context):
+        if isinstance(self.content, Exception):
+            raise self.content
+        return iter(self.content)
+
+
+class FileResponseTestCase(unittest.TestCase):
+    """Tests around diecutter.writers.file_response()."""
+    def setUp(self):
+        settings = {'diecutter.stream_chunk_size': '4'}
+        self.config = testing.setUp(settings=settings)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def request_factory(self):
+        request = testing.DummyRequest()
+        request.cache = {'diecutter_engine_slug': 'jinja2'}
+        return request
+
+    def test_stream(self):
+        """file_response() streams content in chunks as app_iter."""
+        resource = MockFileResource(['Hello', ' ', 'world!'])
+        response = writers.file_response(self.request_factory(), resource, {})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['Diecutter-Engine'], 'jinja2')
+        self.assertEqual(list(response.app_iter), ['Hell', 'o wo', 'rld!'])
+
+    def test_generate(self):
+        """file_response() sends chunks as template is evaluated."""
+        consumed = []
+
+        def numbers():
+            for number in xrange(1000):
+                consumed.append(number)
+                yield number
+        engine = CachedEngine(Jinja2Engine(), LRUCache())
+        resource = MockFileResource(u'{% for n in numbers %}{{ n }}'
+                                    u'{% endfor %}', engine)
+        response = writers.file_response(self.request_factory(), resource,
+                                         {'numbers': numbers()})
+        self.assertEqual(next(response.app_iter), '0123')
+        self.assertTrue(len(consumed) < 1000)
+        self.assertEqual(''.join(response.app_iter),
+                         ''.join(str(n) for n in xrange(1000))[4:])
+
+    def test_generate_error(self):
+        """file_response() returns 500 if template fails before output."""
+        engine = CachedEngine(Jinja2Engine(), LRUCache())
+        resource = MockFileResource(u'{{ foo.bar.baz }}', engine)
+        response = writers.file_response(self.request_factory(), resource, {})
+        self.assertEqual(response.status_int, 500)
+        self.assertTrue(response.body.startswith('"/tmp/dummy.txt: '))
+
+    def test_early_error(self):
+        """file_response() returns 500 if rendering fails."""
+        resource = MockFileResource(TemplateError('Oops'))
+        response = writers.file_response(self.request_factory(), resource, {})
+        self.assertEqual(response.status_int, 500)
+        self.assertEqual(response.body, '"Oops"')
+
+
+class ZipDirectoryResponseTestCase(unittest.TestCase):
+    """Tests around diecutter.writers.zip_directory_response()."""
+    def test_stream(self):
+        """zip_directory_response() streams archive as app_iter."""
+        resource = MockDirResource([('a.txt', 'A'), ('b/c.txt', 'C')])
+        request = testing.DummyRequest()
+        response = writers.zip_directory_response(request, resource, {})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/zip')
+        self.assertFalse(isinstance(response.app_iter, types.ListType))
+        archive = zipfile.ZipFile(StringIO(response.body))
+        self.assertTrue(archive.testzip() is None)
+        self.assertEqual(archive.namelist(), ['a.txt', 'b/c.txt'])
+        self.assertEqual(archive.read('b/c.txt'), 'C')
+
+    def test_mtime(self):
+        """zip_directory_response() dates entries with tree's mtime."""
+        resource = MockDirResource([('a.txt', 'A')])
+        bodies = []
+        for i in range(2):
+            request = testing.DummyRequest()
+            request.cache = {'diecutter_tree_mtime': 1413633600}
+            response = writers.zip_directory_response(request, resource, {})
+            bodies.append(response.body)
+        self.assertEqual(bodies[0], bodies[1])
+        archive = zipfile.ZipFile(StringIO(bodies[0]))
+        self.assertEqual(archive.getinfo('a.txt').date_time[0], 2014)
+
+    def test_early_error(self):
+        """zip_directory_response() returns 500 if first file fails."""
+        resource = MockDirResource([('a.txt', TemplateError('Oops'))])
+        request = testing.DummyRequest()
+        response = writers.zip_directory_response(request, resource, {})
+        self.assertEqual(response.status_int, 500)
+        self.assertEqual(response.body, '"Oops"')
+
+
+class TargzDirectoryResponseTestCase(unittest.TestCase):
+    """Tests around diecutter.writers.targz_directory_response()."""
+    def test_stream(self):
+        """targz_directory_response() streams archive as app_iter."""
+        resource = MockDirResource([('a.txt', 'A'), ('b/c.txt', 'C')])
+        request = testing.DummyRequest()
+        response = writers.targz_directory_response(request, resource, {})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/gzip')
+        self.assertFalse(isinstance(response.app_iter, types.ListType))
+        archive = tarfile.open(fileobj=StringIO(response.body), mode='r:gz')
+        self.assertEqual(archive.getnames(), ['a.txt', 'b/c.txt'])
+        self.assertEqual(archive.extractfile('b/c.txt').read(), 'C')
+
+    def test_mtime(self):
+        """targz_directory_response() dates entries with tree's mtime."""
+        resource = MockDirResource([('a.txt', 'A')])
+        bodies = []
+        for i in range(2):
+            request = testing.DummyRequest()
+            request.cache = {'diecutter_tree_mtime': 1413633600}
+            response = writers.targz_directory_response(request, resource,
+                                                        {})
+            bodies.append(response.body)
+        self.assertEqual(bodies[0], bodies[1])
+        self.assertEqual(struct.unpack('<L', bodies[0][4:8])[0], 1413633600)
+        archive = tarfile.open(fileobj=StringIO(bodies[0]), mode='r:gz')
+        self.assertEqual(archive.getmember('a.txt').mtime, 1413633600)
+
+    def test_early_error(self):
+        """targz_directory_response() returns 500 if first file fails."""
+        resource = MockDirResource([('a.txt', TemplateError('Oops'))])
+        request = testing.DummyRequest()
+        response = writers.targz_directory_response(request, resource, {})
+        self.assertEqual(response.status_int, 500)
+        self.assertEqual(response.body, '"Oops"')